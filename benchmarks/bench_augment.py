@@ -0,0 +1,103 @@
+"""
+Time of the color / stain augmentation of a batch of `image_size` patches,
+for batch sizes up to `max_batch_size`:
+
+    jitter   : float32 random brightness / saturation / hue / contrast of the
+               legacy PreProcess._load(augment=True)
+    stain    : HED perturbation of the uint8 batch (surf_augment.stain_augmentation
+               without flips)
+    stain+d4 : HED perturbation, flips and 90 degree rotations of the patches
+               and masks (--stain_augment)
+    pipeline : stain+d4 and normalize_batch as the map of a tf.data pipeline
+               (surf_sampler.augmented_normalize), prefetched, as it runs in training
+
+The ops are compiled with tf.function and run on `--device` (the first GPU if
+there is one). The batches are random uint8, the time does not depend on the content.
+
+>>>>Example:
+
+python benchmarks/bench_augment.py --image_size 1024 --max_batch_size 32 --iterations 10
+"""
+import argparse
+import os
+import sys
+import time
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from surf_augment import stain_augmentation
+
+
+def jitter(patches, masks):
+    img = tf.cast(patches, tf.float32)
+    img = tf.image.random_brightness(img, max_delta=50.)
+    img = tf.image.random_saturation(img, lower=0.5, upper=1.5)
+    img = tf.image.random_hue(img, max_delta=0.2)
+    img = tf.image.random_contrast(img, lower=0.5, upper=1.5)
+    return tf.clip_by_value(img, 0.0, 255.0), masks
+
+
+def normalize(patches, masks):
+    # normalize_batch of surf_sampler.py, without its imports (horovod, openslide)
+    patches = 2.0 * tf.cast(patches, tf.float32) / 255.0 - 1.0
+    return patches, tf.one_hot(tf.cast(masks[..., 0] > 0, tf.int32), 2, dtype=tf.float32)
+
+
+def bench(fn, patches, masks, iterations):
+    fn = tf.function(fn)
+    # Warm up (tracing)
+    tf.nest.map_structure(lambda t: t.numpy(), fn(patches, masks))
+    t1 = time.perf_counter()
+    for _ in range(iterations):
+        out = fn(patches, masks)
+    tf.nest.map_structure(lambda t: t.numpy(), out)
+    return (time.perf_counter() - t1) / iterations
+
+
+def bench_pipeline(augment, patches, masks, iterations):
+    dataset = tf.data.Dataset.from_tensors((patches, masks)).repeat()
+    dataset = dataset.map(lambda p, m: normalize(*augment(p, m)), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    batches = iter(dataset)
+    next(batches)
+    t1 = time.perf_counter()
+    for _ in range(iterations):
+        next(batches)
+    return (time.perf_counter() - t1) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the stain augmentation of uint8 batches',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--image_size', type=int, default=1024, help='Image size to use')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='Largest batch size, from 1 in powers of two')
+    parser.add_argument('--iterations', type=int, default=10, help='Timed batches per measurement')
+    parser.add_argument('--device', type=str, default=None, help='Device of the ops, e.g. /CPU:0 (default the first GPU, if any)')
+    parser.add_argument('--sigma', type=float, default=0.05, help='Stain scale of the augmentation')
+    parser.add_argument('--bias', type=float, default=0.05, help='Stain shift of the augmentation')
+    opts = parser.parse_args()
+    device = opts.device or ('/GPU:0' if tf.config.list_physical_devices('GPU') else '/CPU:0')
+
+    stain = stain_augmentation(opts.sigma, opts.bias, geometric=False)
+    stain_d4 = stain_augmentation(opts.sigma, opts.bias)
+    print(f"device {device}, image size {opts.image_size}")
+    print(f"{'batch':>6} | {'method':>9} | {'ms/batch':>9} | {'ms/image':>9} | {'images/s':>9}")
+    print('-' * 55)
+    batch_size = 1
+    while batch_size <= opts.max_batch_size:
+        with tf.device(device):
+            size = opts.image_size
+            patches = tf.random.uniform((batch_size, size, size, 3), 0, 256, dtype=tf.int32)
+            patches = tf.cast(patches, tf.uint8)
+            masks = tf.cast(tf.random.uniform((batch_size, size, size, 1), 0, 2, dtype=tf.int32), tf.uint8)
+            times = {'jitter'  : bench(jitter, patches, masks, opts.iterations),
+                     'stain'   : bench(stain, patches, masks, opts.iterations),
+                     'stain+d4': bench(stain_d4, patches, masks, opts.iterations),
+                     'pipeline': bench_pipeline(stain_d4, patches, masks, opts.iterations)}
+        for name, t in times.items():
+            print(f"{batch_size:>6} | {name:>9} | {1000 * t:>9.1f} | {1000 * t / batch_size:>9.2f} | {batch_size / t:>9.1f}")
+        batch_size *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Fraction of wasted level 0 fetches (patches with a mean channel stddev below
+MIN_PATCH_STD, that the samplers discard and refetch) on sample slides, with
+positions drawn from the CoordinatePools of the tissue contours:
+
+    contours   : every position inside the tissue contours (the samplers
+                 before the overview pre-filter)
+    foreground : the positions of surf_coords.foreground_mask, scored on the
+                 overview with --min_tissue_fraction and --min_overview_std
+
+Also reported are the time to score a slide on the overview and the fetch
+time per patch that is not background. Positions are drawn uniformly over the
+contours of a slide, no tile cache is used.
+
+>>>>Example:
+
+python benchmarks/bench_background.py --slide_path /path/to/slides --slide_format tif --image_size 1024
+"""
+import argparse
+import os
+import sys
+import time
+from glob import glob
+import numpy as np
+import pyvips
+from openslide import OpenSlide
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from surf_coords import CoordinatePool, foreground_mask, patch_stddev, MIN_PATCH_STD
+from surf_tissue import tissue_params, slide_tissue_contours
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the background rejection on the overview',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--slide_path', type=str, required=True, help='Folder of the sample slides')
+    parser.add_argument('--slide_format', type=str, default='tif', help='In which format the whole slide images are saved.')
+    parser.add_argument('--num_slides', type=int, default=4, help='Number of slides to benchmark')
+    parser.add_argument('--num_patches', type=int, default=64, help='Fetched patches per slide and method')
+    parser.add_argument('--image_size', type=int, default=1024, help='Size of the patch')
+    parser.add_argument('--bb_downsample', type=int, default=7, help='Level of the overview')
+    parser.add_argument('--tissue_method', type=str, default='hsv', choices=['hsv', 'otsu'], help='Tissue detection method')
+    parser.add_argument('--min_tissue_fraction', type=float, default=0.5, help='Minimum tissue fraction on the overview')
+    parser.add_argument('--min_overview_std', type=float, default=4.0, help='Minimum mean channel stddev on the overview')
+    opts = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    mag_factor = 2 ** opts.bb_downsample
+    stats = {name: {'fetches': 0, 'background': 0, 'seconds': 0.0} for name in ('contours', 'foreground')}
+    score_seconds, slides = 0.0, 0
+    for slide_path in sorted(glob(os.path.join(opts.slide_path, f'*.{opts.slide_format}')))[:opts.num_slides]:
+        wsi = OpenSlide(slide_path)
+        overview = np.array(wsi.read_region((0, 0), opts.bb_downsample, wsi.level_dimensions[opts.bb_downsample]))
+        contours = slide_tissue_contours(wsi, overview, opts.bb_downsample, tissue_params(opts.tissue_method))
+        width, height = wsi.dimensions
+        wsi.close()
+        if not len(contours):
+            print(f"{slide_path}: no tissue, skipped")
+            continue
+        t1 = time.perf_counter()
+        keep = foreground_mask(overview, contours, opts.image_size / mag_factor, opts.min_tissue_fraction, opts.min_overview_std)
+        score_seconds += time.perf_counter() - t1
+        slides += 1
+
+        image = pyvips.Image.new_from_file(slide_path)
+        region = pyvips.Region.new(image)
+        for name, mask in (('contours', None), ('foreground', keep)):
+            pools = [CoordinatePool(contour, mag_factor, rng=rng, keep=mask) for contour in contours]
+            weights = np.array([len(pool) for pool in pools], dtype=np.float64)
+            for k in rng.choice(len(pools), size=opts.num_patches, p=weights / weights.sum()):
+                y, x = pools[k].next()
+                x, y = int(min(x, width - opts.image_size)), int(min(y, height - opts.image_size))
+                t1 = time.perf_counter()
+                patch = np.ndarray((opts.image_size, opts.image_size, image.bands),
+                                   buffer=region.fetch(x, y, opts.image_size, opts.image_size), dtype=np.uint8)
+                background = patch_stddev(patch) < MIN_PATCH_STD
+                stats[name]['seconds'] += time.perf_counter() - t1
+                stats[name]['fetches'] += 1
+                stats[name]['background'] += int(background)
+
+    print(f"{'positions':>10} | {'fetches':>8} | {'wasted %':>9} | {'ms/useful patch':>16}")
+    print('-' * 52)
+    for name, stat in stats.items():
+        useful = stat['fetches'] - stat['background']
+        print(f"{name:>10} | {stat['fetches']:>8} | {100 * stat['background'] / max(stat['fetches'], 1):>9.1f} | "
+              f"{1000 * stat['seconds'] / max(useful, 1):>16.1f}")
+    print(f"overview scoring {1000 * score_seconds / max(slides, 1):.1f} ms/slide")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Read time of a context patch of `image_size` pixels with a field of view of
+`image_size * 2**level` level 0 pixels, on sample slides:
+
+    level0  : pyvips Region.fetch of the whole field of view at level 0, resized
+              to image_size with cv2.INTER_AREA (what a large FoV costs without
+              the pyramid)
+    pyramid : pyvips Region.fetch of image_size pixels at the pyramid level
+              (SurfSampler.read_contexts)
+
+Positions are random in the slide, no tile cache is used. Drop the page
+cache between runs (`echo 3 > /proc/sys/vm/drop_caches`) to measure cold reads.
+
+>>>>Example:
+
+python benchmarks/bench_context.py --slide_path /path/to/slides --slide_format tif --image_size 1024 --level 2
+"""
+import argparse
+import os
+import time
+from glob import glob
+import numpy as np
+import cv2
+import pyvips
+
+
+def fetch(region, bands, x, y, size):
+    return np.ndarray((size, size, bands), buffer=region.fetch(x, y, size, size), dtype=np.uint8)[..., :3]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of context patches from a pyramid level against level 0',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--slide_path', type=str, required=True, help='Folder of the sample slides')
+    parser.add_argument('--slide_format', type=str, default='tif', help='In which format the whole slide images are saved.')
+    parser.add_argument('--num_slides', type=int, default=4, help='Number of slides to benchmark')
+    parser.add_argument('--num_patches', type=int, default=16, help='Context patches per slide')
+    parser.add_argument('--image_size', type=int, default=1024, help='Size of the context patch')
+    parser.add_argument('--level', type=int, default=2, help='Pyramid level of the context patch')
+    opts = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    times = {'level0': 0.0, 'pyramid': 0.0}
+    count = 0
+    for slide_path in sorted(glob(os.path.join(opts.slide_path, f'*.{opts.slide_format}')))[:opts.num_slides]:
+        image = pyvips.Image.new_from_file(slide_path)
+        level_image = pyvips.Image.new_from_file(slide_path, level=opts.level)
+        region, level_region = pyvips.Region.new(image), pyvips.Region.new(level_image)
+        downsample = image.width / level_image.width
+        fov = int(round(opts.image_size * downsample))
+        if fov > min(image.width, image.height):
+            print(f"{slide_path}: field of view {fov} larger than the slide, skipped")
+            continue
+        for _ in range(opts.num_patches):
+            x, y = rng.randint(0, image.width - fov), rng.randint(0, image.height - fov)
+            t1 = time.perf_counter()
+            patch = fetch(region, image.bands, x, y, fov)
+            cv2.resize(patch, (opts.image_size, opts.image_size), interpolation=cv2.INTER_AREA)
+            t2 = time.perf_counter()
+            fetch(level_region, level_image.bands, int(x / downsample), int(y / downsample), opts.image_size)
+            t3 = time.perf_counter()
+            times['level0'] += t2 - t1
+            times['pyramid'] += t3 - t2
+            count += 1
+
+    print(f"{'read':>8} | {'patches':>8} | {'ms/patch':>9} | {'MB read':>10}")
+    print('-' * 45)
+    size, scale = opts.image_size, 2 ** opts.level
+    for name, pixels in (('level0', (size * scale) ** 2), ('pyramid', size ** 2)):
+        print(f"{name:>8} | {count:>8} | {1000 * times[name] / max(count, 1):>9.1f} | {3 * pixels / 2**20:>10.1f}")
+    print(f"speedup {times['level0'] / max(times['pyramid'], 1e-9):.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the per batch patch-coordinate sampling of SurfSampler,
+against the area of the contour that is sampled from.
+
+    legacy : full overview mask + cv2.drawContours per patch, random.choice and
+             np.isin / np.delete to remove the used coordinate (the sampler before surf_coords.py)
+    pool   : CoordinatePool, built once per contour, O(1) cursor per patch
+
+Only needs numpy and OpenCV, the contours are synthetic circles on an overview
+the size of a CAMELYON slide at bb_downsample 7.
+
+>>>>Example:
+
+python benchmarks/bench_coordinate_pool.py --batch_size 8 --steps_per_epoch 50000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from surf_coords import CoordinatePool
+
+
+def circle_contour(radius, center):
+    msk = np.zeros((2 * center[1], 2 * center[0]), np.uint8)
+    cv2.circle(msk, center, radius, 255, -1)
+    contours, _ = cv2.findContours(msk, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return contours[0]
+
+
+def legacy_batch(state, contour, overview_shape, opts):
+    for i in range(opts.batch_size):
+        msk = np.zeros(overview_shape, np.uint8)
+        cv2.drawContours(msk, [contour], -1, (255), -1)
+        if not len(state['pixelpoints']):
+            pixelpoints = np.transpose(np.nonzero(msk))[..., :2] * opts.mag_factor
+            np.random.shuffle(pixelpoints)
+            state['pixelpoints'] = pixelpoints[:opts.part, :]
+        pixelcoords = random.choice(state['pixelpoints'])
+        del_row = np.where(np.all(np.isin(state['pixelpoints'], pixelcoords), axis=1))
+        state['pixelpoints'] = np.delete(state['pixelpoints'], del_row, axis=0)
+        if len(state['pixelpoints']) <= opts.batch_size:
+            state['pixelpoints'] = []
+
+
+def pool_batch(state, contour, overview_shape, opts):
+    if state.get('pool') is None:
+        state['pool'] = CoordinatePool(contour, opts.mag_factor, size=opts.part)
+    for i in range(opts.batch_size):
+        state['pool'].next()
+
+
+def bench(fn, contour, overview_shape, opts):
+    state = {'pixelpoints': []}
+    # Warm up (includes building the pool / first mask)
+    fn(state, contour, overview_shape, opts)
+    t1 = time.perf_counter()
+    for _ in range(opts.iterations):
+        fn(state, contour, overview_shape, opts)
+    return (time.perf_counter() - t1) / opts.iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of patch-coordinate sampling',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch_size', type=int, default=8, help='Patches per batch')
+    parser.add_argument('--steps_per_epoch', type=int, default=50000, help='Steps per epoch of the sampler')
+    parser.add_argument('--num_slides', type=int, default=10, help='Number of slides, the pool holds steps_per_epoch // num_slides coordinates')
+    parser.add_argument('--overview', type=int, nargs=2, default=[1536, 768], help='Overview (width, height) at bb_downsample')
+    parser.add_argument('--bb_downsample', type=int, default=7, help='Level of the overview')
+    parser.add_argument('--radii', type=int, nargs='+', default=[10, 25, 50, 100, 200, 350], help='Contour radii on the overview')
+    parser.add_argument('--iterations', type=int, default=20, help='Timed batches per measurement')
+    opts = parser.parse_args()
+    opts.mag_factor = pow(2, opts.bb_downsample)
+    opts.part = max(2, opts.steps_per_epoch // opts.num_slides)
+
+    overview_shape = (opts.overview[1], opts.overview[0], 4)
+    center = (opts.overview[0] // 2, opts.overview[1] // 2)
+
+    print(f"{'contour area (px)':>18} | {'legacy (ms/batch)':>18} | {'pool (ms/batch)':>16} | {'speedup':>8}")
+    print('-' * 70)
+    for radius in opts.radii:
+        radius = min(radius, min(center) - 1)
+        contour = circle_contour(radius, center)
+        area = int(cv2.contourArea(contour))
+        t_legacy = bench(legacy_batch, contour, overview_shape, opts)
+        t_pool = bench(pool_batch, contour, overview_shape, opts)
+        print(f"{area:>18} | {1000 * t_legacy:>18.3f} | {1000 * t_pool:>16.3f} | {t_legacy / t_pool:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
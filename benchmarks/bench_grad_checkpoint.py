@@ -0,0 +1,106 @@
+"""
+Peak GPU memory and step time of a training step with and without gradient
+checkpointing, for increasing image sizes (FoV).
+
+    deeplab      : Deeplabv3 (xception), --grad_checkpoint none / all
+                   (Xception entry and middle flow blocks recomputed)
+    efficientdet : EfficientDetNet with the segmentation head,
+                   grad_checkpoint none / all (MBConv blocks and FPN cells recomputed)
+
+A size that does not fit on the GPU is reported as OOM. Peak memory needs
+TensorFlow >= 2.5 (tf.config.experimental.get_memory_info).
+
+>>>>Example:
+
+python benchmarks/bench_grad_checkpoint.py --model deeplab --image_sizes 1024 2048 4096 --batch_size 1
+"""
+import argparse
+import os
+import sys
+import time
+import tensorflow as tf
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def get_model(opts, image_size, grad_checkpoint):
+    if opts.model == 'deeplab':
+        sys.path.insert(0, os.path.join(ROOT, 'deeplab', 'keras-deeplab-v3-plus-master'))
+        from model import Deeplabv3
+        model_opts = argparse.Namespace(grad_checkpoint=grad_checkpoint, weights_path=None)
+        return Deeplabv3(weights=None, input_shape=(image_size, image_size, 3), classes=2, backbone='xception', opts=model_opts)
+
+    sys.path.insert(0, os.path.join(ROOT, 'efficientdet'))
+    import hparams_config
+    from keras import efficientdet_keras
+    config = hparams_config.get_efficientdet_config(opts.name)
+    config.heads = ['segmentation']
+    config.image_size = image_size
+    config.grad_checkpoint = grad_checkpoint
+    model = efficientdet_keras.EfficientDetNet(config=config)
+    model.build((opts.batch_size, image_size, image_size, 3))
+    return model
+
+
+def bench(opts, image_size, grad_checkpoint):
+    """ (peak memory in GB, seconds per step) of the training step, or None on OOM """
+    tf.keras.backend.clear_session()
+    try:
+        model = get_model(opts, image_size, grad_checkpoint)
+        optimizer = tf.keras.optimizers.SGD(0.001, momentum=0.9)
+        loss_func = tf.keras.losses.CategoricalCrossentropy(from_logits=True)
+
+        @tf.function
+        def train_step(x, y):
+            with tf.GradientTape() as tape:
+                logits = model(x, training=True)
+                if isinstance(logits, (list, tuple)):
+                    logits = logits[-1]
+                logits = tf.image.resize(tf.cast(logits, tf.float32), tf.shape(y)[1:3])
+                loss = loss_func(y, logits)
+            grads = tape.gradient(loss, model.trainable_variables)
+            optimizer.apply_gradients(zip(grads, model.trainable_variables))
+            return loss
+
+        x = tf.random.uniform((opts.batch_size, image_size, image_size, 3), -1, 1)
+        y = tf.one_hot(tf.random.uniform((opts.batch_size, image_size, image_size), 0, 2, dtype=tf.int32), 2)
+        # Warm up (tracing, slot variables)
+        train_step(x, y).numpy()
+        if opts.device.startswith('GPU'):
+            tf.config.experimental.reset_memory_stats(opts.device)
+        t1 = time.perf_counter()
+        for _ in range(opts.iterations):
+            loss = train_step(x, y)
+        loss.numpy()
+        steptime = (time.perf_counter() - t1) / opts.iterations
+        peak = tf.config.experimental.get_memory_info(opts.device)['peak'] / 2**30 if opts.device.startswith('GPU') else float('nan')
+        return peak, steptime
+    except (tf.errors.ResourceExhaustedError, tf.errors.InternalError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of gradient checkpointing',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model', type=str, default='deeplab', choices=['deeplab', 'efficientdet'], help='Model to train')
+    parser.add_argument('--name', type=str, default='efficientdet-d0', help='Name of the efficientdet model')
+    parser.add_argument('--image_sizes', type=int, nargs='+', default=[1024, 2048, 4096], help='Image sizes to benchmark')
+    parser.add_argument('--batch_size', type=int, default=1, help='Batch size to use')
+    parser.add_argument('--iterations', type=int, default=5, help='Timed steps per measurement')
+    parser.add_argument('--device', type=str, default='GPU:0', help='Device of which the peak memory is reported')
+    opts = parser.parse_args()
+
+    print(f"{'image size':>10} | {'checkpoint':>10} | {'peak (GB)':>9} | {'s/step':>8}")
+    print('-' * 47)
+    for image_size in opts.image_sizes:
+        for grad_checkpoint in ('none', 'all'):
+            result = bench(opts, image_size, grad_checkpoint)
+            if result is None:
+                print(f"{image_size:>10} | {grad_checkpoint:>10} | {'OOM':>9} | {'-':>8}")
+            else:
+                peak, steptime = result
+                print(f"{image_size:>10} | {grad_checkpoint:>10} | {peak:>9.2f} | {steptime:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Patches per second of the train patch reads, live from the slides against
+a patch cache of surf_patches.py.
+
+    live    : SurfSampler.iter_slide, pyvips Region.fetch of the tiles (JPEG /
+              JPEG2000 decode) of the sampler's ROI's
+    random  : PatchCache.batch of random patch indices (memory mapped)
+    stream  : PatchCache.iter_shard, whole shards in file order
+
+Run on one worker without horovodrun. Drop the page cache between runs
+(`echo 3 > /proc/sys/vm/drop_caches`) to measure cold reads.
+
+>>>>Example:
+
+python surf_patches.py --slide_path /path/to/slides --label_path /path/to/labels --image_size 512 --patch_cache_dir /path/to/cache
+python benchmarks/bench_patch_cache.py --slide_path /path/to/slides --label_path /path/to/labels --image_size 512 --patch_cache_dir /path/to/cache
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import horovod.tensorflow as hvd
+from surf_patches import PatchCache, add_sampler_arguments
+
+
+def bench_live(opts):
+    from surf_sampler import SurfSampler
+    sampler = SurfSampler(opts, mode='train')
+    count = 0
+    t1 = time.perf_counter()
+    for wsi_idx in range(len(sampler.train_paths)):
+        for _ in sampler.iter_slide(wsi_idx, opts.num_patches - count):
+            count += 1
+        if count >= opts.num_patches:
+            break
+    return count, time.perf_counter() - t1
+
+
+def bench_random(cache, opts):
+    rng = np.random.RandomState(0)
+    count = 0
+    t1 = time.perf_counter()
+    while count < opts.num_patches:
+        patches, _ = cache.batch(rng.randint(0, len(cache), size=opts.batch_size))
+        count += len(patches)
+    return count, time.perf_counter() - t1
+
+
+def bench_stream(cache, opts):
+    count = 0
+    t1 = time.perf_counter()
+    for k in range(len(cache.shards)):
+        for patches, _ in cache.iter_shard(k, chunk=opts.batch_size):
+            count += len(patches)
+        if count >= opts.num_patches:
+            break
+    return count, time.perf_counter() - t1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the patch cache against live slide reads',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_sampler_arguments(parser)
+    parser.add_argument('--patch_cache_dir', type=str, help='Folder of the patch cache', required=True)
+    parser.add_argument('--num_patches', type=int, default=512, help='Patches read per measurement')
+    opts = parser.parse_args()
+    hvd.init()
+
+    cache = PatchCache(opts.patch_cache_dir)
+    assert cache.image_size == opts.image_size, f"WARNING: patch cache has image size {cache.image_size}"
+
+    print(f"{'read':>8} | {'patches':>8} | {'seconds':>8} | {'patches/s':>10}")
+    print('-' * 45)
+    results = {}
+    for name, fn in (('live', lambda: bench_live(opts)),
+                     ('random', lambda: bench_random(cache, opts)),
+                     ('stream', lambda: bench_stream(cache, opts))):
+        count, seconds = fn()
+        results[name] = count / seconds
+        print(f"{name:>8} | {count:>8} | {seconds:>8.2f} | {results[name]:>10.1f}")
+    print(f"speedup random {results['random'] / results['live']:.1f}x, stream {results['stream'] / results['live']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
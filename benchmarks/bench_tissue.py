@@ -0,0 +1,98 @@
+"""
+Runtime and agreement of the tissue detection methods of surf_tissue.py on
+sample slides, against the original pipeline of SurfSampler.get_bb.
+
+    legacy : HSV inRange, 50 x 50 close and 30 x 30 open with np.ones kernels
+             through PIL, and the index mutating contour delete loop
+    hsv    : the same thresholds, without the PIL round trips, with a correct
+             filter of the small contours
+    otsu   : Otsu on the saturation of an automatically chosen thumbnail level,
+             downscaled separable morphology and a connected component area filter
+
+Times include reading the overview / thumbnail with OpenSlide. The IoU is
+computed between the filled contours of a method and of legacy, on the
+overview at bb_downsample.
+
+>>>>Example:
+
+python benchmarks/bench_tissue.py --slide_path /path/to/slides --slide_format tif --num_slides 10
+"""
+import argparse
+import os
+import sys
+import time
+from glob import glob
+import numpy as np
+import cv2
+from PIL import Image
+from openslide import OpenSlide
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from surf_tissue import TISSUE_PARAMS, tissue_params, slide_tissue_contours
+
+
+def legacy_contours(rgb_image, params=TISSUE_PARAMS):
+    hsv = cv2.cvtColor(rgb_image, cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv, np.array(params['hsv_lower']), np.array(params['hsv_upper']))
+    close_kernel = np.ones((params['close_kernel'], params['close_kernel']), dtype=np.uint8)
+    image_close = Image.fromarray(cv2.morphologyEx(np.array(mask), cv2.MORPH_CLOSE, close_kernel))
+    open_kernel = np.ones((params['open_kernel'], params['open_kernel']), dtype=np.uint8)
+    image_open = Image.fromarray(cv2.morphologyEx(np.array(image_close), cv2.MORPH_OPEN, open_kernel))
+    contours, _ = cv2.findContours(np.array(image_open), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = list(contours)
+    _offset = 0
+    for i, contour in enumerate(contours):
+        if contour.shape[0] < params['min_contour_points']:
+            del contours[i]
+            _offset += 1
+            i = i - _offset
+    return contours
+
+
+def fill(contours, shape):
+    mask = np.zeros(shape, dtype=np.uint8)
+    cv2.drawContours(mask, [np.asarray(contour, dtype=np.int32) for contour in contours], -1, 1, -1)
+    return mask
+
+
+def iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return np.logical_and(a, b).sum() / union if union else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the tissue detection methods',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--slide_path', type=str, required=True, help='Folder of the sample slides')
+    parser.add_argument('--slide_format', type=str, default='tif', help='In which format the whole slide images are saved.')
+    parser.add_argument('--num_slides', type=int, default=10, help='Number of slides to benchmark')
+    parser.add_argument('--bb_downsample', type=int, default=7, help='Level of the overview')
+    opts = parser.parse_args()
+
+    methods = ('legacy', 'hsv', 'otsu')
+    times = {method: [] for method in methods}
+    ious = {method: [] for method in methods}
+    print(f"{'slide':>24} | " + ' | '.join(f"{method + ' (s)':>11} | {'IoU':>5}" for method in methods))
+    for slide_path in sorted(glob(os.path.join(opts.slide_path, f'*.{opts.slide_format}')))[:opts.num_slides]:
+        wsi = OpenSlide(slide_path)
+        level = opts.bb_downsample
+        masks, row = {}, []
+        for method in methods:
+            t1 = time.perf_counter()
+            overview = np.array(wsi.read_region((0, 0), level, wsi.level_dimensions[level]))
+            if method == 'legacy':
+                contours = legacy_contours(overview)
+            else:
+                contours = slide_tissue_contours(wsi, overview, level, tissue_params(method))
+            times[method].append(time.perf_counter() - t1)
+            masks[method] = fill(contours, overview.shape[:2])
+            ious[method].append(iou(masks[method], masks['legacy']))
+            row.append(f"{times[method][-1]:>11.3f} | {ious[method][-1]:>5.3f}")
+        wsi.close()
+        print(f"{os.path.basename(slide_path)[-24:]:>24} | " + ' | '.join(row))
+
+    print(f"{'mean':>24} | " + ' | '.join(f"{np.mean(times[method]):>11.3f} | {np.mean(ious[method]):>5.3f}" for method in methods))
+
+
+if __name__ == '__main__':
+    main()
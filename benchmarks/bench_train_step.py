@@ -0,0 +1,115 @@
+"""
+Throughput of the DeepLab training step, before and after the compiled step
+of deeplab/train.py.
+
+    legacy   : eager step with a persistent tape, `set_value` of the learning
+               rate, and a second `tape.gradient` + apply through a new SGD
+               optimizer every step (train_one_step before get_train_step)
+    compiled : `tf.function` step, one gradient pass, one optimizer with a
+               LearningRateSchedule (get_train_step)
+
+Runs on a single worker without Horovod (the distributed tape is a plain
+average with one worker). The model is Deeplabv3 with the xception backbone,
+or a small conv net with `--model small` for a quick check on CPU.
+
+>>>>Example:
+
+python benchmarks/bench_train_step.py --image_size 512 --batch_size 2 --iterations 20
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deeplab'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'deeplab', 'keras-deeplab-v3-plus-master'))
+
+
+def get_model(opts):
+    if opts.model == 'deeplab':
+        from model import Deeplabv3
+        return Deeplabv3(weights=None, input_shape=(opts.image_size, opts.image_size, 3), classes=2, backbone='xception', opts=opts)
+    inputs = tf.keras.Input((opts.image_size, opts.image_size, 3))
+    x = inputs
+    for filters in (32, 64, 128):
+        x = tf.keras.layers.Conv2D(filters, 3, padding='same', activation='relu')(x)
+    outputs = tf.keras.layers.Conv2D(2, 1)(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def cosine_lr(step, opts):
+    step = step % opts.total_steps
+    return 0.5 * opts.base_lr * (1 + np.cos(np.pi * step / opts.total_steps))
+
+
+def legacy_step(model, opt, x, y, step, loss_func, opts):
+    with tf.GradientTape(persistent=True) as tape:
+        logits = model(x, training=True)
+        loss = loss_func(y, logits)
+    tf.keras.backend.set_value(opt.lr, cosine_lr(step, opts))
+    grads = tape.gradient(loss, model.trainable_variables)
+    opt.apply_gradients(zip(grads, model.trainable_variables))
+    opt = tf.keras.optimizers.SGD(learning_rate=cosine_lr(step, opts), momentum=0.9, nesterov=True)
+    grads = tape.gradient(loss, model.trainable_variables)
+    opt.apply_gradients(zip(grads, model.trainable_variables))
+    del tape
+    return loss
+
+
+def get_compiled_step(model, opt, loss_func):
+    @tf.function
+    def train_step(x, y):
+        with tf.GradientTape() as tape:
+            logits = model(x, training=True)
+            loss = loss_func(y, logits)
+        grads = tape.gradient(loss, model.trainable_variables)
+        opt.apply_gradients(zip(grads, model.trainable_variables))
+        return loss
+    return train_step
+
+
+def bench(step_fn, opts):
+    x = tf.random.uniform((opts.batch_size, opts.image_size, opts.image_size, 3), -1, 1)
+    y = tf.one_hot(tf.random.uniform((opts.batch_size, opts.image_size, opts.image_size), 0, 2, dtype=tf.int32), 2)
+    # Warm up (tracing, slot variables)
+    for step in range(2):
+        step_fn(x, y, step).numpy()
+    t1 = time.perf_counter()
+    for step in range(opts.iterations):
+        loss = step_fn(x, y, step)
+    loss.numpy()
+    return (time.perf_counter() - t1) / opts.iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the DeepLab training step',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--model', type=str, default='deeplab', choices=['deeplab', 'small'], help='Model to train')
+    parser.add_argument('--image_size', type=int, default=512, help='Image size to use')
+    parser.add_argument('--batch_size', type=int, default=2, help='Batch size to use')
+    parser.add_argument('--base_lr', type=float, default=0.001, help='Base learning rate of the cosine schedule')
+    parser.add_argument('--total_steps', type=int, default=1000, help='Period of the cosine schedule')
+    parser.add_argument('--iterations', type=int, default=20, help='Timed steps per measurement')
+    opts = parser.parse_args()
+    loss_func = tf.keras.losses.BinaryCrossentropy(from_logits=True)
+
+    model = get_model(opts)
+    opt = tf.keras.optimizers.SGD(opts.base_lr, momentum=0.9, nesterov=True)
+    t_legacy = bench(lambda x, y, step: legacy_step(model, opt, x, y, step, loss_func, opts), opts)
+
+    model = get_model(opts)
+    schedule = tf.keras.optimizers.schedules.CosineDecay(opts.base_lr, opts.total_steps)
+    compiled_step = get_compiled_step(model, tf.keras.optimizers.SGD(schedule, momentum=0.9, nesterov=True), loss_func)
+    t_compiled = bench(lambda x, y, step: compiled_step(x, y), opts)
+
+    print(f"{'step':>10} | {'s/step':>8} | {'images/s':>9}")
+    print('-' * 34)
+    for name, t in (('legacy', t_legacy), ('compiled', t_compiled)):
+        print(f"{name:>10} | {t:>8.3f} | {opts.batch_size / t:>9.1f}")
+    print(f"speedup {t_legacy / t_compiled:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -126,8 +126,52 @@ def _conv2d_same(x, filters, prefix, stride=1, kernel_size=3, rate=1):
                       name=prefix)(x)
 
 
+class RecomputeGrad(layers.Layer):
+    """ Wraps a block (a keras Model), of which the activations are not kept for
+        the backward pass, but recomputed with tf.recompute_grad.
+        The moving statistics of BatchNormalization layers in the block are
+        updated twice per step (forward pass and recomputation).
+    """
+
+    def __init__(self, block, **kwargs):
+        super(RecomputeGrad, self).__init__(name=block.name + '_recompute', **kwargs)
+        self.block = block
+
+    def call(self, inputs, training=None):
+        return tf.recompute_grad(lambda x: self.block(x, training=training))(inputs)
+
+
+def _layers_with_weights(model):
+    """ All layers with weights of a model, including the blocks in RecomputeGrad layers """
+    for layer in model.layers:
+        if isinstance(layer, RecomputeGrad):
+            for block_layer in _layers_with_weights(layer.block):
+                yield block_layer
+        elif isinstance(layer, Model):
+            for block_layer in _layers_with_weights(layer):
+                yield block_layer
+        elif layer.weights:
+            yield layer
+
+
+def _load_weights_by_name(model, weights_path):
+    """ model.load_weights(by_name=True) only matches the top level layers, this
+        also loads the layers inside the RecomputeGrad blocks (keras h5 format)
+    """
+    import h5py
+    with h5py.File(weights_path, 'r') as f:
+        if 'model_weights' in f:
+            f = f['model_weights']
+        for layer in _layers_with_weights(model):
+            if layer.name not in f:
+                continue
+            group = f[layer.name]
+            weight_names = [n.decode('utf8') if isinstance(n, bytes) else n for n in group.attrs['weight_names']]
+            layer.set_weights([group[name][()] for name in weight_names])
+
+
 def _xception_block(inputs, depth_list, prefix, skip_connection_type, stride,
-                    rate=1, depth_activation=False, return_skip=False):
+                    rate=1, depth_activation=False, return_skip=False, recompute=False):
     """ Basic building block of modified Xception network
         Args:
             inputs: input tensor
@@ -138,7 +182,15 @@ def _xception_block(inputs, depth_list, prefix, skip_connection_type, stride,
             rate: atrous rate for depthwise convolution
             depth_activation: flag to use activation between depthwise & pointwise convs
             return_skip: flag to return additional tensor after 2 SepConvs for decoder
+            recompute: flag to recompute the activations of the block in the backward pass
             """
+    if recompute:
+        # Build the block as its own model, and wrap it
+        block_input = Input(shape=inputs.shape[1:])
+        block_outputs = _xception_block(block_input, depth_list, prefix, skip_connection_type, stride,
+                                        rate=rate, depth_activation=depth_activation, return_skip=return_skip)
+        return RecomputeGrad(Model(block_input, block_outputs, name=prefix))(inputs)
+
     residual = inputs
     for i in range(3):
         residual = SepConv_BN(residual,
@@ -270,6 +322,11 @@ def Deeplabv3(weights='pascal_voc', input_tensor=None, input_shape=(512, 512, 3)
         raise ValueError('The `backbone` argument should be either '
                          '`xception`  or `mobilenetv2` ')
 
+    # Gradient checkpointing of the Xception entry / middle flow blocks
+    grad_checkpoint = getattr(opts, 'grad_checkpoint', 'none')
+    recompute_entry = grad_checkpoint in ('entry', 'all')
+    recompute_middle = grad_checkpoint in ('middle', 'all')
+
     if input_tensor is None:
         img_input = Input(shape=input_shape)
     else:
@@ -298,18 +355,18 @@ def Deeplabv3(weights='pascal_voc', input_tensor=None, input_shape=(512, 512, 3)
 
         x = _xception_block(x, [128, 128, 128], 'entry_flow_block1',
                             skip_connection_type='conv', stride=2,
-                            depth_activation=False)
+                            depth_activation=False, recompute=recompute_entry)
         x, skip1 = _xception_block(x, [256, 256, 256], 'entry_flow_block2',
                                    skip_connection_type='conv', stride=2,
-                                   depth_activation=False, return_skip=True)
+                                   depth_activation=False, return_skip=True, recompute=recompute_entry)
 
         x = _xception_block(x, [728, 728, 728], 'entry_flow_block3',
                             skip_connection_type='conv', stride=entry_block3_stride,
-                            depth_activation=False)
+                            depth_activation=False, recompute=recompute_entry)
         for i in range(16):
             x = _xception_block(x, [728, 728, 728], 'middle_flow_unit_{}'.format(i + 1),
                                 skip_connection_type='sum', stride=1, rate=middle_block_rate,
-                                depth_activation=False)
+                                depth_activation=False, recompute=recompute_middle)
 
         x = _xception_block(x, [728, 1024, 1024], 'exit_flow_block1',
                             skip_connection_type='conv', stride=1, rate=exit_block_rates[0],
@@ -480,7 +537,10 @@ def Deeplabv3(weights='pascal_voc', input_tensor=None, input_shape=(512, 512, 3)
             weights_path = get_file('deeplabv3_mobilenetv2_tf_dim_ordering_tf_kernels.h5',
                                     WEIGHTS_PATH_MOBILE,
                                     cache_subdir='models')
-        model.load_weights(weights_path, by_name=True)
+        if recompute_entry or recompute_middle:
+            _load_weights_by_name(model, weights_path)
+        else:
+            model.load_weights(weights_path, by_name=True)
     elif weights == 'cityscapes':
         if backbone == 'xception':
             weights_path = get_file('deeplabv3_xception_tf_dim_ordering_tf_kernels_cityscapes.h5',
@@ -490,7 +550,10 @@ def Deeplabv3(weights='pascal_voc', input_tensor=None, input_shape=(512, 512, 3)
             weights_path = get_file('deeplabv3_mobilenetv2_tf_dim_ordering_tf_kernels_cityscapes.h5',
                                     WEIGHTS_PATH_MOBILE_CS,
                                     cache_subdir='models')
-        model.load_weights(weights_path, by_name=True)
+        if recompute_entry or recompute_middle:
+            _load_weights_by_name(model, weights_path)
+        else:
+            model.load_weights(weights_path, by_name=True)
     return model
 
 def preprocess_input(x):
@@ -40,6 +40,9 @@ def get_options():
                         help='Reduce to FP16 precision for gradient all reduce')
     parser.add_argument('--mixed_precision', action='store_true',
                         help='Enable "mixed_float16" policy for keras layers.')
+    parser.add_argument('--grad_checkpoint', type=str, default='none', choices=['none', 'entry', 'middle', 'all'],
+                        help='Recompute the activations of the Xception entry and / or middle flow blocks in the backward pass, '
+                             'trades compute for memory at large image sizes')
 
     # Optimizer and learning rate scheduling options
     parser.add_argument('--optimizer', type=str, default='Adam', choices=['Adam', 'SGD'])
@@ -58,7 +61,11 @@ def get_options():
     parser.add_argument('--max_lr', type=float, default=0.001, help='Maximum learning rate for the cyclic learning rate')
 
     # == Dataset and path options ==
-    parser.add_argument('--hard_mining', action='store_true', help='Use hard mining or not')
+    parser.add_argument('--hard_mining', action='store_true',
+                        help='Draw train patches proportional to their recorded loss (see surf_mining.py), implies --stratified')
+    parser.add_argument('--mining_decay', type=float, default=0.9, help='Decay of the hard mining heat at every reweighting')
+    parser.add_argument('--mining_cap', type=float, default=4.0, help='Maximum sampling weight of a hard patch, relative to an easy one')
+    parser.add_argument('--mining_refresh', type=int, default=100, help='Reweight the hard mining draws every X batches')
     parser.add_argument('--slide_path', type=str,
                         help='Folder of where the training data whole slide images are located', default=None)
     parser.add_argument('--label_path', type=str,
@@ -77,12 +84,67 @@ def get_options():
     parser.add_argument('--evaluate', action='store_true',
                         help='Only evaluate slides present in valid_slide_{path,label}')
     parser.add_argument('--model_dir', type=str, help='Model dir for saved_model', default=None)
+    parser.add_argument('--tiled_inference', action='store_true',
+                        help='Evaluate whole slides on a regular grid of tiles with stitched probability maps (see surf_inference.py)')
+    parser.add_argument('--tile_overlap', type=int, default=128, help='Overlap in patch pixels (at the target magnification) between the tiles of --tiled_inference')
+    parser.add_argument('--tile_batch_size', type=int, default=8, help='Batch size of the tiles of --tiled_inference')
+    parser.add_argument('--prob_map_level', type=int, default=5,
+                        help='Level (downsampling 2**level of level 0) of the stitched probability map of --tiled_inference')
 
     # == Options for SURF Sampler ==
     parser.add_argument('--bb_downsample', type=int,
                         help='Level to use for the bounding box construction as downsampling level of whole slide image',
                         default=7)
     parser.add_argument('--batch_tumor_ratio', type=float, help='The ratio of the batch that contains tumor', default=1)
+    parser.add_argument('--contour_index_dir', type=str, default=None,
+                        help='Folder of the persistent contour index of the WSI\'s (see surf_index.py), not used if None')
+    parser.add_argument('--prefetch_workers', type=int, default=0,
+                        help='Processes per worker that prefetch training batches (see surf_prefetch.py), 0 = sample synchronously')
+    parser.add_argument('--prefetch_depth', type=int, default=4, help='Number of batches in the prefetch ring buffer')
+    parser.add_argument('--tf_dataset', action='store_true',
+                        help='Sample training batches with one long-lived tf.data pipeline (SurfSampler.as_dataset)')
+    parser.add_argument('--shard_seed', type=int, default=0,
+                        help='Seed of the division of the slides over the workers, which is rebalanced every epoch')
+    parser.add_argument('--pairing_rules', type=str, nargs='*', default=[],
+                        help='Rules REGEX=>TEMPLATE that map a label file name to its slide file name (see surf_pairing.py)')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='JSONL dataset manifest of slide / label pairs and slide metadata (see surf_manifest.py), loaded instead of globbing if it exists, written otherwise')
+    parser.add_argument('--fuzzy_cutoff', type=float, default=0.6, help='Minimum string similarity of the fuzzy pairing of leftover labels')
+    parser.add_argument('--patch_cache_dir', type=str, default=None,
+                        help='Train on a patch cache of surf_patches.py instead of reading the slides, not used if None')
+    parser.add_argument('--tile_cache_mb', type=int, default=1024,
+                        help='Size in MB of the per process LRU cache of decoded slide tiles (see surf_tiles.py), 0 = read patches with pyvips directly')
+    parser.add_argument('--no_overlays', dest='overlays', action='store_false',
+                        help='Do not draw and write the sampling overlays of the WSI\'s to --log_dir')
+    parser.add_argument('--overlay_interval', type=float, default=60,
+                        help='Write the sampling overlay of a WSI at most every X seconds (in a background thread)')
+    parser.add_argument('--tissue_method', type=str, default='hsv', choices=['hsv', 'otsu'],
+                        help='Tissue detection: HSV threshold of the overview, or Otsu on the saturation of an automatically chosen thumbnail level (see surf_tissue.py)')
+    parser.add_argument('--stratified', action='store_true',
+                        help='Draw train batches with exact tumor / boundary / normal ratios over all train WSI\'s (see surf_strata.py)')
+    parser.add_argument('--boundary_ratio', type=float, default=0.0,
+                        help='The ratio of the batch from tumor boundary positions with --stratified')
+    parser.add_argument('--target_level', type=int, default=0,
+                        help='Sample patches at the magnification of this pyramid level, read from that level (see SurfSampler.read_patch)')
+    parser.add_argument('--target_mpp', type=float, default=None,
+                        help='Sample patches at this resolution in micron per pixel, read from the nearest pyramid level (overrides --target_level)')
+    parser.add_argument('--context_levels', type=int, nargs='*', default=[],
+                        help='Pyramid levels of image_size context patches centred on every patch, read from that level (e.g. 2 for a 4x wider view), for a model with a context input (not Deeplabv3)')
+    parser.add_argument('--min_tissue_fraction', type=float, default=0.5,
+                        help='Minimum tissue fraction on the overview of the footprint of a sampled patch, background positions are never fetched (see surf_coords.foreground_mask)')
+    parser.add_argument('--min_overview_std', type=float, default=4.0,
+                        help='Minimum mean channel stddev on the overview of the footprint of a sampled patch (the overview is smoothed, keep it below the level 0 threshold of 15)')
+    parser.add_argument('--sampler_seed', type=int, default=0,
+                        help='Seed of the sampling RNG of every worker (combined with the rank and the sampler mode)')
+    parser.add_argument('--resume_sampler', action='store_true',
+                        help='Resume the model, optimizer and sampling position of the last resume point in --log_dir (see deeplab/train.py save_resume_point)')
+    parser.add_argument('--stain_augment', action='store_true',
+                        help='H&E stain augmentation (HED perturbation, flips and 90 degree rotations) of the uint8 train batches in the input pipeline (see surf_augment.py)')
+    parser.add_argument('--stain_sigma', type=float, default=0.05,
+                        help='Scale of the stains with --stain_augment, every stain is scaled by U(1 - sigma, 1 + sigma)')
+    parser.add_argument('--stain_bias', type=float, default=0.05,
+                        help='Shift of the stains in optical density with --stain_augment, U(-bias, bias)')
+    parser.add_argument('--interleave_slides', type=int, default=4, help='Number of WSI\'s sampled in parallel with --tf_dataset')
 
 
     # == Log options ==
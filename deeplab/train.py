@@ -14,81 +14,80 @@ import tensorflow as tf
 import time
 from tqdm import tqdm
 import random
+from glob import glob
 from surf_sampler import SurfSampler, PreProcess
-from utils import init, setup_logger, log_training_step, log_validation_step, cosine_decay_with_warmup, \
-    get_model_and_optimizer, cyclic_learning_rate
+from surf_prefetch import PrefetchSampler
+from surf_patches import PatchCacheSampler
+from surf_inference import TiledInference
+from utils import init, setup_logger, log_training_step, log_validation_step, get_model_and_optimizer
 
 
 
 
 def start(opts):
-    train_sampler = SurfSampler(opts)
+    # The samplers can read context patches, but Deeplabv3 has a single image input
+    assert not opts.context_levels, "WARNING: --context_levels needs a model with a context input, Deeplabv3 has none"
+    if opts.hard_mining:
+        assert not opts.patch_cache_dir, "WARNING: hard mining draws from the slides, not from a patch cache"
+        # The tf.data threads draw ahead of the train step, the losses can not be matched to their patches
+        assert not opts.tf_dataset, "WARNING: --hard_mining records the losses of the sampler batches, it can not be combined with --tf_dataset"
+        # The losses of a batch are fed back to the sampler of this process, that draws it (see surf_mining.py)
+        opts.stratified = True
+        opts.prefetch_workers = 0
+    if opts.patch_cache_dir:
+        # Cached patches are a memory mapped read, there is nothing to prefetch
+        opts.prefetch_workers = 0
+    if opts.resume_sampler:
+        # Sampled in other processes / tf.data threads, their position is not saved (see SurfSampler.save_state)
+        assert not (opts.prefetch_workers or opts.tf_dataset or opts.patch_cache_dir), \
+            "WARNING: --resume_sampler needs the SurfSampler of this process, without --prefetch_workers, --tf_dataset or --patch_cache_dir"
+    if opts.patch_cache_dir:
+        train_sampler = PatchCacheSampler(opts)
+    else:
+        train_sampler = SurfSampler(opts)
+    if opts.prefetch_workers:
+        train_sampler = PrefetchSampler(train_sampler, opts)
     valid_sampler = SurfSampler(opts,mode='validation')
     test_sampler = SurfSampler(opts,mode='test')
     preprocessor = PreProcess(opts)
     return train_sampler, valid_sampler, test_sampler, preprocessor
 
 
-def train_one_step(model, opt, x, y, step, loss_func, compression, opts):
-
-    preprocess = PreProcess(opts)
-
-    with tf.GradientTape(persistent=True) as tape:
-        logits = model(x, training=True)
-        loss = loss_func(y, logits)
-        # scaled_loss = opt.get_scaled_loss(loss)
-
-    # Horovod: add Horovod Distributed GradientTape.
-    tape = hvd.DistributedGradientTape(tape, compression=compression,
-                                       op=hvd.Average)  # ,device_sparse='/gpu:2', device_dense='/gpu:2')
-    # scaled_gradients = tape.gradient(scaled_loss, model.trainable_variables)
-    # grads = opt.get_unscaled_gradients(scaled_gradients)
-
-    if opts.lr_scheduler == 'constant':
-        lr = opts.base_lr
-    elif opts.lr_scheduler == 'cosine':
-        lr = cosine_decay_with_warmup(global_step=step,
-                                      learning_rate_base=opts.base_lr,
-                                      total_steps=opts.steps_per_epoch // 2,
-                                      warmup_learning_rate=opts.warmup_learning_rate,
-                                      warmup_steps=2 * hvd.size())
-    elif opts.lr_scheduler == 'cyclic':
-        lr = cyclic_learning_rate(global_step=step,
-                                  base_lr=opts.min_lr,
-                                  max_lr=opts.max_lr,
-                                  step_size=opts.step_size,
-                                  gamma=opts.gamma)
-    else:
-        raise NotImplementedError('Unsupported learning rate scheduling type')
+def get_train_step(model, opt, loss_func, compression, patch_losses=False):
+    """
+    Compiled training step: one forward / backward pass, gradients averaged
+    over the workers and applied by the (persistent) optimizer. The learning
+    rate schedule is evaluated by the optimizer itself, see utils.get_learning_rate.
+    With `patch_losses` it also returns the mean loss per patch, for hard mining (else None)
+    """
+    @tf.function
+    def train_step(x, y):
+        with tf.GradientTape() as tape:
+            logits = model(x, training=True)
+            loss = loss_func(y, logits)
+
+        # Horovod: add Horovod Distributed GradientTape.
+        tape = hvd.DistributedGradientTape(tape, compression=compression,
+                                           op=hvd.Average)  # ,device_sparse='/gpu:2', device_dense='/gpu:2')
+        grads = tape.gradient(loss, model.trainable_variables)
+        opt.apply_gradients(zip(grads, model.trainable_variables))
+        if not patch_losses:
+            return loss, tf.argmax(logits, axis=-1), None
+        losses = tf.reduce_mean(tf.keras.losses.binary_crossentropy(y, logits, from_logits=True), axis=[1, 2])
+        return loss, tf.argmax(logits, axis=-1), losses
 
-    tf.keras.backend.set_value(opt.lr, lr)
+    return train_step
 
-    grads = tape.gradient(loss, model.trainable_variables)
 
-    opt.apply_gradients(zip(grads, model.trainable_variables))
+def train_one_step(train_step, model, opt, x, y):
+    loss, pred, patch_losses = train_step(x, y)
 
-    if step == 0:
+    # Horovod: broadcast the initial variables (and optimizer slots, which exist after the first step)
+    if opt.iterations == 1:
         hvd.broadcast_variables(model.variables, root_rank=0)
         hvd.broadcast_variables(opt.variables(), root_rank=0)
 
-    if not opts.evaluate:
-        lr = cosine_decay_with_warmup(global_step=step,
-                                          learning_rate_base=0.001,
-                                          warmup_learning_rate=0.00001,
-                                          total_steps=opts.steps_per_epoch // 1,
-                                          warmup_steps=2*hvd.size())
-        opt = tf.keras.optimizers.SGD(learning_rate=lr*hvd.size(), momentum=0.9, nesterov=True)
-        grads = tape.gradient(loss, model.trainable_variables)
-
-        opt.apply_gradients(zip(grads, model.trainable_variables))
-        if step == 0:
-            hvd.broadcast_variables(model.variables, root_rank=0)
-            hvd.broadcast_variables(opt.variables(), root_rank=0)
-
-    pred = tf.argmax(logits, axis=-1)
-    
-    del tape
-    return loss, pred, opt
+    return loss, pred, patch_losses
 
 
 def validate(opts, model, step, val_dataset, file_writer, metrics, epoch):
@@ -118,6 +117,46 @@ def validate(opts, model, step, val_dataset, file_writer, metrics, epoch):
     return
 
 
+def resume_prefix(opts, epoch, step):
+    """ Prefix of the model / optimizer checkpoint of the resume point at (epoch, step) of the next batch """
+    return os.path.join(opts.log_dir, 'resume', f'epoch_{epoch:03d}_step_{step:08d}')
+
+
+def save_resume_point(opts, checkpoint, train_sampler, step):
+    """
+    - Saves the model and optimizer (with its iterations, so the learning rate
+    schedule continues) on rank 0, then the sampler state of every worker
+    (see SurfSampler.save_state), so a saved sampler state always has its
+    checkpoint. Only the last resume point is kept.
+    """
+    prefix = resume_prefix(opts, train_sampler.epoch, step)
+    if hvd.rank() == 0:
+        checkpoint.write(prefix)
+    train_sampler.save_state(step)
+    if hvd.rank() == 0:
+        for path in glob(os.path.join(opts.log_dir, 'resume', '*')):
+            if not path.startswith(prefix + '.'):
+                os.remove(path)
+
+
+def restore_resume_point(opts, checkpoint, train_sampler):
+    """
+    Restores the model and optimizer of the resume point of the loaded sampler
+    state (--resume_sampler), refuses to resume without it
+    """
+    epoch, step = train_sampler.epoch, train_sampler.resume_step
+    if not epoch and not step:
+        if hvd.rank() == 0:
+            print(f"No sampler state in {opts.log_dir}, training starts at epoch 0")
+        return
+    prefix = resume_prefix(opts, epoch, step)
+    assert tf.io.gfile.exists(prefix + '.index'), \
+        f"WARNING: the sampler state of {opts.log_dir} is at epoch {epoch}, step {step}, but there is no checkpoint {prefix}, can not resume"
+    checkpoint.read(prefix).assert_existing_objects_matched()
+    if hvd.rank() == 0:
+        print(f"Resumed model and optimizer (iteration {int(checkpoint.optimizer.iterations)}) from {prefix}")
+
+
 def train(opts, model, optimizer, file_writer, compression,train_sampler,valid_sampler,preprocessor):
 
     step = 0
@@ -131,20 +170,45 @@ def train(opts, model, optimizer, file_writer, compression,train_sampler,valid_s
     # tf.profiler.experimental.start(opts.log_dir, tf.profiler.experimental.ProfilerOptions(host_tracer_level=3, python_tracer_level=0))
     # tf.profiler.experimental.start(opts.log_dir)
     ### 10 steps for measuring profile ###
-    for epoch in range(opts.epochs):
-        for step in range(0, opts.steps_per_epoch, hvd.size() * opts.batch_size):
+    train_step = get_train_step(model, optimizer, compute_loss, compression, patch_losses=opts.hard_mining)
+    if opts.tf_dataset:
+        # The pipeline is built once, and consumed every step
+        train_iter = iter(train_sampler.as_dataset())
+    # The sampling position is saved with a checkpoint of the model and optimizer (see save_resume_point),
+    # and with --resume_sampler the training continues at the epoch and step of the saved sampler state
+    resumable = isinstance(train_sampler, SurfSampler) and not opts.tf_dataset and opts.log_dir
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer)
+    start_epoch, start_step = 0, 0
+    if opts.resume_sampler:
+        restore_resume_point(opts, checkpoint, train_sampler)
+        start_epoch, start_step = train_sampler.epoch, train_sampler.resume_step
+    stride = hvd.size() * opts.batch_size
+    train_seconds = 0.0
+    for epoch in range(start_epoch, opts.epochs):
+        for step in range(start_step if epoch == start_epoch else 0, opts.steps_per_epoch, stride):
             # with tf.profiler.experimental.Trace('train', step_num=step, _r=1):
-            patch, mask = train_sampler.__getitem__(step)
-            train_ds = preprocessor.tfdataset(patch,mask)
+            if opts.tf_dataset:
+                train_ds = [next(train_iter)]
+            else:
+                patch, mask = train_sampler.__getitem__(step)
+                train_ds = preprocessor.tfdataset(patch,mask,augment=True)
             for patch, mask in train_ds:
                 t1 = time.time()
-                loss, pred, optimizer = train_one_step(model, optimizer, patch, mask, step, compute_loss, compression, opts)
+                loss, pred, patch_losses = train_one_step(train_step, model, optimizer, patch, mask)
+                if opts.hard_mining:
+                    train_sampler.record_losses(patch_losses.numpy())
                 steptime = time.time() - t1
+                train_seconds += steptime
                 if hvd.rank() == 0:
                     print(f'\nTraining step in {steptime} seconds\n')
     
                 if step % opts.log_every == 0 and step > 0:
                     log_training_step(opts, model, file_writer, patch, mask, loss, pred, step, metrics, optimizer, steptime,epoch)
+                    if opts.prefetch_workers and hvd.rank() == 0:
+                        print(f"Prefetch queue: {train_sampler.stats()}")
+                    if opts.hard_mining and hvd.rank() == 0:
+                        print(f"Hard mining: {train_sampler.miner.stats()}, "
+                              f"{100 * train_sampler.miner.seconds / max(train_seconds, 1e-9):.1f}% of the step time")
     
                 if step % opts.validate_every == 0 and step > 0:
                     # Only one sample for validation
@@ -155,25 +219,25 @@ def train(opts, model, optimizer, file_writer, compression,train_sampler,valid_s
                     if hvd.rank() == 0:
                         print(f'\nSaving model...\n')
                         model.save(os.path.join(opts.log_dir, f'saved_model_{step}'), save_format="tf")
-    
-                if opts.hard_mining:
-                    # Bit ugly to define the function here, but it works
-                    def filter_hard_mining(image, mask):
-                        pred_logits = model(image)
-                        pred = tf.math.argmax(pred_logits, axis=-1)
-                        miou = tf.keras.metrics.MeanIoU(num_classes=2)(mask, pred)
-                        # Only select training samples with miou less then 0.95
-                        return miou < 0.95
-    
-                    _len = tf.data.experimental.cardinality(train_ds)
-                    train_ds = train_ds.filter(filter_hard_mining)
-                    print(f"Hard mining removed {_len - tf.data.experimental.cardinality(train_ds)} images")
+                    if opts.hard_mining:
+                        # Every worker saves its own hard mining state with the checkpoint
+                        train_sampler.save_mining()
+                    if resumable:
+                        save_resume_point(opts, checkpoint, train_sampler, step + stride)
 
     
         if hvd.rank() == 0:
             model.save(os.path.join(opts.log_dir, f'saved_model_{step}'), save_format="tf")
+        if opts.hard_mining:
+            train_sampler.save_mining()
+        # Rebalance the slides over the workers
+        train_sampler.on_epoch_end()
+        if resumable:
+            save_resume_point(opts, checkpoint, train_sampler, 0)
         print(f"Finished epoch {epoch}!")
     
+    if opts.prefetch_workers:
+        train_sampler.close()
     return 
 
 def test(opts, model, optimizer, file_writer, compression, sampler,preprocess):
@@ -200,7 +264,7 @@ def test(opts, model, optimizer, file_writer, compression, sampler,preprocess):
                                                                      past_wsi=past_wsi)
         for patch, mask in test_ds:
             t1 = time.time()
-            loss, pred, optimizer = train_one_step(model, optimizer, patch, mask, step, compute_loss, compression, opts)
+            pred = tf.argmax(model(patch, training=False), axis=-1)
             steptime = time.time() - t1
             if hvd.rank() == 0: print(f'\nTest step in {steptime} seconds\n')
 
@@ -241,7 +305,12 @@ if __name__ == '__main__':
 
         if hvd.rank() == 0:
             print('Preparing evaluation...')
-        test(opts, model, optimizer, file_writer, compression, test_sampler)
+        if opts.tiled_inference:
+            inference = TiledInference(model, opts)
+            for slide_path, prob_map, overview in inference.run(test_sampler):
+                inference.save(slide_path, prob_map, overview)
+        else:
+            test(opts, model, optimizer, file_writer, compression, test_sampler)
         if hvd.rank() == 0:
             print('Evaluation is done')
     else:
@@ -64,70 +64,99 @@ def init(opts):
         print("Past hvd.init()")
 
 
-def cosine_decay_with_warmup(global_step,
-                             learning_rate_base,
-                             total_steps,
-                             warmup_learning_rate=0.0,
-                             warmup_steps=0,
-                             hold_base_rate_steps=0):
-    """Cosine decay schedule with warm up period.
+class CosineDecayWithWarmup(tf.keras.optimizers.schedules.LearningRateSchedule):
+    """
+    Cosine decay schedule with warm up period, as LearningRateSchedule, so
+    the optimizer evaluates it in graph at every step.
 
     Cosine annealing learning rate as described in:
       Loshchilov and Hutter, SGDR: Stochastic Gradient Descent with Warm Restarts.
       ICLR 2017. https://arxiv.org/abs/1608.03983
-    In this schedule, the learning rate grows linearly from warmup_learning_rate
-    to learning_rate_base for warmup_steps, then transitions to a cosine decay
-    schedule.
-
-    Arguments:
-        global_step {int} -- global step.
-        learning_rate_base {float} -- base learning rate.
-        total_steps {int} -- total number of training steps.
-
-    Keyword Arguments:
-        warmup_learning_rate {float} -- initial learning rate for warm up. (default: {0.0})
-        warmup_steps {int} -- number of warmup steps. (default: {0})
-        hold_base_rate_steps {int} -- Optional number of steps to hold base learning rate
-                                    before decaying. (default: {0})
-    Returns:
-      a float representing learning rate.
-
-    Raises:
-      ValueError: if warmup_learning_rate is larger than learning_rate_base,
-        or if warmup_steps is larger than total_steps.
+    The learning rate grows linearly from warmup_learning_rate to
+    learning_rate_base for warmup_steps, then follows a cosine decay, which
+    restarts every total_steps.
+
+    The optimizer counts batches (`optimizer.iterations`), while the
+    schedule parameters are in images of all workers, so the iterations are
+    multiplied by `step_scale` (hvd.size() * batch_size).
     """
-    if global_step > 0:
-        global_step = global_step % total_steps
-    if total_steps < warmup_steps:
-        raise ValueError('total_steps must be larger or equal to '
-                         'warmup_steps.')
-    learning_rate = 0.5 * learning_rate_base * (1 + np.cos(
-        np.pi *
-        (global_step - warmup_steps - hold_base_rate_steps
-         ) / float(total_steps - warmup_steps - hold_base_rate_steps)))
-    if hold_base_rate_steps > 0:
-        learning_rate = np.where(global_step > warmup_steps + hold_base_rate_steps,
-                                 learning_rate, learning_rate_base)
-    if warmup_steps > 0:
-        if learning_rate_base < warmup_learning_rate:
+    def __init__(self, learning_rate_base, total_steps, warmup_learning_rate=0.0, warmup_steps=0, step_scale=1):
+        super().__init__()
+        if total_steps < warmup_steps:
+            raise ValueError('total_steps must be larger or equal to '
+                             'warmup_steps.')
+        if warmup_steps > 0 and learning_rate_base < warmup_learning_rate:
             raise ValueError('learning_rate_base must be larger or equal to '
                              'warmup_learning_rate.')
-        slope = (learning_rate_base - warmup_learning_rate) / warmup_steps
-        warmup_rate = slope * global_step + warmup_learning_rate
-        learning_rate = np.where(global_step < warmup_steps, warmup_rate,
-                                 learning_rate)
-    return np.where(global_step > total_steps, 0.0, learning_rate)
-
-
-def cyclic_learning_rate(global_step, base_lr=0.001, max_lr=0.006, step_size=2000., gamma=1):
-
-    def scale_fn(step):
-        return gamma ** step
-
-    cycle = np.floor(1 + global_step / (2 * step_size))
-    x = np.abs(global_step / step_size - 2 * cycle + 1)
-
-    return base_lr + (max_lr - base_lr) * np.maximum(0, (1 - x)) * scale_fn(global_step)
+        self.learning_rate_base = learning_rate_base
+        self.total_steps = total_steps
+        self.warmup_learning_rate = warmup_learning_rate
+        self.warmup_steps = warmup_steps
+        self.step_scale = step_scale
+
+    def __call__(self, step):
+        global_step = tf.math.floormod(tf.cast(step, tf.float32) * self.step_scale, float(self.total_steps))
+        learning_rate = 0.5 * self.learning_rate_base * (1 + tf.cos(
+            np.pi * (global_step - self.warmup_steps) / float(self.total_steps - self.warmup_steps)))
+        if self.warmup_steps > 0:
+            slope = (self.learning_rate_base - self.warmup_learning_rate) / self.warmup_steps
+            warmup_rate = slope * global_step + self.warmup_learning_rate
+            learning_rate = tf.where(global_step < self.warmup_steps, warmup_rate, learning_rate)
+        return learning_rate
+
+    def get_config(self):
+        return {'learning_rate_base'  : self.learning_rate_base,
+                'total_steps'         : self.total_steps,
+                'warmup_learning_rate': self.warmup_learning_rate,
+                'warmup_steps'        : self.warmup_steps,
+                'step_scale'          : self.step_scale}
+
+
+class CyclicLearningRate(tf.keras.optimizers.schedules.LearningRateSchedule):
+    """ Triangular cyclic learning rate between base_lr and max_lr as LearningRateSchedule, see CosineDecayWithWarmup for `step_scale` """
+    def __init__(self, base_lr=0.001, max_lr=0.006, step_size=2000., gamma=1, step_scale=1):
+        super().__init__()
+        self.base_lr = base_lr
+        self.max_lr = max_lr
+        self.step_size = float(step_size)
+        self.gamma = gamma
+        self.step_scale = step_scale
+
+    def __call__(self, step):
+        global_step = tf.cast(step, tf.float32) * self.step_scale
+        cycle = tf.floor(1 + global_step / (2 * self.step_size))
+        x = tf.abs(global_step / self.step_size - 2 * cycle + 1)
+        return self.base_lr + (self.max_lr - self.base_lr) * tf.maximum(0., (1 - x)) * tf.pow(self.gamma, global_step)
+
+    def get_config(self):
+        return {'base_lr'   : self.base_lr,
+                'max_lr'    : self.max_lr,
+                'step_size' : self.step_size,
+                'gamma'     : self.gamma,
+                'step_scale': self.step_scale}
+
+
+def get_learning_rate(opts):
+    """ Learning rate (schedule) of the optimizer, according to opts.lr_scheduler """
+    # One optimizer step processes batch_size images on every worker
+    step_scale = hvd.size() * opts.batch_size
+    if opts.lr_scheduler == 'constant':
+        # Scaled linearly with the number of workers, as the optimizer learning rate always was with Horovod
+        return opts.base_lr * hvd.size() if opts.horovod else opts.base_lr
+    elif opts.lr_scheduler == 'cosine':
+        return CosineDecayWithWarmup(learning_rate_base=opts.base_lr,
+                                     total_steps=opts.steps_per_epoch // 2,
+                                     warmup_learning_rate=opts.warmup_learning_rate,
+                                     warmup_steps=2 * hvd.size(),
+                                     step_scale=step_scale)
+    elif opts.lr_scheduler == 'cyclic':
+        return CyclicLearningRate(base_lr=opts.min_lr,
+                                  max_lr=opts.max_lr,
+                                  step_size=opts.step_size,
+                                  gamma=opts.gamma,
+                                  step_scale=step_scale)
+    else:
+        raise NotImplementedError('Unsupported learning rate scheduling type')
 
 
 def get_model_and_optimizer(opts):
@@ -147,10 +176,11 @@ def get_model_and_optimizer(opts):
         # Horovod: (optional) compression algorithm.
         compression = hvd.Compression.fp16 if opts.fp16_allreduce else hvd.Compression.none
 
+        # The schedule lives in the optimizer, it is not reset by hand every step
         if opts.optimizer == 'Adam':
-            opt = tf.optimizers.Adam(opts.base_lr * hvd.size(), epsilon=opts.epsilon)
+            opt = tf.optimizers.Adam(get_learning_rate(opts), epsilon=opts.epsilon)
         elif opts.optimizer == 'SGD':
-            opt = tf.optimizers.SGD(opts.base_lr * hvd.size(), opts.momentum, opts.nesterov)
+            opt = tf.optimizers.SGD(get_learning_rate(opts), opts.momentum, opts.nesterov)
         else:
             raise NotImplementedError('Only SGD and Adam are supported for now')
 
@@ -161,9 +191,9 @@ def get_model_and_optimizer(opts):
 
     else:
         if opts.optimizer == 'Adam':
-            opt = tf.optimizers.Adam(opts.base_lr, epsilon=opts.epsilon)
+            opt = tf.optimizers.Adam(get_learning_rate(opts), epsilon=opts.epsilon)
         elif opts.optimizer == 'SGD':
-            opt = tf.optimizers.SGD(opts.base_lr, opts.momentum, opts.nesterov)
+            opt = tf.optimizers.SGD(get_learning_rate(opts), opts.momentum, opts.nesterov)
         else:
             raise NotImplementedError('Only SGD and Adam are supported for now')
         compression = None
@@ -251,7 +281,10 @@ def log_training_step(opts, model, file_writer, x, y, loss, pred, step, metrics,
 
             # Logging the optimizer's hyperparameters
             for key in optimizer._hyper:
-                tf.summary.scalar(key, optimizer._hyper[key].numpy(), step=tf.cast(step, tf.int64))
+                value = optimizer._hyper[key]
+                if isinstance(value, tf.keras.optimizers.schedules.LearningRateSchedule):
+                    value = value(optimizer.iterations)
+                tf.summary.scalar(key, value.numpy(), step=tf.cast(step, tf.int64))
             # Extract weights and filter out None elemens for aspp without weights
             weights = filter(None, [x.weights for x in model.layers])
             for var in weights:
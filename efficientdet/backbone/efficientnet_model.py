@@ -37,7 +37,7 @@ GlobalParams = collections.namedtuple('GlobalParams', [
     'num_classes', 'width_coefficient', 'depth_coefficient', 'depth_divisor',
     'min_depth', 'survival_prob', 'relu_fn', 'batch_norm', 'use_se',
     'local_pooling', 'condconv_num_experts', 'clip_projection_output',
-    'blocks_args', 'fix_head_stem'
+    'blocks_args', 'fix_head_stem', 'grad_checkpoint'
 ])
 GlobalParams.__new__.__defaults__ = (None,) * len(GlobalParams._fields)
 
@@ -359,13 +359,15 @@ class MBConvBlock(tf.keras.layers.Layer):
         epsilon=self._batch_norm_epsilon,
         name=get_bn_name())
 
-  def call(self, inputs, training, survival_prob=None):
+  def call(self, inputs, training, survival_prob=None, drop_mask=None):
     """Implementation of call().
 
     Args:
       inputs: the inputs tensor.
       training: boolean, whether the model is constructed for training.
       survival_prob: float, between 0 to 1, drop connect rate.
+      drop_mask: binary [batch, 1, 1, 1] drop connect mask, drawn in the call
+        if None (see utils.drop_connect_mask).
 
     Returns:
       A output tensor.
@@ -409,7 +411,7 @@ class MBConvBlock(tf.keras.layers.Layer):
           ) and self._block_args.input_filters == self._block_args.output_filters:
             # Apply only if skip connection presents.
             if survival_prob:
-              x = utils.drop_connect(x, training, survival_prob)
+              x = utils.drop_connect(x, training, survival_prob, drop_mask)
             x = tf.add(x, inputs)
         logging.info('Project shape: %s', x.shape)
         return x
@@ -449,13 +451,15 @@ class MBConvBlockWithoutDepthwise(MBConvBlock):
         momentum=self._batch_norm_momentum,
         epsilon=self._batch_norm_epsilon)
 
-  def call(self, inputs, training, survival_prob=None):
+  def call(self, inputs, training, survival_prob=None, drop_mask=None):
     """Implementation of call().
 
     Args:
       inputs: the inputs tensor.
       training: boolean, whether the model is constructed for training.
       survival_prob: float, between 0 to 1, drop connect rate.
+      drop_mask: binary [batch, 1, 1, 1] drop connect mask, drawn in the call
+        if None (see utils.drop_connect_mask).
 
     Returns:
       A output tensor.
@@ -482,7 +486,7 @@ class MBConvBlockWithoutDepthwise(MBConvBlock):
       ) and self._block_args.input_filters == self._block_args.output_filters:
         # Apply only if skip connection presents.
         if survival_prob:
-          x = utils.drop_connect(x, training, survival_prob)
+          x = utils.drop_connect(x, training, survival_prob, drop_mask)
         x = tf.add(x, inputs)
     logging.info('Project shape: %s', x.shape)
     return x
@@ -743,7 +747,22 @@ class Model(tf.keras.Model):
             drop_rate = 1.0 - survival_prob
             survival_prob = 1.0 - drop_rate * float(idx) / len(self._blocks)
             logging.info('block_%s survival_prob: %s', idx, survival_prob)
-          outputs = block(outputs, training=training, survival_prob=survival_prob)
+          if (self._global_params.grad_checkpoint and training and block.built
+              and survival_prob):
+            # Recompute the activations of the block in the backward pass. The
+            # drop connect mask is drawn outside, so the recomputation drops
+            # the same samples.
+            drop_mask = utils.drop_connect_mask(outputs, survival_prob)
+            outputs = tf.recompute_grad(
+                lambda x, mask, block=block, p=survival_prob: block(
+                    x, training=training, survival_prob=p, drop_mask=mask))(
+                        outputs, drop_mask)
+          elif self._global_params.grad_checkpoint and training and block.built:
+            # Recompute the activations of the block in the backward pass.
+            outputs = tf.recompute_grad(
+                lambda x, block=block: block(x, training=training))(outputs)
+          else:
+            outputs = block(outputs, training=training, survival_prob=survival_prob)
           self.endpoints['block_%s' % idx] = outputs
           if is_reduction:
             self.endpoints['reduction_%s' % reduction_idx] = outputs
@@ -193,8 +193,68 @@ def default_detection_configs():
   # This is to avoid an imbalanced dataset.
 
   h.batch_tumor_ratio = (hvd.rank()+1) % 2 # odd workers have tumor, others dont
+  # Folder of the persistent tissue / tumor contour index, build it once with `python surf_index.py` (None = no index)
+  h.contour_index_dir = None
+  # Processes per worker that prefetch training batches in a shared memory ring buffer (0 = sample synchronously)
+  h.prefetch_workers = 0
+  # Number of batches in the prefetch ring buffer
+  h.prefetch_depth = 4
+  # Sample training batches with one long-lived tf.data pipeline (SurfSampler.as_dataset), instead of the keras Sequence
+  h.tf_dataset = False
+  # Number of WSI's sampled in parallel with tf_dataset
+  h.interleave_slides = 4
+  # Seed of the division of the slides over the workers, which is rebalanced every epoch
+  h.shard_seed = 0
+  # Rules 'REGEX=>TEMPLATE' that map a label file name to its slide file name (see surf_pairing.py)
+  h.pairing_rules = []
+  # JSONL dataset manifest of slide / label pairs and slide metadata (see surf_manifest.py), loaded instead of globbing if it exists, written otherwise
+  h.manifest = None
+  # Minimum string similarity of the fuzzy pairing of leftover labels
+  h.fuzzy_cutoff = 0.6
+  # Train on a patch cache of surf_patches.py instead of reading the slides, not used if None
+  h.patch_cache_dir = None
+  # Size in MB of the per process LRU cache of decoded slide tiles (see surf_tiles.py), 0 = read patches with pyvips directly
+  h.tile_cache_mb = 1024
+  # Draw and write the sampling overlays of the WSI's to log_dir
+  h.overlays = True
+  # Write the sampling overlay of a WSI at most every overlay_interval seconds (in a background thread)
+  h.overlay_interval = 60
+  # Tissue detection: 'hsv' threshold of the overview, or 'otsu' on the saturation of an automatically chosen thumbnail level (see surf_tissue.py)
+  h.tissue_method = 'hsv'
+  # Draw train batches with exact tumor / boundary / normal ratios over all train WSI's (see surf_strata.py)
+  h.stratified = False
+  # The ratio of the batch from tumor boundary positions with stratified
+  h.boundary_ratio = 0.0
+  # Sample patches at the magnification of this pyramid level, read from that level (see SurfSampler.read_patch)
+  h.target_level = 0
+  # Sample patches at this resolution in micron per pixel, read from the nearest pyramid level (overrides target_level)
+  h.target_mpp = None
+  # Pyramid levels of image_size context patches centred on every patch, read from that level (e.g. [2] for a 4x wider view)
+  h.context_levels = []
+  # Minimum tissue fraction on the overview of the footprint of a sampled patch, background positions are never fetched (see surf_coords.foreground_mask)
+  h.min_tissue_fraction = 0.5
+  # Minimum mean channel stddev on the overview of the footprint of a sampled patch (the overview is smoothed, keep it below the level 0 threshold of 15)
+  h.min_overview_std = 4.0
+  # Seed of the sampling RNG of every worker (combined with the rank and the sampler mode)
+  h.sampler_seed = 0
+  # Resume the sampling position saved in log_dir (see SurfSampler.save_state), only by deeplab/train.py with its checkpoint
+  h.resume_sampler = False
+  # H&E stain augmentation (HED perturbation, flips and 90 degree rotations) of the uint8 train batches in the input pipeline (see surf_augment.py)
+  h.stain_augment = False
+  # Scale of the stains with stain_augment, every stain is scaled by U(1 - sigma, 1 + sigma)
+  h.stain_sigma = 0.05
+  # Shift of the stains in optical density with stain_augment, U(-bias, bias)
+  h.stain_bias = 0.05
   # If only running evaluation
   h.evaluate = False
+  # Evaluate whole slides on a regular grid of tiles with stitched probability maps (see surf_inference.py)
+  h.tiled_inference = False
+  # Overlap in patch pixels (at the target magnification) between the tiles of tiled_inference
+  h.tile_overlap = 128
+  # Batch size of the tiles of tiled_inference
+  h.tile_batch_size = 8
+  # Level (downsampling 2**level of level 0) of the stitched probability map of tiled_inference
+  h.prob_map_level = 5
   # In this directory all the logging will be saved (checkpoints,summaries,images)
   h.log_dir = '/home/rubenh/EffDet/efficientdet/keras/delete'
   # Verbosity of data Sampler
@@ -338,6 +398,12 @@ def default_detection_configs():
   h.dataset_type = None
   h.positives_momentum = None
 
+  # Gradient checkpointing of the keras model (keras/efficientdet_keras.py),
+  # the activations of the MBConv blocks ('backbone') and / or the FPN cells
+  # ('fpn') are recomputed in the backward pass: 'none', 'backbone', 'fpn', 'all'.
+  # See device.grad_ckpting for the estimator model.
+  h.grad_checkpoint = 'none'
+
   h.device = {
       # If true, apply gradient checkpointing to reduce memory usage.
       'grad_ckpting': False,
@@ -653,8 +653,14 @@ class FPNCells(tf.keras.layers.Layer):
     ]
 
   def call(self, feats, training):
+    grad_checkpoint = self.config.grad_checkpoint in ('fpn', 'all') and training
     for cell in self.cells:
-      cell_feats = cell(feats, training)
+      if grad_checkpoint and cell.built:
+        # Recompute the activations of the cell in the backward pass.
+        cell_feats = tf.recompute_grad(
+            lambda *x, cell=cell: cell(list(x), training))(*feats)
+      else:
+        cell_feats = cell(feats, training)
       min_level = self.config.min_level
       max_level = self.config.max_level
 
@@ -734,6 +740,7 @@ class EfficientDetNet(tf.keras.Model):
             efficientnet_builder.BlockDecoder().encode(
                 config.backbone_config.blocks))
       override_params['data_format'] = config.data_format
+      override_params['grad_checkpoint'] = config.grad_checkpoint in ('backbone', 'all')
       self.backbone = backbone_factory.get_model(
           backbone_name, override_params=override_params)
 
@@ -96,6 +96,33 @@ class EfficientDetKerasTest(tf.test.TestCase):
     self.assertAllClose(
         eager_seg_out, keras_seg_out, rtol=1e-4, atol=1e-4)
 
+  def test_grad_checkpoint(self):
+    inputs_shape = [1, 256, 256, 3]
+    config = hparams_config.get_efficientdet_config('efficientdet-d0')
+    config.heads = ['segmentation']
+    tmp_ckpt = os.path.join(tempfile.mkdtemp(), 'ckpt3')
+
+    feats = tf.ones(inputs_shape)
+    model = efficientdet_keras.EfficientDetNet(config=config)
+    model(feats, True)
+    model.save_weights(tmp_ckpt)
+    with tf.GradientTape() as tape:
+      tape.watch(feats)
+      seg_out = model(feats, True)[-1]
+    seg_grads = tape.gradient(seg_out, feats)
+
+    config.grad_checkpoint = 'all'
+    ckpt_model = efficientdet_keras.EfficientDetNet(config=config)
+    ckpt_model(feats, True)
+    ckpt_model.load_weights(tmp_ckpt)
+    with tf.GradientTape() as tape:
+      tape.watch(feats)
+      ckpt_seg_out = ckpt_model(feats, True)[-1]
+    ckpt_seg_grads = tape.gradient(ckpt_seg_out, feats)
+
+    self.assertAllClose(seg_out, ckpt_seg_out, rtol=1e-4, atol=1e-4)
+    self.assertAllClose(seg_grads, ckpt_seg_grads, rtol=1e-4, atol=1e-4)
+
   def test_build_feature_network(self):
     config = hparams_config.get_efficientdet_config('efficientdet-d0')
     config.max_level = 5
@@ -34,7 +34,13 @@ import os
 import pdb
 from PIL import Image
 from scipy import ndimage
-from surf_sampler import SurfSampler, PreProcess
+from surf_sampler import SurfSampler, PreProcess, normalize_batch, batch_dataset
+from surf_augment import train_augmentation
+from surf_prefetch import PrefetchSampler
+from surf_patches import PatchCacheSampler
+from surf_inference import TiledInference
+from surf_staging import StagingMap, slide_resolution
+from surf_metrics import EvaluationAccumulator
 import tensorflow_addons as tfa
 from tensorflow.python.framework.convert_to_constants import (convert_variables_to_constants_v2_as_graph,)
 import time
@@ -87,7 +93,7 @@ def get_flops(model,config):
 
     return flops.total_float_ops
 
-def get_metastase(wsi_name,data,test_sampler,config):
+def get_metastase(wsi_name,staging_map,test_sampler,config):
     """
     
     
@@ -95,13 +101,14 @@ def get_metastase(wsi_name,data,test_sampler,config):
     ----------
     wsi_name : string ("patient_1_node_001")
         name of whole slide image.
-    data : numpy.array
-        data with mask predictions.
+    staging_map : surf_staging.StagingMap
+        low resolution map with the tumor predictions of the WSI.
     config : config.object
         configuration file ("config.object")
 
-    Computes the pN staging of lymph node of patients
-    Negative:           smaller than 0.2 mm = 200 microm
+    Computes the pN staging of lymph node of patients, from the largest
+    connected tumor component of the staging map
+    ITC:                smaller than 0.2 mm = 200 microm
     Micro-metastases:   200microm < ... < 2000 microm
     Macro-metastases:   > 2000 microm ( > 2 mm)
     
@@ -118,71 +125,19 @@ def get_metastase(wsi_name,data,test_sampler,config):
     """
 
     csv = []
+    # The csv names the slide file, independent of the slide folders of the config (None in test mode)
+    slide_name = f'{wsi_name}.{config.slide_format}'
     try:
-        # Load openslide
-        if test_sampler.mode == 'validation':
-            path = config.valid_slide_path
-        elif test_sampler.mode == 'test':
-            path = config.test_path
-            
-        slide_path = os.path.join(path,wsi_name+f'.{config.slide_format}')
-        slide = OpenSlide(slide_path)
-        # mask = OpenSlide(mask_path)
-        
-        # Get dimensions of level 0
-        level_dimensions = (slide.level_dimensions[0][1],slide.level_dimensions[0][0])
-        
-        # Get resolution in microns per pixel (1 micrometer = 10e-6 meter = 0.001 mm)
-        try:
-            # CAM16
-            resolution = (float(slide.properties['openslide.mpp-x']) + float(slide.properties['openslide.mpp-y'])) / 2
-        except:
-            # CAM 17 
-            resolution = ( float(slide.properties['tiff.YResolution']) / float(slide.properties['openslide.level[0].height']) +
-                           float(slide.properties['tiff.XResolution'])  / float(slide.properties['openslide.level[0].width']) ) / 2
-        
-        # Get resolution for micro metastases in micron per pixel
-        res_for_micro = 200*resolution
-        # Make mask numpy
-        pred = np.zeros(level_dimensions,dtype=np.uint8)[...,None]
-
-        # Fill mask with predictions
-        print(f" Worker {hvd.rank()}: Starting filling mask of {slide_path}...")
-        for idx, patch in enumerate(data):
-            row = patch[0]
-            column = patch[1]
-            try:
-                # Fill in based on coordinates
-                pred[row:row+config.image_size,column:column+config.image_size] = patch[-1][0] # (1,config.image_size,config.image_size,1) -> (config.image_size,config.image_size,1))
-                if idx % 100 == 0: print(f" Worker {hvd.rank()}:Processed patch {idx + 1} / {len(data)}...")
-            except:
-                print(f" Worker {hvd.rank()}:Skipping row {row} column {column} of patch {idx} (mask {pred.shape})")
-                continue
-    
-        # Get minimum dimension so that resolution of 1 pixel is enough for micro metastases    
-        micro_res_dimensions = (int(level_dimensions[1] // res_for_micro), int(level_dimensions[0] // res_for_micro))
-        
-        # Downsample predicted mask to this minimum dimension (if one positive pixel in this image, it is micrometastase)
-        pred_down = cv2.resize(pred[0],dsize=(micro_res_dimensions))
-        
-        # Convolute downsampled image, so that if more then 10 grouped positive pixels, in sliding window sum(255*10 pixels) will be macro metastase
-        _filter = np.ones((10,10))
-        filtered = ndimage.convolve(pred_down, _filter, mode='constant', cval=0.0)
-        
-        if filtered.max() >= 2550:
-            csv.append((slide_path.split('/')[-1],'macro'))
-        elif pred_down.max():
-            csv.append((slide_path.split('/')[-1],'micro'))   
-        elif pred.max():
-            csv.append((slide_path.split('/')[-1],'itc'))   
-        else:
-            csv.append((slide_path.split('/')[-1],'negative'))
+        stage, diameter = staging_map.stage()
+        print(f" Worker {hvd.rank()}: {wsi_name} is {stage} (largest diameter {diameter:.0f} microm, "
+              f"map {staging_map.map.shape} at {staging_map.pixel_um:.1f} microm per pixel)")
+        csv.append((slide_name,stage))
     except Exception as e:
-        print(f' E: {e} slide {slide_path}')
+        print(f' E: {e} slide {slide_name}')
         pass
          
     
-    print(f" Worker {hvd.rank()}: Saving csv of {slide_path}...")
+    print(f" Worker {hvd.rank()}: Saving csv of {slide_name}...")
     csv = sorted(csv)
 
     with open(os.path.join(config.log_dir,f'{wsi_name}.csv'),'w') as out:
@@ -194,6 +149,17 @@ def get_metastase(wsi_name,data,test_sampler,config):
     return True
 
 
+def new_staging_map(slide_path, metadata=None):
+    """ Empty StagingMap with the dimensions and resolution of a WSI, from its manifest entry if known """
+    entry = (metadata or {}).get(slide_path)
+    if entry is not None and entry.get('mpp'):
+        return StagingMap(tuple(entry['level_dimensions'][0]), entry['mpp'])
+    slide = OpenSlide(slide_path)
+    staging_map = StagingMap(slide.dimensions, slide_resolution(slide))
+    slide.close()
+    return staging_map
+
+
 
 def evaluate(model,config,test_sampler):
     """
@@ -211,7 +177,9 @@ def evaluate(model,config,test_sampler):
     - Every WSI, it will save an overlay, in which the tumor and non tumor is
     annotated.
     - In the case of validation data with labels, it will also compute the 
-    mIoU of the Whole Slide Images.
+    IoU, Dice and AUC (from a running confusion matrix / histogram, see
+    surf_metrics.py) of every Whole Slide Image, and of all WSI's of all
+    workers, plus the FROC of the lesion detection.
     - Lastly, it will save a csv per whole slide image with the metastases of
     the tumor cells, using the function method `get_metastase`.
     
@@ -222,53 +190,71 @@ def evaluate(model,config,test_sampler):
     """
     done=0
     wsi_idx=0
-    _array=[]
+    metrics = EvaluationAccumulator(config.seg_num_classes)
+    staging_map = None
     save_mask = np.zeros((config.image_size,config.image_size,3))
     patch_idx = 0
     
     while not done:
         # Get test batch (in orderly fashion; past WSI's / ROI's / FOV coordinates are dropped)
         patches, masks = test_sampler.__getitem__(wsi_idx)
-        # Get patch, mask from test_sampler
-        for (patch,mask) in zip(patches,masks):
+        patches, masks = (tensor.numpy() for tensor in normalize_batch(patches, masks))
+        # Predict the batch, and update the confusion matrix / histograms in graph
+        probs = tf.nn.softmax(tf.cast(model(patches,training=False)[0],tf.float32),axis=-1)
+        if probs.shape[1:3] != patches.shape[1:3]:
+            probs = tf.image.resize(probs,patches.shape[1:3])
+        if test_sampler.mode == 'validation':
+            metrics.update(masks,probs)
+        tumor = (1.0 - probs[...,0]).numpy()
+        batch_predictions = tf.cast(255 * tf.argmax(probs,axis=-1)[...,None], tf.uint8).numpy()
+
+        # Accumulate predictions (and ground truth) for the PN - Staging and FROC, every patch at its own coordinates
+        # and over its level 0 footprint (at --target_mpp / --target_level a patch covers more than image_size)
+        slide_path = test_sampler.save_data[0]['file_name']
+        footprint = test_sampler.footprint(slide_path)
+        if staging_map is None:
+            staging_map = new_staging_map(slide_path, test_sampler.metadata)
+            truth_map = new_staging_map(slide_path, test_sampler.metadata)
+        staging_map.add_batch(test_sampler.save_data, tumor, footprint)
+        if test_sampler.mode == 'validation':
+            # Masks are one-hot, the tumor class is 1
+            truth_map.add_batch(test_sampler.save_data, masks[...,1], footprint)
+
+        # Get patch, mask from test_sampler, save_data has an entry per patch of the batch
+        for i, (patch,mask,prob,predictions) in enumerate(zip(patches,masks,tumor,batch_predictions)):
+            entry = test_sampler.save_data[i]
+            patch_idx += 1
             patch = patch[None,...]
             mask = mask[None,...]
-
-            # Predict patch
-            pred = model(patch,training=True)[0]
-            pred = tf.expand_dims(tf.argmax(pred,axis=-1), axis=-1)
-            predictions = tf.cast(pred * 255, tf.uint8).numpy()
-            
+            predictions = predictions[None,...]
             
             # Make mask
             if test_sampler.mode == 'validation':
                 # Mask is one-hot from data sampler
                 mask = tf.expand_dims(tf.argmax(mask,axis=-1), axis=-1)
                 mask = tf.cast(255 * mask, tf.uint8).numpy()
-                Image.fromarray(mask[0,...,0]).save(f"testmask_{patch_idx}.png")
-                ps =  patch + 1
-                ps = ps * 127.5
-                ps = ps[0].astype('uint8')
-                Image.fromarray(ps).save(f"testpatch_{patch_idx}.png")
-                Image.fromarray(predictions[0,...,0]).save(f"testpred_{patch_idx}.png")
+                if config.verbose == 'debug':
+                    Image.fromarray(mask[0,...,0]).save(f"testmask_{patch_idx}.png")
+                    ps =  patch + 1
+                    ps = ps * 127.5
+                    ps = ps[0].astype('uint8')
+                    Image.fromarray(ps).save(f"testpatch_{patch_idx}.png")
+                    Image.fromarray(predictions[0,...,0]).save(f"testpred_{patch_idx}.png")
                 
             # row    ,  columnn
-            y_topleft,x_topleft = test_sampler.save_data[patch_idx]['coords']#[0]
-            
-            # Append predicted data to save array
-            _array.append([y_topleft,x_topleft,mask.astype('uint8'),predictions.astype('uint8')])
+            y_topleft,x_topleft = entry['coords']
             
             # Make predictions fit on downsampled rgb-image
             x,y = x_topleft // 2**config.bb_downsample, y_topleft // 2**config.bb_downsample
-            dsize = config.image_size // 2**config.bb_downsample
+            dsize = max(1, footprint // 2**config.bb_downsample)
             mask_down = cv2.resize(predictions[0,...],dsize=(dsize,dsize))[...,None]
             
             # Resize a mask to sizes of downsampled rgb_image
             try:
-                save_mask = cv2.resize(save_mask,(test_sampler.save_data[patch_idx]['image'].shape[1],test_sampler.save_data[patch_idx]['image'].shape[0]))
+                save_mask = cv2.resize(save_mask,(entry['image'].shape[1],entry['image'].shape[0]))
             except:
                 print("error")
-                save_mask = cv2.resize(save_mask,(test_sampler.save_data[patch_idx]['image'].take(0).size[0],test_sampler.save_data[patch_idx]['image'].take(0).size[1]))
+                save_mask = cv2.resize(save_mask,(entry['image'].take(0).size[0],entry['image'].take(0).size[1]))
             
             try:
                 # Fill downsampled image with downsampled predictions
@@ -278,16 +264,15 @@ def evaluate(model,config,test_sampler):
                 continue
             
         # If a WSI is completed save: 
-        # 1. *.npy files with [x_topleft,y_topleft,mask,predictions]
-        # 2. Test masks (downsampled)
-        # 3. Test image (downsampled, with tumor overlay)   
+        # 1. csv with the PN - Staging
+        # 2. Test image (downsampled, with tumor overlay)
+        # 3. Scores of the slide (validation)
         if wsi_idx != test_sampler.wsi_idx:
-            data = np.array(_array)
             # wsi_name = test_sampler.save_data[patch_idx-1]['file_name'].split('/')[-1][:-4]
             wsi_name = test_sampler.save_data[0]['file_name'].split('/')[-1][:-4]
 
             ### Get PN - Staging
-            get_metastase(wsi_name,data,test_sampler,config)
+            get_metastase(wsi_name,staging_map,test_sampler,config)
             
             # Mark tumor in black, else green
             save_mask = np.where(save_mask,[0,0,0],[0,255,0]).astype('uint8')
@@ -296,30 +281,15 @@ def evaluate(model,config,test_sampler):
             cv2.imwrite(os.path.join(config.log_dir,wsi_name+'_mask.png'),save_mask)
             
             if test_sampler.mode == 'validation':
-                print(f" Worker {hvd.rank()}: Computing mIoU...")
-                mask = np.empty((1,config.image_size,config.image_size,1))
-                pred  = np.empty((1,config.image_size,config.image_size,1))
-                mIoU = tf.keras.metrics.MeanIoU(num_classes=config.seg_num_classes)
-                for x in tqdm(_array): 
-                    mask  = x[2]
-                    pred  = x[3]
-                    _sum = np.sum(pred)
-                    if np.isnan(_sum):
-                        print(f" Worker {hvd.rank()}: Skipping patch due to NaN in prediction")
-                        pass
-                    mask = np.where(mask,1,0)
-                    pred = np.where(pred,1,0)
-                    # Update confusion matrix of mIoU see https://www.tensorflow.org/api_docs/python/tf/keras/metrics/MeanIoU#update_state
-                    print(f"Pred NonZero: {np.count_nonzero(pred) / (2048**2)}")
-                    print(f"Msk NonZero: {np.count_nonzero(mask) / (2048**2)}")
-                    mIoU.update_state(mask,pred)
-
-                print(f" Worker {hvd.rank()}: mIoU of {wsi_name} is {mIoU.result().numpy()}")
+                scores = metrics.end_slide(staging_map.map,truth_map.map >= truth_map.threshold)
+                print(f" Worker {hvd.rank()}: {wsi_name}: mIoU {scores['mIoU']:.4f}, Dice {scores['mDice']:.4f}, "
+                      f"AUC {scores['AUC']:.4f}, detected {scores['detected']} / {scores['lesions']} lesions")
                 print(f" Worker {hvd.rank()}: Evaluated {test_sampler.wsi_idx} / {len(test_sampler.valid_paths)} test WSI's.")
             else:
                 print(f" Worker {hvd.rank()}: Evaluated {test_sampler.wsi_idx} / {len(test_sampler.test_paths)} test WSI's.")
                
            
+            staging_map = None
             wsi_idx = test_sampler.wsi_idx
             test_sampler.save_data = []
             patch_idx = 0
@@ -333,22 +303,64 @@ def evaluate(model,config,test_sampler):
                     done += 1
                     wsi_idx = 0
         
-    try:
-        mIoU.reset_states()
-    except:
-        pass
+    if test_sampler.mode == 'validation':
+        # All workers have to take part in the allreduce
+        scores = metrics.result()
+        if hvd.rank() == 0:
+            print(f" Validation: mIoU {scores['mIoU']:.4f} (IoU {scores['IoU']}), Dice {scores['mDice']:.4f}, "
+                  f"AUC {scores['AUC']:.4f}, FROC {scores['FROC']:.4f} {scores['sensitivity']}")
     return 
     
 
 
 
 
+def evaluate_tiled(model,config,test_sampler):
+    """
+    
+    Parameters
+    ----------
+    model       : tensorflow.keras.Model checkpoint, trained model used for
+    evaluation.
+    config      : config.object configuration file ("config.object").
+    
+    test_sampler: SurfSampler of which the WSI's are evaluated
+
+    - Deterministic alternative of `evaluate`: every WSI is predicted on a
+    regular grid of tiles over all tissue, in eval mode, see surf_inference.py
+    - Every WSI, it will save the stitched probability map (.npy) and an
+    overlay (.png), and a csv with the metastases using `get_metastase`.
+    
+    Returns
+    -------
+        -.
+
+    """
+    inference = TiledInference(model, config)
+    for slide_path, prob_map, overview in inference.run(test_sampler):
+        wsi_name = inference.save(slide_path, prob_map, overview)
+        staging_map = new_staging_map(slide_path, test_sampler.metadata)
+        staging_map.add_map(prob_map, inference.map_downsample)
+        get_metastase(wsi_name,staging_map,test_sampler,config)
+    return
+
+
+
 def main(config):
 
     assert isinstance(config.image_size,int),"WARNING: Please make sure that the config.image_size is an integer"
-    train_sampler = SurfSampler(config,mode='train')
+    # The samplers can read context patches, but EfficientDetNet has a single image input
+    assert not config.context_levels, "WARNING: context_levels needs a model with a context input, EfficientDetNet has none"
+    if config.patch_cache_dir:
+        # Cached patches are a memory mapped read, there is nothing to prefetch
+        config.prefetch_workers = 0
+        train_sampler = PatchCacheSampler(config)
+    else:
+        train_sampler = SurfSampler(config,mode='train')
+    if config.prefetch_workers:
+        train_sampler = PrefetchSampler(train_sampler, config)
     valid_sampler = SurfSampler(config,mode='validation')
-    valid_data    = valid_sampler.__getitem__(0)    
+    valid_data    = normalize_batch(*valid_sampler.__getitem__(0))
     test_sampler  = SurfSampler(config,mode='test')
     
     
@@ -440,9 +452,12 @@ def main(config):
         # if hvd.rank() == 0:
         cb_options = train_lib.get_callbacks(config, train_sampler, valid_sampler, profile=False)
         callbacks.extend(cb_options)
+        if config.prefetch_workers and hvd.rank() == 0:
+            callbacks.append(tf.keras.callbacks.LambdaCallback(
+                on_epoch_end=lambda epoch, logs: print(f"Prefetch queue: {train_sampler.stats()}")))
         # with tf.device("/CPU:0"):
         model.fit(
-            train_sampler,
+            train_sampler.as_dataset() if config.tf_dataset else batch_dataset(train_sampler, augment=train_augmentation(config)),
             epochs=config.num_epochs,
             steps_per_epoch=config.steps_per_epoch,
             validation_data=valid_data,
@@ -452,10 +467,15 @@ def main(config):
             verbose=verbose)
             
         print(f"Finished training\n")
+        if config.prefetch_workers:
+            train_sampler.close()
             
         print("Starting Evaluation...")
         
-    evaluate(model,config,valid_sampler)
+    if config.tiled_inference:
+        evaluate_tiled(model,config,valid_sampler)
+    else:
+        evaluate(model,config,valid_sampler)
     # if hvd.rank() == 0:
     #     print(f'Finished evaluation with exceptions:\n {test_sampler.exceptions}')
         
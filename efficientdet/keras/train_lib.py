@@ -265,13 +265,19 @@ class DisplayCallback(tf.keras.callbacks.Callback):
 
   def __init__(self, train_sampler, valid_sampler, output_dir, update_freq=1):
     super().__init__()
+    # The samplers return uint8 batches in reused buffers, normalized in the graph
+    from surf_sampler import normalize_batch
+    self.normalize_batch = normalize_batch
     # image_file = tf.io.read_file(sample_image)
     # self.sample_image = tf.expand_dims(
     #     tf.image.decode_jpeg(image_file, channels=3), axis=0)
     
-    self.valid_data =  valid_sampler.__getitem__(0)
+    self.valid_data =  self.normalize_batch(*valid_sampler.__getitem__(0))
     self.valid_images = self.valid_data[0]
     self.valid_masks  = self.valid_data[1]
+    # A train batch of its own, taken before fit: during fit the train sampler is
+    # used by the generator of its dataset (see batch_dataset), and its buffers are reused
+    self.display_train_data = self.normalize_batch(*train_sampler.__getitem__(0))
     
     self.train_sampler = train_sampler
     self.valid_sampler = valid_sampler
@@ -298,7 +304,7 @@ class DisplayCallback(tf.keras.callbacks.Callback):
   def on_epoch_end(self, epoch, logs=None):
     self.save_worker = 0 # random.choice(range(hvd.size()))
     if epoch % self.update_freq == 0:
-        self.train_data = self.train_sampler.__getitem__(epoch)
+        self.train_data = self.display_train_data
         self.train_images = self.train_data[0]
         self.train_masks  = self.train_data[1]
         self.valid_images = self.valid_data[0]
@@ -373,17 +373,27 @@ def batch_norm_act(inputs,
   return inputs
 
 
-def drop_connect(inputs, is_training, survival_prob):
-  """Drop the entire conv with given survival probability."""
+def drop_connect_mask(inputs, survival_prob):
+  """Binary [batch, 1, 1, 1] mask of the samples of `inputs` that survive."""
+  batch_size = tf.shape(inputs)[0]
+  random_tensor = survival_prob
+  random_tensor += tf.random.uniform([batch_size, 1, 1, 1], dtype=inputs.dtype)
+  return tf.floor(random_tensor)
+
+
+def drop_connect(inputs, is_training, survival_prob, binary_tensor=None):
+  """Drop the entire conv with given survival probability.
+
+  A given `binary_tensor` (see drop_connect_mask) is used instead of a new
+  random mask, e.g. to drop the same samples when a block is recomputed.
+  """
   # "Deep Networks with Stochastic Depth", https://arxiv.org/pdf/1603.09382.pdf
   if not is_training:
     return inputs
 
   # Compute tensor.
-  batch_size = tf.shape(inputs)[0]
-  random_tensor = survival_prob
-  random_tensor += tf.random.uniform([batch_size, 1, 1, 1], dtype=inputs.dtype)
-  binary_tensor = tf.floor(random_tensor)
+  if binary_tensor is None:
+    binary_tensor = drop_connect_mask(inputs, survival_prob)
   # Unlike conventional way that multiply survival_prob at test time, here we
   # divide survival_prob at training time, such that no addition compute is
   # needed at test time.
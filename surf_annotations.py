@@ -0,0 +1,120 @@
+import numpy as np
+import cv2
+import xml.etree.ElementTree as ET
+
+
+def parse_asap_xml(label):
+    """
+        make the list of polygons from xml(annotation file)
+        input (CAMELYON16/17):
+
+    <?xml version="1.0"?>
+    <ASAP_Annotations>
+    	<Annotations>
+    		<Annotation Name="Annotation 0" Type="Polygon" PartOfGroup="metastases" Color="#F4FA58">
+    			<Coordinates>
+    				<Coordinate Order="0" X="12711.2998" Y="88778.1016" />
+                    .
+                    .
+                    .
+    			</Coordinates>
+    		</Annotation>
+    	</Annotations>
+    </ASAP_Annotations>
+
+        return list of (N,2) float32 arrays with level 0 ([x,y]) coordinates
+    """
+    polygons = []
+    tree = ET.parse(label)
+
+    for ASAP_Annotations in tree.iter():
+        for i_1, Annotations in enumerate(ASAP_Annotations):
+            for i_2, Annotation in enumerate(Annotations):
+                for i_3, Coordinates in enumerate(Annotation):
+                    li_point = []
+                    for i_4, Coordinate in enumerate(Coordinates):
+                        x_0 = float(Coordinate.attrib['X'])
+                        y_0 = float(Coordinate.attrib['Y'])
+                        li_point.append((x_0, y_0))
+                    if len(li_point):
+                        polygons.append(np.array(li_point, dtype=np.float32))
+
+    return polygons
+
+
+class PolygonMask():
+    """
+    - Lazy, polygon backed tumor mask of a whole slide image. Instead of
+    allocating the full level 0 mask (~10 GB for a 100k x 100k slide), only the
+    requested window is rasterized, from the polygons that intersect it.
+
+    - It can be used in place of both the pyvips mask image and its region in
+    `SurfSampler.trainer` / `SurfSampler.tester`:
+        > mask.get('bands')                 -> 1
+        > mask.fetch(x, y, width, height)   -> (height, width) uint8 buffer, 255 = tumor
+
+    - `overview` produces the low resolution mask (at `bb_downsample`) directly
+    from the scaled polygons.
+
+    >>>>Example:
+
+    mask = PolygonMask.from_xml('patient_004_node_4.xml', wsi.dimensions)
+    patch_mask = np.ndarray((1024, 1024, mask.get('bands')), buffer=mask.fetch(x, y, 1024, 1024), dtype=np.uint8)
+
+    """
+    def __init__(self, polygons, dimensions):
+        self.polygons = polygons
+        # (width, height) of level 0
+        self.dimensions = tuple(dimensions)
+        # Bounding boxes (x_min, y_min, x_max, y_max) for culling polygons outside a window
+        if len(polygons):
+            self.bboxes = np.array([np.concatenate([p.min(axis=0), p.max(axis=0)]) for p in polygons], dtype=np.float32)
+        else:
+            self.bboxes = np.zeros((0, 4), dtype=np.float32)
+
+    @classmethod
+    def from_xml(cls, label, dimensions):
+        return cls(parse_asap_xml(label), dimensions)
+
+    def get(self, name):
+        """ Mimics pyvips.Image.get for the properties the sampler uses """
+        if name == 'bands':
+            return 1
+        if name == 'width':
+            return self.dimensions[0]
+        if name == 'height':
+            return self.dimensions[1]
+        raise KeyError(f'PolygonMask has no property {name}')
+
+    def window(self, x, y, width, height, downsample=1):
+        """
+        Rasterize the level 0 window at (x, y) of size (width, height), at
+        `downsample` (so the result is (round(height / downsample), round(width / downsample)))
+        """
+        out = np.zeros((int(round(height / downsample)), int(round(width / downsample))), dtype=np.uint8)
+        if not len(self.polygons):
+            return out
+
+        inside = np.where((self.bboxes[:, 0] < x + width) & (self.bboxes[:, 2] >= x) &
+                          (self.bboxes[:, 1] < y + height) & (self.bboxes[:, 3] >= y))[0]
+        for i in inside:
+            # Draw every polygon on its own, as the xml polygons may overlap
+            pts = np.round((self.polygons[i] - (x, y)) / downsample).astype(np.int32)
+            cv2.fillPoly(out, pts=[pts], color=(255))
+        return out
+
+    def fetch(self, x, y, width, height):
+        """ Mimics pyvips.Region.fetch, returns a buffer of (height, width, 1) uint8 """
+        return self.window(int(x), int(y), int(width), int(height))
+
+    def overview(self, size):
+        """ The complete mask at (width, height) `size`, as (height, width, 1) uint8 """
+        out = np.zeros((size[1], size[0]), dtype=np.uint8)
+        scale = (size[0] / self.dimensions[0], size[1] / self.dimensions[1])
+        for polygon in self.polygons:
+            cv2.fillPoly(out, pts=[np.round(polygon * scale).astype(np.int32)], color=(255))
+        return out[..., None]
+
+    def close(self):
+        """ Mimics OpenSlide.close, there are no handles to release """
+        return
@@ -0,0 +1,94 @@
+"""
+- H&E stain augmentation of uint8 batches in the graph, for the tf.data
+pipelines of the samplers (`batch_dataset`, `SurfSampler.as_dataset`,
+`PatchCacheSampler.as_dataset` and `PreProcess.tfdataset`), before `normalize_batch`:
+
+    HED     : the optical density of every pixel is projected on the stain
+              vectors of hematoxylin, eosin and DAB (Ruifrok & Johnston), every
+              stain is scaled by U(1 - sigma, 1 + sigma) and shifted by
+              U(-bias, bias) per sample, and projected back to RGB
+    flips   : per sample transpose, vertical and horizontal flip, which make
+              all 8 flips / 90 degree rotations (the masks and context
+              patches get the same)
+
+- The stain projection, perturbation and back projection are linear in the
+optical density, so they are one 3 x 3 matrix and an offset per sample: a
+log, a batched matmul and an exp per pixel. Every op runs on every
+sample (the random choices are selects), so the cost per image is fixed, and
+the op runs on the device the pipeline map runs on.
+
+>>>>Example:
+
+augment = stain_augmentation(sigma=0.05, bias=0.05)
+patches, masks = augment(patches, masks)  # uint8 (batch, size, size, 3), (batch, size, size, 1)
+"""
+import numpy as np
+import tensorflow as tf
+
+
+# Stain vectors of hematoxylin, eosin and DAB in RGB optical density (rows), and its inverse
+RGB_FROM_HED = np.array([[0.65, 0.70, 0.29],
+                         [0.07, 0.99, 0.11],
+                         [0.27, 0.57, 0.78]])
+HED_FROM_RGB = np.linalg.inv(RGB_FROM_HED)
+
+
+def stain_transform(image, matrix, offset):
+    """
+    uint8 (batch, ..., 3) `image` with its optical density transformed by the
+    per sample (batch, 3, 3) `matrix` and (batch, 3) `offset`
+    """
+    shape = tf.shape(image)
+    od = -tf.math.log(tf.maximum(tf.cast(image, tf.float32), 1.0) / 255.0)
+    od = tf.matmul(tf.reshape(od, [shape[0], -1, 3]), matrix) + offset[:, None, :]
+    rgb = tf.clip_by_value(tf.round(255.0 * tf.exp(-od)), 0.0, 255.0)
+    return tf.reshape(tf.cast(rgb, tf.uint8), shape)
+
+
+def dihedral_transform(image, transpose, flip_rows, flip_columns):
+    """
+    (batch, ..., height, width, channels) `image` transposed and flipped per
+    sample, by (batch,) booleans. Patches have to be square for the transpose
+    """
+    rank = len(image.shape)
+    condition = lambda choice: tf.reshape(choice, [-1] + [1] * (rank - 1))
+    image = tf.where(condition(transpose), tf.transpose(image, list(range(rank - 3)) + [rank - 2, rank - 3, rank - 1]), image)
+    image = tf.where(condition(flip_rows), tf.reverse(image, [rank - 3]), image)
+    image = tf.where(condition(flip_columns), tf.reverse(image, [rank - 2]), image)
+    return image
+
+
+def stain_augmentation(sigma=0.05, bias=0.05, geometric=True):
+    """
+    - Augmentation `augment(patches, masks)` of a uint8 batch, see the module
+    docstring. `patches` can be a (patches, contexts) pair (see
+    SurfSampler.read_contexts), the contexts get the stain and flips of their patch.
+
+    - `sigma` and `bias` are in optical density (a pixel of 255 / e is 1):
+    0.05 is a light, 0.2 a strong stain augmentation. `geometric` adds the flips / rotations.
+    """
+    hed_from_rgb = tf.constant(HED_FROM_RGB, tf.float32)
+    rgb_from_hed = tf.constant(RGB_FROM_HED, tf.float32)
+
+    def augment(patches, masks):
+        batch = tf.shape(masks)[0]
+        alpha = tf.random.uniform([batch, 3], 1.0 - sigma, 1.0 + sigma)
+        beta = tf.random.uniform([batch, 3], -bias, bias)
+        # ((od @ hed_from_rgb) * alpha + beta) @ rgb_from_hed as od @ matrix + offset
+        matrix = tf.einsum('ij,bj,jk->bik', hed_from_rgb, alpha, rgb_from_hed)
+        offset = tf.matmul(beta, rgb_from_hed)
+        patches = tf.nest.map_structure(lambda image: stain_transform(image, matrix, offset), patches)
+        if geometric:
+            choices = tf.unstack(tf.random.uniform([3, batch]) < 0.5)
+            patches = tf.nest.map_structure(lambda image: dihedral_transform(image, *choices), patches)
+            masks = dihedral_transform(masks, *choices)
+        return patches, masks
+
+    return augment
+
+
+def train_augmentation(opts):
+    """ The augmentation of the train batches of `opts` (--stain_augment, --stain_sigma, --stain_bias), or None """
+    if not opts.stain_augment:
+        return None
+    return stain_augmentation(opts.stain_sigma, opts.stain_bias)
@@ -0,0 +1,128 @@
+import numpy as np
+import cv2
+from surf_strata import window_sums
+
+
+# Minimum mean channel stddev of a level 0 patch that is not background
+MIN_PATCH_STD = 15
+
+
+def patch_stddev(patch, step=4):
+    """ Mean channel stddev of a uint8 patch, on every `step`-th pixel (the background check of the samplers) """
+    return patch[::step, ::step, :3].std(axis=(0, 1)).mean()
+
+
+def foreground_mask(overview, contours, size, min_tissue=0.5, min_std=4.0):
+    """
+    - Background rejection on the overview: bool mask of the overview pixels
+    of which the patch footprint of `size` x `size` overview pixels, with its
+    top left corner at the pixel, has a tissue fraction (of the filled tissue
+    `contours`, outside the overview is no tissue) of at least `min_tissue`
+    and a mean channel stddev of at least `min_std`.
+
+    - Both are box sums of the integral images of the tissue, the channels and
+    their squares, so scoring all positions of a slide costs a few overview
+    passes instead of a level 0 fetch and stddev per patch. The overview is
+    smoothed by the downsampling, so `min_std` is well below MIN_PATCH_STD.
+    A footprint of one overview pixel has no stddev, it is only scored on tissue.
+
+    >>>>Example:
+
+    keep = foreground_mask(overview, contours, size=footprint // mag_factor)
+    pool = CoordinatePool(contour, mag_factor, keep=keep)
+    """
+    size = max(1, int(round(size)))
+    shape = overview.shape[:2]
+    tissue = np.zeros(shape, dtype=np.uint8)
+    cv2.drawContours(tissue, [np.asarray(contour, dtype=np.int32) for contour in contours], -1, 1, -1)
+    keep = window_sums(tissue, size) >= min_tissue * size * size
+    if size > 1 and min_std > 0:
+        # Over the part of the footprint inside the overview
+        rows = np.minimum(np.arange(shape[0]) + size, shape[0]) - np.arange(shape[0])
+        columns = np.minimum(np.arange(shape[1]) + size, shape[1]) - np.arange(shape[1])
+        area = np.outer(rows, columns).astype(np.float64)
+        std = np.zeros(shape)
+        for channel in range(3):
+            values = overview[..., channel].astype(np.float64)
+            mean = window_sums(values, size) / area
+            std += np.sqrt(np.maximum(window_sums(values * values, size) / area - mean * mean, 0))
+        keep &= std / 3 >= min_std
+    return keep
+
+
+class CoordinatePool():
+    """
+    - Shuffled pool of the level 0 (row, column) top-left coordinates of a
+    contour on the overview (at `bb_downsample`).
+
+    - The contour is rasterized once, in its own bounding box instead of the
+    full overview, and the pool is drawn from with an O(1) cursor. There is no
+    per patch mask allocation, `np.isin` scan or `np.delete`.
+
+    - When the pool is exhausted it is reshuffled and the cursor restarts, so
+    drawing never fails. `remaining()` tells the sampler when to move on to the
+    next contour.
+
+    - `keep` (see foreground_mask) leaves out the background positions of the
+    contour, so they are never fetched. A contour without foreground keeps
+    all its positions.
+
+    >>>>Example:
+
+    pool = CoordinatePool(contour, mag_factor=2**7, size=100)
+    y_topleft, x_topleft = pool.next()
+
+    """
+    def __init__(self, contour, mag_factor, size=None, rng=None, keep=None):
+        self.rng = rng if rng is not None else np.random
+        x, y, w, h = cv2.boundingRect(contour)
+        msk = np.zeros((h, w), np.uint8)
+        cv2.drawContours(msk, [np.asarray(contour, dtype=np.int32)], -1, (255), -1, offset=(-x, -y))
+        if keep is not None:
+            # The contours are of the overview, so is their bounding box
+            foreground = keep[y:y + h, x:x + w]
+            if (msk & foreground).any():
+                msk &= foreground
+        # get all non zero pixels, aka all pixels in contour, and multiply by magnification factor
+        coords = (np.transpose(np.nonzero(msk)) + (y, x)) * mag_factor
+        # A degenerate contour (a line) has no inner pixels, fall back to its points
+        if not len(coords):
+            coords = np.asarray(contour).reshape(-1, 2)[:, ::-1] * mag_factor
+        self.rng.shuffle(coords)
+        # Get subset of coordinates based on argument
+        if size:
+            coords = coords[:size]
+        self.coords = np.ascontiguousarray(coords, dtype=np.int64)
+        self.cursor = 0
+
+    @classmethod
+    def from_coords(cls, coords, cursor=0, rng=None):
+        """ Pool of the (n, 2) level 0 `coords` of a saved pool, continued at `cursor` (see SurfSampler.save_state) """
+        pool = cls.__new__(cls)
+        pool.rng = rng if rng is not None else np.random
+        pool.coords = np.ascontiguousarray(coords, dtype=np.int64).reshape(-1, 2)
+        pool.cursor = int(cursor)
+        return pool
+
+    def __len__(self):
+        return len(self.coords)
+
+    def remaining(self):
+        return len(self.coords) - self.cursor
+
+    def reset(self):
+        """ Reshuffle the pool and restart the cursor """
+        self.rng.shuffle(self.coords)
+        self.cursor = 0
+
+    def next(self):
+        """ Next (row, column) coordinate """
+        if self.cursor >= len(self.coords):
+            self.reset()
+        coords = self.coords[self.cursor]
+        self.cursor += 1
+        return coords
+
+    def take(self, n):
+        """ Next `n` coordinates as (n, 2) array """
+        return np.stack([self.next() for _ in range(n)])
@@ -0,0 +1,82 @@
+"""Tests for surf_coords."""
+import unittest
+import numpy as np
+import cv2
+from surf_coords import CoordinatePool, foreground_mask, patch_stddev
+
+
+class CoordinatePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.contour = np.array([[[10, 20]], [[29, 20]], [[29, 34]], [[10, 34]]], dtype=np.int32)
+        # All pixels of the filled contour, as (row, column)
+        mask = np.zeros((64, 64), np.uint8)
+        cv2.drawContours(mask, [self.contour], -1, 1, -1)
+        self.pixels = {tuple(pixel) for pixel in np.transpose(np.nonzero(mask))}
+
+    def test_coords_in_contour(self):
+        pool = CoordinatePool(self.contour, 4, rng=np.random.RandomState(0))
+        self.assertEqual(len(pool), len(self.pixels))
+        self.assertEqual({(row // 4, column // 4) for row, column in pool.coords}, self.pixels)
+        self.assertFalse((pool.coords % 4).any())
+
+    def test_cursor_and_reset(self):
+        pool = CoordinatePool(self.contour, 1, size=10, rng=np.random.RandomState(0))
+        self.assertEqual(len(pool), 10)
+        first = pool.take(10)
+        self.assertEqual(pool.remaining(), 0)
+        self.assertEqual(len({tuple(coords) for coords in first}), 10)
+        # An exhausted pool is reshuffled, drawing never fails
+        second = pool.take(10)
+        self.assertEqual({tuple(coords) for coords in first}, {tuple(coords) for coords in second})
+
+    def test_keep(self):
+        keep = np.zeros((64, 64), bool)
+        keep[20:25, 10:15] = True
+        pool = CoordinatePool(self.contour, 1, keep=keep)
+        self.assertEqual({tuple(coords) for coords in pool.coords}, {(row, column) for row in range(20, 25) for column in range(10, 15)})
+        # Without foreground in the contour, all its positions are kept
+        self.assertEqual(len(CoordinatePool(self.contour, 1, keep=np.zeros((64, 64), bool))), len(self.pixels))
+
+    def test_from_coords(self):
+        pool = CoordinatePool(self.contour, 1, rng=np.random.RandomState(0))
+        pool.take(5)
+        resumed = CoordinatePool.from_coords(pool.coords.copy(), pool.cursor)
+        np.testing.assert_array_equal(resumed.take(5), pool.take(5))
+
+
+class ForegroundMaskTest(unittest.TestCase):
+
+    def test_tissue_and_stddev(self):
+        rng = np.random.RandomState(0)
+        overview = np.full((40, 40, 4), 240, np.uint8)
+        # Textured tissue on the left half, flat tissue colored background on the right
+        overview[:, :20, :3] = rng.randint(100, 200, (40, 20, 3))
+        overview[:, 20:, :3] = 150
+        contour = np.array([[[0, 0]], [[39, 0]], [[39, 39]], [[0, 39]]], dtype=np.int32)
+        keep = foreground_mask(overview, [contour], 4, min_tissue=0.5, min_std=4.0)
+        # The last row is a quarter inside the overview, outside is no tissue
+        self.assertTrue(keep[:39, :16].all())
+        self.assertFalse(keep[39].any())
+        self.assertFalse(keep[:, 20:].any())
+
+    def test_tissue_fraction(self):
+        overview = np.random.RandomState(0).randint(0, 256, (40, 40, 4)).astype(np.uint8)
+        contour = np.array([[[0, 0]], [[19, 0]], [[19, 39]], [[0, 39]]], dtype=np.int32)
+        keep = foreground_mask(overview, [contour], 4, min_tissue=0.5, min_std=0)
+        # A footprint with its top left at column 18 is half tissue (18, 19), at 19 a quarter
+        self.assertTrue(keep[:37, :19].all())
+        self.assertFalse(keep[:, 19:].any() or keep[39].any())
+        # Near the bottom the footprint is partly outside the overview: 3 x 3 and 3 x 2 of 4 x 4 tissue
+        self.assertTrue(keep[37, 17])
+        self.assertFalse(keep[37, 18])
+
+    def test_patch_stddev(self):
+        self.assertEqual(patch_stddev(np.full((16, 16, 3), 200, np.uint8)), 0)
+        patch = np.zeros((16, 16, 3), np.uint8)
+        patch[:, 8:] = 100
+        self.assertAlmostEqual(patch_stddev(patch, step=1), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import numpy as np
+import os
+import hashlib
+import json
+import shutil
+import argparse
+
+
+class ContourIndex():
+    """
+    - On-disk index of the low resolution overview and the tissue / tumor
+    contours of whole slide images, as computed by `SurfSampler` at
+    `opts.bb_downsample`.
+
+    - Every slide gets its own folder in `opts.contour_index_dir`, named by a
+    hash of:
+        > slide path and mtime
+        > label path and mtime (if any)
+        > bb_downsample
+        > tissue detection parameters (see `surf_tissue.TISSUE_METHODS`)
+
+    So a changed slide, label or threshold automatically results in a miss.
+
+    - A folder contains:
+        overview.npy        : (H,W,4) uint8 RGBA image at `bb_downsample`
+        mask.npy            : (H,W,C) uint8 tumor mask at `bb_downsample` (only with label)
+        tissue.npy          : (N,2) int32 concatenated points of the tissue contours
+        tissue_offsets.npy  : (n_contours + 1,) int64 start / end of every contour in tissue.npy
+        tumor.npy           : (M,2) int32 concatenated points of the tumor contours
+        tumor_offsets.npy   : (m_contours + 1,) int64
+        meta.json           : the key the hash is made of
+
+    - All arrays are memory mapped on lookup, so re-opening a slide costs a
+    lookup rather than a full low resolution decode.
+
+    - Build the index offline (optionally with horovodrun, slides are divided over the workers):
+
+    >>>>Example:
+
+    python surf_index.py --slide_path /path/to/slides --label_path /path/to/labels --contour_index_dir /path/to/index
+
+    """
+    def __init__(self, index_dir, bb_downsample, tissue_params):
+        self.index_dir = index_dir
+        self.bb_downsample = bb_downsample
+        self.tissue_params = tissue_params
+        # Known mtimes of slides / labels (e.g. from the dataset manifest), which saves a stat per lookup
+        self.mtimes = {}
+        os.makedirs(self.index_dir, exist_ok=True)
+
+    def mtime(self, path):
+        return self.mtimes[path] if path in self.mtimes else os.path.getmtime(path)
+
+    def key(self, slide_path, label_path=None):
+        meta = {'slide_path'   : os.path.abspath(slide_path),
+                'slide_mtime'  : self.mtime(slide_path),
+                'label_path'   : os.path.abspath(label_path) if label_path else None,
+                'label_mtime'  : self.mtime(label_path) if label_path else None,
+                'bb_downsample': self.bb_downsample,
+                'tissue_params': self.tissue_params}
+        digest = hashlib.sha1(json.dumps(meta, sort_keys=True).encode()).hexdigest()
+        return digest, meta
+
+    @staticmethod
+    def _pack(contours):
+        """ Concatenate OpenCV contours (n,1,2) to one (N,2) array plus offsets """
+        contours = [np.asarray(contour, dtype=np.int32).reshape(-1, 2) for contour in contours]
+        offsets = np.cumsum([0] + [len(contour) for contour in contours]).astype(np.int64)
+        points = np.concatenate(contours) if contours else np.zeros((0, 2), dtype=np.int32)
+        return points, offsets
+
+    @staticmethod
+    def _unpack(points, offsets):
+        """ Views on the (memory mapped) points, in OpenCV contour layout (n,1,2) """
+        return [points[offsets[i]:offsets[i + 1]].reshape(-1, 1, 2) for i in range(len(offsets) - 1)]
+
+    def lookup(self, slide_path, label_path=None):
+        """
+        Returns a dict with `overview`, `mask` (None without label), `contours`
+        and `contours_tumor`, or None if the slide is not (yet) in the index
+        """
+        digest, _ = self.key(slide_path, label_path)
+        folder = os.path.join(self.index_dir, digest)
+        if not os.path.isfile(os.path.join(folder, 'meta.json')):
+            return None
+
+        load = lambda name: np.load(os.path.join(folder, name), mmap_mode='r')
+        return {'overview'      : load('overview.npy'),
+                'mask'          : load('mask.npy') if os.path.isfile(os.path.join(folder, 'mask.npy')) else None,
+                'contours'      : self._unpack(load('tissue.npy'), load('tissue_offsets.npy')),
+                'contours_tumor': self._unpack(load('tumor.npy'), load('tumor_offsets.npy'))}
+
+    def store(self, slide_path, overview, mask, contours, contours_tumor, label_path=None):
+        """
+        Write the entry to a temporary folder first and rename it, so
+        concurrent workers never see a half written entry
+        """
+        digest, meta = self.key(slide_path, label_path)
+        folder = os.path.join(self.index_dir, digest)
+        if os.path.isfile(os.path.join(folder, 'meta.json')):
+            return folder
+
+        tmp_folder = f'{folder}.tmp{os.getpid()}'
+        os.makedirs(tmp_folder, exist_ok=True)
+        np.save(os.path.join(tmp_folder, 'overview.npy'), np.ascontiguousarray(overview, dtype=np.uint8))
+        if mask is not None:
+            np.save(os.path.join(tmp_folder, 'mask.npy'), np.ascontiguousarray(mask, dtype=np.uint8))
+        for name, _contours in (('tissue', contours), ('tumor', contours_tumor)):
+            points, offsets = self._pack(_contours)
+            np.save(os.path.join(tmp_folder, f'{name}.npy'), points)
+            np.save(os.path.join(tmp_folder, f'{name}_offsets.npy'), offsets)
+        with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+        try:
+            os.rename(tmp_folder, folder)
+        except OSError:
+            # Another worker finished this slide first
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+        return folder
+
+
+def get_options():
+    """ Argument parsing options"""
+
+    parser = argparse.ArgumentParser(description='Build the contour index of SurfSampler',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--slide_path', type=str, help='Folder of where the training data whole slide images are located', default=None)
+    parser.add_argument('--label_path', type=str, help='Folder of where the training data whole slide images labels are located', default=None)
+    parser.add_argument('--valid_slide_path', type=str, help='Folder of where the validation data whole slide images are located', default=None)
+    parser.add_argument('--valid_label_path', type=str, help='Folder of where the validation data whole slide images labels are located', default=None)
+    parser.add_argument('--test_path', type=str, help='Folder of where the test data whole slide images are located', default=None)
+    parser.add_argument('--slide_format', type=str, help='In which format the whole slide images are saved.', default='tif')
+    parser.add_argument('--label_format', type=str, help='In which format the labels are saved.', default='xml', choices=['tif', 'xml'])
+    parser.add_argument('--bb_downsample', type=int, help='Level to use for the bounding box construction as downsampling level of whole slide image', default=7)
+    parser.add_argument('--contour_index_dir', type=str, help='Folder of where the contour index is saved', required=True)
+    parser.add_argument('--tissue_method', type=str, default='hsv', choices=['hsv', 'otsu'], help='Tissue detection method (see surf_tissue.py)')
+    parser.add_argument('--pairing_rules', type=str, nargs='*', default=[],
+                        help='Rules REGEX=>TEMPLATE that map a label file name to its slide file name (see surf_pairing.py)')
+    parser.add_argument('--manifest', type=str, default=None, help='JSONL dataset manifest (see surf_manifest.py), loaded instead of globbing if it exists')
+    parser.add_argument('--fuzzy_cutoff', type=float, default=0.6, help='Minimum string similarity of the fuzzy pairing of leftover labels')
+    parser.add_argument('--verbose', type=str, default='info', help='Verbosity of the index builder', choices=['info', 'debug'])
+    return parser.parse_args()
+
+
+def build_index(opts):
+    """ Fill the contour index for all (slide,label) pairs of the given paths """
+    # Imported here, as surf_sampler itself imports this module
+    import horovod.tensorflow as hvd
+    from openslide import OpenSlide
+    from surf_annotations import PolygonMask
+    from surf_pairing import dataset_pairs
+    from surf_sampler import slide_overview, tumor_contours
+    from surf_tissue import tissue_params, slide_tissue_contours
+
+    hvd.init()
+    index = ContourIndex(opts.contour_index_dir, opts.bb_downsample, tissue_params(opts.tissue_method))
+
+    # Same pairs as the sampler (see surf_pairing.py)
+    entries = dataset_pairs(opts) if hvd.rank() == 0 else None
+    entries = hvd.broadcast_object(entries, root_rank=0)
+    pairs = [(entry['slide'], entry['label']) for entry in entries]
+
+    # Divide slides over workers
+    pairs = sorted(set(pairs), key=lambda pair: pair[0])[hvd.rank()::hvd.size()]
+    print(f"Worker {hvd.rank()}: indexing {len(pairs)} slides in {opts.contour_index_dir}")
+
+    for idx, (slide_path, label_path) in enumerate(pairs):
+        if index.lookup(slide_path, label_path) is not None:
+            if opts.verbose == 'debug': print(f"Worker {hvd.rank()}: {slide_path} already indexed")
+            continue
+        wsi, mask = None, None
+        try:
+            wsi = OpenSlide(slide_path)
+            if label_path is None:
+                mask = None
+            elif opts.label_format.find('xml') > -1:
+                mask = PolygonMask.from_xml(label_path, wsi.dimensions)
+            else:
+                mask = OpenSlide(label_path)
+
+            overview, mask_overview = slide_overview(wsi, mask, opts.bb_downsample)
+            contours = slide_tissue_contours(wsi, overview, opts.bb_downsample, tissue_params(opts.tissue_method))
+            contours_tumor = tumor_contours(mask_overview) if mask_overview is not None else []
+            index.store(slide_path, overview, mask_overview, contours, contours_tumor, label_path=label_path)
+            print(f"Worker {hvd.rank()}: indexed {idx + 1} / {len(pairs)} ({slide_path}, {len(contours)} ROI's)")
+        except Exception as e:
+            print(f"{e}, at {slide_path}")
+        finally:
+            # One handle (and OpenSlide tile cache) per slide and label otherwise stays open for the whole cohort
+            for handle in (wsi, mask):
+                if handle is not None:
+                    handle.close()
+
+    return index
+
+
+if __name__ == '__main__':
+    build_index(get_options())
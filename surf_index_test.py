@@ -0,0 +1,58 @@
+"""Tests for surf_index."""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from surf_index import ContourIndex
+
+
+class ContourIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.slide_path = os.path.join(self.tmp_dir, 'tumor_001.tif')
+        self.label_path = os.path.join(self.tmp_dir, 'tumor_001.xml')
+        for path in (self.slide_path, self.label_path):
+            open(path, 'w').close()
+        self.index = ContourIndex(os.path.join(self.tmp_dir, 'index'), 7, {'close_kernel': 50})
+        self.overview = np.arange(8 * 6 * 4, dtype=np.uint8).reshape(8, 6, 4)
+        self.contours = [np.array([[[0, 0]], [[5, 0]], [[5, 7]]]), np.array([[[1, 1]], [[2, 2]]])]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        self.assertIsNone(self.index.lookup(self.slide_path, self.label_path))
+        mask = np.ones((8, 6, 1), np.uint8)
+        self.index.store(self.slide_path, self.overview, mask, self.contours, [], label_path=self.label_path)
+        entry = self.index.lookup(self.slide_path, self.label_path)
+        np.testing.assert_array_equal(entry['overview'], self.overview)
+        np.testing.assert_array_equal(entry['mask'], mask)
+        self.assertEqual(len(entry['contours']), 2)
+        for contour, expected in zip(entry['contours'], self.contours):
+            np.testing.assert_array_equal(contour, expected)
+        self.assertEqual(entry['contours_tumor'], [])
+
+    def test_key_changes_miss(self):
+        self.index.store(self.slide_path, self.overview, None, self.contours, [])
+        self.assertIsNotNone(self.index.lookup(self.slide_path))
+        # The entry with a label is another entry
+        self.assertIsNone(self.index.lookup(self.slide_path, self.label_path))
+        # A changed slide, bb_downsample or tissue parameters is a miss
+        self.index.mtimes[self.slide_path] = os.path.getmtime(self.slide_path) + 1
+        self.assertIsNone(self.index.lookup(self.slide_path))
+        del self.index.mtimes[self.slide_path]
+        self.assertIsNone(ContourIndex(self.index.index_dir, 6, {'close_kernel': 50}).lookup(self.slide_path))
+        self.assertIsNone(ContourIndex(self.index.index_dir, 7, {'close_kernel': 40}).lookup(self.slide_path))
+
+    def test_store_existing(self):
+        folder = self.index.store(self.slide_path, self.overview, None, self.contours, [])
+        # A second store (e.g. of another worker) keeps the first entry
+        self.assertEqual(self.index.store(self.slide_path, np.zeros_like(self.overview), None, [], []), folder)
+        np.testing.assert_array_equal(self.index.lookup(self.slide_path)['overview'], self.overview)
+        self.assertEqual(os.listdir(self.index.index_dir), [os.path.basename(folder)])
+
+
+if __name__ == '__main__':
+    unittest.main()
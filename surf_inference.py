@@ -0,0 +1,165 @@
+import numpy as np
+import os
+import cv2
+import tensorflow as tf
+import horovod.tensorflow as hvd
+from openslide import OpenSlide
+
+
+class TiledInference():
+    """
+    - Deterministic whole slide inference. Instead of predicting random
+    coordinates one patch at a time, it walks the tissue ROI's of `get_bb` on a
+    regular grid of `opts.image_size` tiles with `opts.tile_overlap` pixels of
+    overlap, and predicts them in batches of `opts.tile_batch_size` with the model
+    in eval mode (training=False, so BatchNorm uses its moving statistics).
+
+    - The tiles are read with `SurfSampler.read_patch` of the sampler, at the
+    magnification of `opts.target_mpp` / `opts.target_level` the model is
+    trained at: a tile covers the patch footprint of the slide, and the grid
+    and the overlap are scaled by its downsample.
+
+    - The tumor probabilities of the tiles are stitched into one low resolution
+    probability map at level `opts.prob_map_level` (1 pixel = 2**prob_map_level
+    level 0 pixels, at every magnification). Overlapping tiles are blended with a
+    weight window that decreases towards the tile borders, where the FoV lacks context.
+
+    - The grid is anchored at (0,0) of level 0 and sorted, so the output of a
+    slide is reproducible and covers all tissue.
+
+    >>>>Example:
+
+    inference = TiledInference(model, opts)
+    for slide_path, prob_map, overview in inference.run(test_sampler):
+        inference.save(slide_path, prob_map, overview)
+
+    """
+    def __init__(self, model, opts):
+        self.model = model
+        self.opts = opts
+        self.size = opts.image_size
+        self.stride = opts.image_size - opts.tile_overlap
+        assert self.stride > 0, "WARNING: tile_overlap must be smaller than image_size"
+        self.map_downsample = pow(2, opts.prob_map_level)
+        # Blending windows per tile size on the probability map
+        self.windows = {}
+
+        self.batch = np.zeros((opts.tile_batch_size, self.size, self.size, 3), dtype=np.uint8)
+        self._predict = tf.function(self.predict_batch)
+
+    def window(self, tile):
+        """ Blending window of a `tile` x `tile` map tile, linear ramp from the tile border to the tile center """
+        if tile not in self.windows:
+            ramp = np.minimum(np.arange(tile) + 1, np.arange(tile)[::-1] + 1).astype(np.float32)
+            self.windows[tile] = np.outer(ramp, ramp) / np.outer(ramp, ramp).max()
+        return self.windows[tile]
+
+    def predict_batch(self, batch, tile):
+        """ uint8 batch of tiles -> tumor probability of every tile, at map resolution (`tile` x `tile`) """
+        x = 2.0 * tf.cast(batch, tf.float32) / 255.0 - 1.0
+        logits = self.model(x, training=False)
+        # EfficientDet returns a tuple of heads, the segmentation head is the last
+        if isinstance(logits, (list, tuple)):
+            logits = logits[-1]
+        prob = tf.nn.softmax(tf.cast(logits, tf.float32), axis=-1)[..., 1:2]
+        return tf.image.resize(prob, tf.stack([tile, tile]), method='area')[..., 0]
+
+    def grid(self, contours, dimensions, mag_factor, footprint=None):
+        """
+        Sorted (row, column) level 0 top-left coordinates of the tiles of
+        `footprint` (default `image_size`) level 0 pixels that cover the tissue
+        `contours` (on the overview at `mag_factor`) of a slide of (width, height) `dimensions`
+        """
+        width, height = dimensions
+        size = footprint or self.size
+        stride = max(1, int(round(self.stride * size / self.size)))
+        tiles = set()
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(np.asarray(contour, dtype=np.int32))
+            tissue = np.zeros((h + 1, w + 1), np.uint8)
+            cv2.drawContours(tissue, [np.asarray(contour, dtype=np.int32)], -1, (1), -1, offset=(-x, -y))
+            x0, y0, x1, y1 = x * mag_factor, y * mag_factor, (x + w + 1) * mag_factor, (y + h + 1) * mag_factor
+            for row in range((y0 // stride) * stride, y1, stride):
+                for column in range((x0 // stride) * stride, x1, stride):
+                    # Keep the tile if its footprint on the overview contains tissue
+                    r0, c0 = max(0, row // mag_factor - y), max(0, column // mag_factor - x)
+                    r1, c1 = (row + size) // mag_factor - y + 1, (column + size) // mag_factor - x + 1
+                    if tissue[r0:r1, c0:c1].any():
+                        # Keep the tile inside the slide
+                        tiles.add((max(0, min(row, height - size)), max(0, min(column, width - size))))
+        return np.array(sorted(tiles), dtype=np.int64).reshape(-1, 2)
+
+    def predict_slide(self, sampler, slide_path, contours):
+        """
+        Stitched (H // 2**prob_map_level, W // 2**prob_map_level) tumor
+        probability map of a slide, of tiles read by `sampler` (see SurfSampler.read_patch)
+        """
+        # Overlapping tiles decode the shared slide tiles once with opts.tile_cache_mb (see surf_tiles.py)
+        handles = sampler.open_region(slide_path)
+        image = handles[0]
+        width, height = image.width, image.height
+        footprint = sampler.footprint(slide_path)
+        tiles = self.grid(contours, (width, height), sampler.mag_factor, footprint)
+        # Size of a tile on the probability map
+        tile = max(1, footprint // self.map_downsample)
+        window = self.window(tile)
+
+        map_shape = (height // self.map_downsample + tile, width // self.map_downsample + tile)
+        prob_sum = np.zeros(map_shape, dtype=np.float32)
+        weight_sum = np.zeros(map_shape, dtype=np.float32)
+
+        batch_size = len(self.batch)
+        for start in range(0, len(tiles), batch_size):
+            coords = tiles[start:start + batch_size]
+            for i, (row, column) in enumerate(coords):
+                self.batch[i] = sampler.read_patch(slide_path, int(column), int(row), handles)[..., :3]
+            # The last batch is padded (with the previous tiles), so the function is traced only once
+            probs = self._predict(self.batch, tf.constant(tile)).numpy()[:len(coords)]
+            for (row, column), prob in zip(coords, probs):
+                r, c = row // self.map_downsample, column // self.map_downsample
+                prob_sum[r:r + tile, c:c + tile] += prob * window
+                weight_sum[r:r + tile, c:c + tile] += window
+            if self.opts.verbose == 'debug':
+                print(f"Worker {hvd.rank()}: predicted {start + len(coords)} / {len(tiles)} tiles of {slide_path}")
+
+        prob_map = np.where(weight_sum > 0, prob_sum / np.maximum(weight_sum, 1e-6), 0.0)
+        return prob_map[:height // self.map_downsample, :width // self.map_downsample].astype(np.float32)
+
+    @staticmethod
+    def slide_paths(sampler):
+        """ Unique (slide, label or None) pairs of a validation / test sampler of this worker """
+        paths = sampler.valid_paths if sampler.mode == 'validation' else sampler.test_paths
+        pairs = []
+        for path in paths:
+            pair = tuple(path) if isinstance(path, (tuple, list)) else (path, None)
+            if pair not in pairs:
+                pairs.append(pair)
+        return pairs
+
+    def run(self, sampler):
+        """ Yields (slide_path, probability map, overview) for every slide of the sampler """
+        pairs = TiledInference.slide_paths(sampler)
+        for idx, (slide_path, label_path) in enumerate(pairs):
+            try:
+                wsi = OpenSlide(slide_path)
+                entry = sampler.slide_contours(wsi, None, slide_path)
+                wsi.close()
+                prob_map = self.predict_slide(sampler, slide_path, entry['contours'])
+            except Exception as e:
+                print(f"{e}, at {slide_path}")
+                continue
+            print(f"Worker {hvd.rank()}: Evaluated {idx + 1} / {len(pairs)} WSI's ({slide_path})")
+            yield slide_path, prob_map, entry['overview']
+
+    def save(self, slide_path, prob_map, overview):
+        """ Save the probability map (.npy) and an overlay on the overview (.png) in `opts.log_dir` """
+        wsi_name = os.path.splitext(os.path.basename(slide_path))[0]
+        np.save(os.path.join(self.opts.log_dir, f'{wsi_name}_prob.npy'), prob_map)
+
+        overview = np.ascontiguousarray(overview[..., :3])
+        prob = cv2.resize(prob_map, (overview.shape[1], overview.shape[0]), interpolation=cv2.INTER_AREA)
+        heat = np.zeros_like(overview)
+        heat[..., 0] = (255 * prob).astype(np.uint8)
+        overlay = cv2.addWeighted(overview, 0.7, heat, 0.3, 0)
+        cv2.imwrite(os.path.join(self.opts.log_dir, f'{wsi_name}_prob.png'), cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
+        return wsi_name
@@ -0,0 +1,64 @@
+"""Tests for surf_inference."""
+import unittest
+from types import SimpleNamespace
+import numpy as np
+import cv2
+from surf_inference import TiledInference
+
+
+class TiledInferenceTest(unittest.TestCase):
+
+    def setUp(self):
+        opts = SimpleNamespace(image_size=64, tile_overlap=16, prob_map_level=2, tile_batch_size=2, verbose='info')
+        self.inference = TiledInference(None, opts)
+
+    def covered(self, tiles, shape, size):
+        covered = np.zeros(shape, bool)
+        for row, column in tiles:
+            covered[row:row + size, column:column + size] = True
+        return covered
+
+    def test_window(self):
+        window = self.inference.window(5)
+        np.testing.assert_allclose(window[2], [1 / 3, 2 / 3, 1, 2 / 3, 1 / 3])
+        np.testing.assert_allclose(window, window.T)
+        self.assertIs(self.inference.window(5), window)
+
+    def test_grid_covers_tissue(self):
+        # Overview at 16 level 0 pixels per pixel of a 640 x 480 slide
+        contour = np.array([[[3, 2]], [[20, 5]], [[12, 25]]], dtype=np.int32)
+        tissue = np.zeros((30, 40), np.uint8)
+        cv2.drawContours(tissue, [contour], -1, 1, -1)
+        for footprint in (None, 128):
+            size = footprint or 64
+            tiles = self.inference.grid([contour], (640, 480), 16, footprint)
+            self.assertEqual([tuple(tile) for tile in tiles], sorted({tuple(tile) for tile in tiles}))
+            # On the grid of the stride (48 level 0 pixels, scaled with the footprint), or moved inside the slide
+            stride = 48 * size // 64
+            self.assertTrue(((tiles[:, 0] % stride == 0) | (tiles[:, 0] == 480 - size)).all())
+            self.assertTrue(((tiles[:, 1] % stride == 0) | (tiles[:, 1] == 640 - size)).all())
+            self.assertTrue((tiles[:, 0] + size <= 480).all() and (tiles[:, 1] + size <= 640).all())
+            covered = self.covered(tiles, (480, 640), size)
+            rows, columns = np.nonzero(tissue)
+            self.assertTrue(covered[rows * 16 + 8, columns * 16 + 8].all())
+        # The grid is reproducible
+        np.testing.assert_array_equal(tiles, self.inference.grid([contour], (640, 480), 16, 128))
+
+    def test_grid_slide_border(self):
+        # Tissue up to the bottom right corner: the last tiles are moved inside the slide
+        contour = np.array([[[35, 25]], [[39, 25]], [[39, 29]], [[35, 29]]], dtype=np.int32)
+        tiles = self.inference.grid([contour], (630, 470), 16)
+        self.assertTrue((tiles[:, 0] == 470 - 64).any() and (tiles[:, 1] == 630 - 64).any())
+        self.assertTrue(self.covered(tiles, (470, 630), 64)[400:, 560:].all())
+        self.assertEqual(self.inference.grid([], (630, 470), 16).shape, (0, 2))
+
+    def test_slide_paths(self):
+        sampler = SimpleNamespace(mode='validation', valid_paths=[('a.tif', 'a.xml'), ['a.tif', 'a.xml'], ('b.tif', 'b.xml')],
+                                  test_paths=['c.tif', 'c.tif', 'd.tif'])
+        self.assertEqual(TiledInference.slide_paths(sampler), [('a.tif', 'a.xml'), ('b.tif', 'b.xml')])
+        sampler.mode = 'test'
+        self.assertEqual(TiledInference.slide_paths(sampler), [('c.tif', None), ('d.tif', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+- Dataset manifest: one JSON line per slide of the train, validation and test
+data, with the slide / label pair (see surf_pairing.py) and the slide metadata
+the sampler would otherwise read from the file system on every rank:
+
+    split             : 'train', 'validation' or 'test'
+    slide, label      : paths (label None for test slides)
+    rule              : how the label was paired ('exact', 'rule', 'fuzzy')
+    size, mtime       : of the slide file
+    label_mtime       : of the label file (None without label)
+    level_dimensions  : (width, height) per pyramid level
+    level_downsamples : downsample factor per pyramid level
+    mpp               : micron per pixel of level 0 (None if unknown)
+    tissue_area       : tissue area in pixels of `bb_downsample` (None without contour index)
+
+- SurfSampler loads the manifest on rank 0 and broadcasts it (`opts.manifest`),
+so a run does not glob, stat or open any slide before sampling. Rebuild the
+manifest when the data changes.
+
+- Build it offline (optionally with horovodrun, slides are divided over the
+workers). Build the contour index first to fill in the tissue areas:
+
+>>>>Example:
+
+python surf_manifest.py --slide_path /path/to/slides --label_path /path/to/labels --manifest /path/to/manifest.jsonl
+"""
+import numpy as np
+import os
+import argparse
+import cv2
+from surf_pairing import pair_entries, save_manifest
+from surf_staging import slide_resolution
+
+
+def slide_metadata(slide_path, label_path=None):
+    """ Metadata of a slide (see the module docstring), from one open of the slide """
+    from openslide import OpenSlide
+    wsi = OpenSlide(slide_path)
+    try:
+        mpp = slide_resolution(wsi)
+    except (KeyError, ValueError, ZeroDivisionError):
+        mpp = None
+    metadata = {'size'             : os.path.getsize(slide_path),
+                'mtime'            : os.path.getmtime(slide_path),
+                'label_mtime'      : os.path.getmtime(label_path) if label_path else None,
+                'level_dimensions' : [list(dims) for dims in wsi.level_dimensions],
+                'level_downsamples': [float(downsample) for downsample in wsi.level_downsamples],
+                'mpp'              : mpp}
+    wsi.close()
+    return metadata
+
+
+def tissue_area(contour_index, slide_path, label_path=None):
+    """ Tissue area of the contours in the index at `bb_downsample`, None on a miss """
+    if contour_index is None:
+        return None
+    entry = contour_index.lookup(slide_path, label_path)
+    if entry is None:
+        return None
+    return float(sum(cv2.contourArea(np.asarray(contour, dtype=np.int32)) for contour in entry['contours']))
+
+
+def get_options():
+    """ Argument parsing options"""
+
+    parser = argparse.ArgumentParser(description='Build the dataset manifest of SurfSampler',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--slide_path', type=str, help='Folder of where the training data whole slide images are located', default=None)
+    parser.add_argument('--label_path', type=str, help='Folder of where the training data whole slide images labels are located', default=None)
+    parser.add_argument('--valid_slide_path', type=str, help='Folder of where the validation data whole slide images are located', default=None)
+    parser.add_argument('--valid_label_path', type=str, help='Folder of where the validation data whole slide images labels are located', default=None)
+    parser.add_argument('--test_path', type=str, help='Folder of where the test data whole slide images are located', default=None)
+    parser.add_argument('--slide_format', type=str, help='In which format the whole slide images are saved.', default='tif')
+    parser.add_argument('--label_format', type=str, help='In which format the labels are saved.', default='xml', choices=['tif', 'xml'])
+    parser.add_argument('--bb_downsample', type=int, help='Level to use for the bounding box construction as downsampling level of whole slide image', default=7)
+    parser.add_argument('--contour_index_dir', type=str, default=None, help='Folder of the contour index, for the tissue areas (see surf_index.py)')
+    parser.add_argument('--tissue_method', type=str, default='hsv', choices=['hsv', 'otsu'], help='Tissue detection method of the contour index (see surf_tissue.py)')
+    parser.add_argument('--pairing_rules', type=str, nargs='*', default=[],
+                        help='Rules REGEX=>TEMPLATE that map a label file name to its slide file name (see surf_pairing.py)')
+    parser.add_argument('--fuzzy_cutoff', type=float, default=0.6, help='Minimum string similarity of the fuzzy pairing of leftover labels')
+    parser.add_argument('--manifest', type=str, help='JSONL file the manifest is written to', required=True)
+    return parser.parse_args()
+
+
+def build_manifest(opts):
+    """ Pair the slides, read their metadata (divided over the workers) and write the manifest on rank 0 """
+    import horovod.tensorflow as hvd
+    from surf_index import ContourIndex
+    from surf_tissue import tissue_params
+
+    hvd.init()
+    entries = pair_entries(opts) if hvd.rank() == 0 else None
+    entries = hvd.broadcast_object(entries, root_rank=0)
+    index = ContourIndex(opts.contour_index_dir, opts.bb_downsample, tissue_params(opts.tissue_method)) if opts.contour_index_dir else None
+
+    # Divide slides over workers
+    metadata = {}
+    for idx in range(hvd.rank(), len(entries), hvd.size()):
+        entry = entries[idx]
+        try:
+            metadata[idx] = slide_metadata(entry['slide'], entry['label'])
+            metadata[idx]['tissue_area'] = tissue_area(index, entry['slide'], entry['label'])
+        except Exception as e:
+            print(f"{e}, at {entry['slide']}")
+
+    metadata = hvd.allgather_object(metadata)
+    if hvd.rank() == 0:
+        for worker_metadata in metadata:
+            for idx, fields in worker_metadata.items():
+                entries[idx].update(fields)
+        missing = sum('size' not in entry for entry in entries)
+        save_manifest(opts.manifest, entries)
+        print(f"Saved {len(entries)} slides to {opts.manifest} ({missing} without metadata)")
+    return entries
+
+
+if __name__ == '__main__':
+    build_manifest(get_options())
@@ -0,0 +1,47 @@
+"""Tests for surf_manifest."""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from surf_index import ContourIndex
+from surf_manifest import tissue_area
+from surf_pairing import load_manifest, save_manifest
+from surf_sharding import slide_work
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.slide_path = os.path.join(self.tmp_dir, 'tumor_001.tif')
+        with open(self.slide_path, 'wb') as f:
+            f.write(b'0' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_tissue_area(self):
+        index = ContourIndex(os.path.join(self.tmp_dir, 'index'), 7, {'close_kernel': 50})
+        self.assertIsNone(tissue_area(None, self.slide_path))
+        self.assertIsNone(tissue_area(index, self.slide_path))
+        contours = [np.array([[[0, 0]], [[10, 0]], [[10, 5]], [[0, 5]]]), np.array([[[20, 20]], [[24, 20]], [[24, 24]]])]
+        index.store(self.slide_path, np.zeros((32, 32, 4), np.uint8), None, contours, [])
+        self.assertEqual(tissue_area(index, self.slide_path), 50 + 8)
+
+    def test_round_trip(self):
+        entries = [{'split': 'train', 'slide': self.slide_path, 'label': None, 'rule': None,
+                    'size': 100, 'mtime': os.path.getmtime(self.slide_path), 'label_mtime': None,
+                    'level_dimensions': [[4096, 2048], [1024, 512]], 'level_downsamples': [1.0, 4.0],
+                    'mpp': 0.243, 'tissue_area': 1234.5}]
+        path = os.path.join(self.tmp_dir, 'manifest.jsonl')
+        save_manifest(path, entries)
+        loaded = load_manifest(path)
+        self.assertEqual(loaded, entries)
+        # The sampler balances the shards on the tissue area of the manifest
+        metadata = {entry['slide']: entry for entry in loaded}
+        np.testing.assert_array_equal(slide_work([self.slide_path], metadata=metadata), [1234.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
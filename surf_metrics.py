@@ -0,0 +1,189 @@
+import numpy as np
+import cv2
+import tensorflow as tf
+import horovod.tensorflow as hvd
+
+
+# Average number of false positives per slide at which the FROC sensitivity is reported (CAMELYON16)
+FROC_FP_RATES = (0.25, 0.5, 1, 2, 4, 8)
+
+
+def confusion_scores(confusion):
+    """ Per class IoU and Dice of a (K,K) confusion matrix (rows: ground truth, columns: prediction) """
+    confusion = np.asarray(confusion, dtype=np.float64)
+    tp = np.diag(confusion)
+    fp = confusion.sum(axis=0) - tp
+    fn = confusion.sum(axis=1) - tp
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(tp + fp + fn > 0, tp / (tp + fp + fn), np.nan)
+        dice = np.where(tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), np.nan)
+    return iou, dice
+
+
+def histogram_auc(histogram):
+    """
+    Area under the ROC curve from a (2, num_bins) histogram of the tumor
+    probability of the negative (row 0) and positive (row 1) pixels
+    """
+    negatives, positives = np.asarray(histogram, dtype=np.float64)
+    if not negatives.sum() or not positives.sum():
+        return np.nan
+    # Sweep the threshold from the highest bin down
+    tpr = np.concatenate([[0], np.cumsum(positives[::-1]) / positives.sum()])
+    fpr = np.concatenate([[0], np.cumsum(negatives[::-1]) / negatives.sum()])
+    # Trapezoidal rule
+    return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+
+def slide_candidates(prob_map, truth_map, threshold=0.5):
+    """
+    Lesion detections of one slide for the FROC: every connected component of
+    `prob_map` >= threshold is a candidate at its maximum, which hits the ground
+    truth lesion (connected component of `truth_map`) it lies in.
+
+    Returns (candidates, num_lesions), with candidates a (N,2) array of
+    (probability, hit lesion label or 0)
+    """
+    num_lesions, lesions = cv2.connectedComponents(np.asarray(truth_map, dtype=np.uint8), connectivity=8)
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats((prob_map >= threshold).astype(np.uint8), connectivity=8)
+    candidates = np.zeros((max(0, num_labels - 1), 2), dtype=np.float64)
+    for label in range(1, num_labels):
+        x, y, w, h = stats[label, :4]
+        component = np.where(labels[y:y + h, x:x + w] == label, prob_map[y:y + h, x:x + w], -1)
+        row, column = np.unravel_index(np.argmax(component), component.shape)
+        candidates[label - 1] = (component[row, column], lesions[y + row, x + column])
+    return candidates, num_lesions - 1
+
+
+def froc(slides, fp_rates=FROC_FP_RATES):
+    """
+    Average sensitivity at `fp_rates` false positives per slide, from a list of
+    per slide (candidates, num_lesions) of `slide_candidates`
+    """
+    num_slides = len(slides)
+    total_lesions = sum(num_lesions for _, num_lesions in slides)
+    if not num_slides or not total_lesions:
+        return np.nan, {}
+
+    detections = []
+    for slide_id, (candidates, _) in enumerate(slides):
+        for prob, lesion in candidates:
+            detections.append((prob, slide_id, int(lesion)))
+    detections.sort(key=lambda detection: -detection[0])
+
+    # Walk down the probabilities, counting false positives and detected lesions
+    false_positives, hits = 0, set()
+    curve = [(0.0, 0.0)]
+    for prob, slide_id, lesion in detections:
+        if lesion:
+            hits.add((slide_id, lesion))
+        else:
+            false_positives += 1
+        curve.append((false_positives / num_slides, len(hits) / total_lesions))
+    curve = np.array(curve)
+
+    sensitivities = {}
+    for rate in fp_rates:
+        # Highest sensitivity with at most `rate` false positives per slide
+        sensitivities[rate] = float(curve[curve[:, 0] <= rate, 1].max())
+    return float(np.mean(list(sensitivities.values()))), sensitivities
+
+
+class EvaluationAccumulator():
+    """
+    - Streaming evaluation metrics of a segmentation model. Instead of keeping
+    the masks and predictions of all patches, every batch updates (in graph):
+        > a (K,K) confusion matrix, for IoU and Dice
+        > a (2, num_bins) histogram of the tumor probability of the negative /
+        positive pixels, for the AUC
+
+    - Counts are kept for the current slide and for all slides of this worker.
+    `end_slide` reports the scores of the slide and moves its counts to the
+    global counts. `result` all-reduces the global counts (and gathers the FROC
+    candidates) over the Horovod workers.
+
+    - The FROC is computed from the low resolution (staging) maps of the
+    prediction and the ground truth, passed to `end_slide`, so memory is bounded
+    by one map per slide.
+
+    >>>>Example:
+
+    metrics = EvaluationAccumulator(config.seg_num_classes)
+    metrics.update(masks, probs)
+    print(metrics.end_slide(staging_map.map, truth_map.map >= 0.5))
+    print(metrics.result())
+
+    """
+    def __init__(self, num_classes, num_bins=200):
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.slide_confusion = tf.Variable(tf.zeros((num_classes, num_classes), tf.float64), trainable=False)
+        self.slide_histogram = tf.Variable(tf.zeros((2, num_bins), tf.float64), trainable=False)
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.float64)
+        self.histogram = np.zeros((2, num_bins), dtype=np.float64)
+        self.slides = []
+
+    @tf.function
+    def update(self, masks, probs):
+        """
+        Add a batch of one-hot (B,H,W,K) `masks` and softmax (B,h,w,K) `probs`
+        (resized to the masks if the model outputs a lower resolution)
+        """
+        probs = tf.cast(probs, tf.float32)
+        if probs.shape[1:3] != masks.shape[1:3]:
+            probs = tf.image.resize(probs, tf.shape(masks)[1:3], method='bilinear')
+        labels = tf.reshape(tf.argmax(masks, axis=-1), [-1])
+        predictions = tf.reshape(tf.argmax(probs, axis=-1), [-1])
+        self.slide_confusion.assign_add(tf.math.confusion_matrix(labels, predictions, num_classes=self.num_classes, dtype=tf.float64))
+
+        # Tumor (class > 0) vs background histogram of the tumor probability
+        tumor = tf.reshape(1.0 - probs[..., 0], [-1])
+        bins = tf.clip_by_value(tf.cast(tumor * self.num_bins, tf.int32), 0, self.num_bins - 1)
+        index = tf.cast(labels > 0, tf.int32) * self.num_bins + bins
+        counts = tf.math.bincount(index, minlength=2 * self.num_bins, maxlength=2 * self.num_bins, dtype=tf.float64)
+        self.slide_histogram.assign_add(tf.reshape(counts, (2, self.num_bins)))
+
+    @staticmethod
+    def scores(confusion, histogram):
+        iou, dice = confusion_scores(confusion)
+        return {'IoU'  : iou,
+                'mIoU' : float(np.nanmean(iou)),
+                'Dice' : dice,
+                'mDice': float(np.nanmean(dice)),
+                'AUC'  : histogram_auc(histogram)}
+
+    def end_slide(self, prob_map=None, truth_map=None):
+        """ Scores of the current slide; the counts are moved to the global counts """
+        confusion = self.slide_confusion.numpy()
+        histogram = self.slide_histogram.numpy()
+        self.confusion += confusion
+        self.histogram += histogram
+        self.slide_confusion.assign(tf.zeros_like(self.slide_confusion))
+        self.slide_histogram.assign(tf.zeros_like(self.slide_histogram))
+
+        scores = self.scores(confusion, histogram)
+        if prob_map is not None and truth_map is not None:
+            candidates, num_lesions = slide_candidates(prob_map, truth_map)
+            self.slides.append((candidates, num_lesions))
+            scores['lesions'] = num_lesions
+            scores['detected'] = len(np.unique(candidates[candidates[:, 1] > 0, 1]))
+        return scores
+
+    def result(self, allreduce=True):
+        """ Scores over all slides (of all workers, if `allreduce`) """
+        confusion, histogram, slides = self.confusion, self.histogram, self.slides
+        if allreduce and hvd.size() > 1:
+            confusion = hvd.allreduce(tf.constant(confusion), op=hvd.Sum).numpy()
+            histogram = hvd.allreduce(tf.constant(histogram), op=hvd.Sum).numpy()
+            slides = [slide for worker_slides in hvd.allgather_object(slides) for slide in worker_slides]
+
+        scores = self.scores(confusion, histogram)
+        scores['FROC'], scores['sensitivity'] = froc(slides)
+        return scores
+
+    def reset(self):
+        self.slide_confusion.assign(tf.zeros_like(self.slide_confusion))
+        self.slide_histogram.assign(tf.zeros_like(self.slide_histogram))
+        self.confusion[...] = 0
+        self.histogram[...] = 0
+        self.slides = []
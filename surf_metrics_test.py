@@ -0,0 +1,62 @@
+"""Tests for surf_metrics."""
+import unittest
+import numpy as np
+from surf_metrics import confusion_scores, froc, histogram_auc, slide_candidates
+
+
+class ConfusionScoresTest(unittest.TestCase):
+
+    def test_scores(self):
+        iou, dice = confusion_scores([[5, 1, 0], [2, 2, 0], [0, 0, 0]])
+        np.testing.assert_allclose(iou[:2], [5 / 8, 2 / 5])
+        np.testing.assert_allclose(dice[:2], [10 / 13, 4 / 7])
+        # A class absent from masks and predictions has no score
+        self.assertTrue(np.isnan(iou[2]) and np.isnan(dice[2]))
+
+
+class HistogramAucTest(unittest.TestCase):
+
+    def test_against_direct(self):
+        rng = np.random.RandomState(0)
+        num_bins = 20
+        negatives = rng.randint(0, num_bins, 300)
+        positives = np.clip(rng.randint(0, num_bins, 200) + 5, 0, num_bins - 1)
+        histogram = np.stack([np.bincount(negatives, minlength=num_bins), np.bincount(positives, minlength=num_bins)])
+        # Probability that a positive ranks above a negative, ties count half
+        direct = np.mean((positives[:, None] > negatives[None]) + 0.5 * (positives[:, None] == negatives[None]))
+        self.assertAlmostEqual(histogram_auc(histogram), direct)
+
+    def test_extremes(self):
+        self.assertAlmostEqual(histogram_auc([[3, 0, 0], [0, 0, 4]]), 1.0)
+        self.assertAlmostEqual(histogram_auc([[0, 0, 3], [4, 0, 0]]), 0.0)
+        self.assertAlmostEqual(histogram_auc([[2, 2], [1, 1]]), 0.5)
+        self.assertTrue(np.isnan(histogram_auc([[2, 2], [0, 0]])))
+
+
+class FrocTest(unittest.TestCase):
+
+    def test_slide_candidates(self):
+        prob_map = np.zeros((20, 20), np.float32)
+        prob_map[2:5, 2:5] = 0.6
+        prob_map[3, 3] = 0.9
+        prob_map[10:12, 10:12] = 0.7
+        truth_map = np.zeros((20, 20), np.uint8)
+        truth_map[2:6, 2:6] = 1
+        truth_map[15:18, 15:18] = 1
+        candidates, num_lesions = slide_candidates(prob_map, truth_map)
+        self.assertEqual(num_lesions, 2)
+        # One hit at the maximum of the first component, one false positive
+        np.testing.assert_allclose(candidates[np.argsort(candidates[:, 0])], [[0.7, 0], [0.9, 1]], rtol=1e-6)
+
+    def test_froc(self):
+        # Slide 0: two lesions, one detected at 0.9, a false positive at 0.8
+        # Slide 1: one lesion, detected twice (0.6, 0.5), a false positive at 0.95
+        slides = [(np.array([[0.9, 1], [0.8, 0]]), 2), (np.array([[0.95, 0], [0.6, 1], [0.5, 1]]), 1)]
+        score, sensitivities = froc(slides, fp_rates=(0.25, 0.5, 1))
+        self.assertEqual(sensitivities, {0.25: 0.0, 0.5: 1 / 3, 1: 2 / 3})
+        self.assertAlmostEqual(score, 1 / 3)
+        self.assertTrue(np.isnan(froc([(np.zeros((0, 2)), 0)])[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Hard example mining of the train sampler (SurfSampler with --hard_mining), see HardExampleMiner
+"""
+import numpy as np
+import os
+import time
+from glob import glob
+
+
+class HardExampleMiner():
+    """
+    - Hard example mining: the per patch training loss is recorded in a
+    difficulty heatmap per slide, of cells of `cell` x `cell` level 0 pixels
+    (the patch footprint, so a 100k x 200k slide at 1024 is a 98 x 196
+    float32 map). A slide can be registered with its own cell, e.g. with a
+    footprint that depends on its resolution.
+    The sampler draws positions with a weight of heat / mean loss, clipped to
+    [1, cap]: a hard patch is drawn at most `cap` times as often as an easy one, and every
+    position keeps being drawn.
+
+    - The heat decays with `decay` at every `refresh` (the sampler rebuilds the
+    weights of its StratifiedIndex then, see SurfSampler.record_losses), so a
+    region that became easy is drawn less again.
+
+    - The state (heatmaps and mean loss) is saved with the checkpoints
+    (`save` / `load`), one file per Horovod worker; `load` merges the files of
+    all workers, so a resumed run has the heat of every slide. Between epochs
+    the workers `merge` the `state` of all workers (the slides move between
+    workers), so the heat of a slide follows it.
+
+    >>>>Example:
+
+    miner = HardExampleMiner(cell=1024, decay=0.9, cap=4.0)
+    miner.register(slide_path, wsi.dimensions, cell=footprint)
+    miner.record([slide_path], coords, losses)
+    weights = miner.weights(slide_path, positions * mag_factor)
+    """
+    def __init__(self, cell, decay=0.9, cap=4.0, momentum=0.5):
+        self.cell = cell
+        self.decay_factor = decay
+        self.cap = cap
+        self.momentum = momentum
+        self.heatmaps = {}
+        self.cells = {}
+        self.mean_loss = 0.0
+        self.records = 0
+        self.seconds = 0.0
+
+    def register(self, slide_path, dimensions, cell=None):
+        """
+        Heatmap of a slide of level 0 (width, height) `dimensions`, of cells of
+        `cell` (default `self.cell`) level 0 pixels, kept if it exists with that cell (e.g. loaded)
+        """
+        cell = int(cell or self.cell)
+        if slide_path not in self.heatmaps or self.cells.get(slide_path, self.cell) != cell:
+            width, height = dimensions
+            self.heatmaps[slide_path] = np.zeros((-(-height // cell), -(-width // cell)), dtype=np.float32)
+            self.cells[slide_path] = cell
+
+    def record(self, slide_paths, coords, losses):
+        """ Losses of the patches at level 0 (row, column) `coords` of `slide_paths` """
+        t1 = time.perf_counter()
+        for slide_path, (y, x), loss in zip(slide_paths, coords, np.asarray(losses, dtype=np.float32)):
+            heat = self.heatmaps.get(slide_path)
+            if heat is None:
+                continue
+            cell = self.cells.get(slide_path, self.cell)
+            row, column = min(int(y) // cell, heat.shape[0] - 1), min(int(x) // cell, heat.shape[1] - 1)
+            old = heat[row, column]
+            heat[row, column] = loss if old == 0 else self.momentum * old + (1 - self.momentum) * loss
+            self.mean_loss = loss if not self.records else 0.99 * self.mean_loss + 0.01 * loss
+            self.records += 1
+        self.seconds += time.perf_counter() - t1
+
+    def decay(self):
+        for heat in self.heatmaps.values():
+            heat *= self.decay_factor
+
+    def weights(self, slide_path, coords):
+        """ Sampling weights in [1, cap] of level 0 (row, column) `coords` of a slide """
+        heat = self.heatmaps.get(slide_path)
+        if heat is None or not self.mean_loss or not len(coords):
+            return np.ones(len(coords), dtype=np.float32)
+        cell = self.cells.get(slide_path, self.cell)
+        rows = np.minimum(coords[:, 0] // cell, heat.shape[0] - 1)
+        columns = np.minimum(coords[:, 1] // cell, heat.shape[1] - 1)
+        return np.clip(heat[rows, columns] / self.mean_loss, 1.0, self.cap)
+
+    def stats(self):
+        hard = sum(int((heat > self.mean_loss).sum()) for heat in self.heatmaps.values())
+        return {'records'   : self.records,
+                'mean_loss' : round(float(self.mean_loss), 4),
+                'hard_cells': hard,
+                'seconds'   : round(self.seconds, 3)}
+
+    def state(self):
+        """ (heatmaps, cells, mean loss, records), e.g. to gather from all workers """
+        return self.heatmaps, self.cells, self.mean_loss, self.records
+
+    def merge(self, states):
+        """ Merge the `state`s of other workers (or saved ones), the hottest cell wins """
+        for heatmaps, cells, mean_loss, records in states:
+            for slide_path, heat in heatmaps.items():
+                cell = cells.get(slide_path, self.cell)
+                if (slide_path in self.heatmaps and self.heatmaps[slide_path].shape == heat.shape
+                        and self.cells.get(slide_path, self.cell) == cell):
+                    np.maximum(self.heatmaps[slide_path], heat, out=self.heatmaps[slide_path])
+                else:
+                    self.heatmaps[slide_path] = np.array(heat, dtype=np.float32)
+                    self.cells[slide_path] = cell
+            self.mean_loss = max(self.mean_loss, float(mean_loss))
+            self.records = max(self.records, int(records))
+
+    def save(self, path):
+        """ Heatmaps, their cells and mean loss to `path` (.npz), atomically """
+        tmp_path = f'{path}.tmp{os.getpid()}.npz'
+        slides = list(self.heatmaps)
+        np.savez(tmp_path, slides=np.array(slides, dtype=str), mean_loss=self.mean_loss, records=self.records,
+                 cells=np.array([self.cells.get(slide_path, self.cell) for slide_path in slides], dtype=np.int64),
+                 **{f'heat_{i}': self.heatmaps[slide_path] for i, slide_path in enumerate(slides)})
+        os.replace(tmp_path, path)
+
+    def load(self, pattern):
+        """ Merge the saved states matching `pattern` (of all workers), see `merge` """
+        paths = sorted(glob(pattern))
+        for path in paths:
+            saved = np.load(path)
+            slides = list(map(str, saved['slides']))
+            cells = saved['cells'] if 'cells' in saved.files else [self.cell] * len(slides)
+            self.merge([({slide_path: saved[f'heat_{i}'] for i, slide_path in enumerate(slides)},
+                         {slide_path: int(cell) for slide_path, cell in zip(slides, cells)},
+                         saved['mean_loss'], saved['records'])])
+        return len(paths)
@@ -0,0 +1,104 @@
+import numpy as np
+import os
+import time
+import queue
+import threading
+import cv2
+import atexit
+from PIL import Image
+
+
+class OverlayWriter():
+    """
+    - Writes the sampling overlays (overview of a WSI with the sampled patches
+    drawn on it) to PNG in a background thread, off the sampling path:
+        > `submit` only copies the overview into a bounded queue of
+          `max_queue` images, a full queue drops the write
+        > writes are coalesced to at most one per file per `interval` seconds,
+          `force=True` (e.g. when the sampler leaves a WSI) always writes
+
+    - The thread is started on the first `submit` of a process, so a sampler
+    that is forked (e.g. by the PrefetchSampler) gets its own.
+
+    - Counters through `stats()`: written, coalesced and dropped overlays.
+
+    >>>>Example:
+
+    writer = OverlayWriter(interval=60)
+    writer.submit('/path/to/logs/tumor_001.png', overview)
+    writer.close()
+    """
+    def __init__(self, interval=60, max_queue=4):
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.last_submit = {}
+        self.thread = None
+        self.pid = None
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            path, image = item
+            try:
+                tmp_path = f'{path}.tmp{os.getpid()}.png'
+                Image.fromarray(image).save(tmp_path)
+                os.replace(tmp_path, path)
+                self.written += 1
+            except Exception as e:
+                print(f"{e}, writing overlay {path}")
+
+    def _ensure_thread(self):
+        if self.pid != os.getpid():
+            self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+            atexit.register(self.close)
+
+    def submit(self, path, image, force=False):
+        """ Queue `image` (uint8, RGB or RGBA) to be written to `path`, unless written less than `interval` ago """
+        now = time.time()
+        if not force and now - self.last_submit.get(path, -np.inf) < self.interval:
+            self.coalesced += 1
+            return False
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait((path, np.array(image[..., :3], dtype=np.uint8)))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.last_submit[path] = now
+        return True
+
+    def stats(self):
+        return {'written'  : self.written,
+                'coalesced': self.coalesced,
+                'dropped'  : self.dropped}
+
+    def close(self):
+        """ Write the queued overlays and stop the thread """
+        if self.thread is not None and self.pid == os.getpid():
+            self.queue.put(None)
+            self.thread.join()
+        self.thread, self.pid = None, None
+
+
+def base_overlay(rgb_image, mask_image=None, contours=None):
+    """
+    Overview to draw the sampled patches on: the RGBA overview with the tumor
+    marked in black (the RGB overview if there is no mask), and the tissue
+    contours in green
+    """
+    if mask_image is not None:
+        overlay = np.array(rgb_image) * np.repeat((mask_image[..., :1] + 1), 4, axis=-1)
+    else:
+        overlay = np.array(rgb_image)[..., :3]
+    overlay = np.ascontiguousarray(overlay, dtype=np.uint8)
+    if contours is not None and len(contours):
+        overlay = cv2.drawContours(overlay, list(contours), -1, (0, 255, 0), 1)
+    return overlay
@@ -0,0 +1,63 @@
+"""Tests for surf_overlay."""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from surf_overlay import OverlayWriter, base_overlay
+
+
+class OverlayWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image = np.zeros((8, 8, 4), np.uint8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_coalesce_and_force(self):
+        writer = OverlayWriter(interval=3600)
+        path = os.path.join(self.tmp_dir, 'tumor_001.png')
+        self.assertTrue(writer.submit(path, self.image))
+        self.assertFalse(writer.submit(path, self.image))
+        self.assertTrue(writer.submit(path, self.image, force=True))
+        # Another file is not coalesced
+        self.assertTrue(writer.submit(os.path.join(self.tmp_dir, 'tumor_002.png'), self.image))
+        writer.close()
+        self.assertEqual(writer.stats(), {'written': 3, 'coalesced': 1, 'dropped': 0})
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['tumor_001.png', 'tumor_002.png'])
+
+    def test_queue(self):
+        writer = OverlayWriter(interval=0, max_queue=1)
+        # Without a writing thread the queue fills up
+        writer.pid = os.getpid()
+        self.assertTrue(writer.submit(os.path.join(self.tmp_dir, 'tumor_001.png'), self.image))
+        self.assertFalse(writer.submit(os.path.join(self.tmp_dir, 'tumor_002.png'), self.image))
+        self.assertEqual(writer.stats(), {'written': 0, 'coalesced': 0, 'dropped': 1})
+        # The queued overview is an RGB copy
+        self.image[...] = 255
+        path, queued = writer.queue.get_nowait()
+        self.assertEqual(path, os.path.join(self.tmp_dir, 'tumor_001.png'))
+        self.assertEqual(queued.shape, (8, 8, 3))
+        self.assertFalse(queued.any())
+
+
+class BaseOverlayTest(unittest.TestCase):
+
+    def test_tumor_and_contours(self):
+        rgb_image = np.full((8, 8, 4), 100, np.uint8)
+        mask_image = np.zeros((8, 8, 1), np.uint8)
+        mask_image[:2] = 255
+        contour = np.array([[[4, 4]], [[6, 4]], [[6, 6]], [[4, 6]]], dtype=np.int32)
+        overlay = base_overlay(rgb_image, mask_image, [contour])
+        self.assertEqual(overlay.shape, (8, 8, 4))
+        # The tumor is black (255 + 1 wraps to 0), the contour green
+        self.assertFalse(overlay[:2].any())
+        self.assertEqual(tuple(overlay[4, 4, :3]), (0, 255, 0))
+        self.assertEqual(tuple(overlay[2, 2]), (100, 100, 100, 100))
+        self.assertEqual(base_overlay(rgb_image).shape, (8, 8, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
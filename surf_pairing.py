@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import difflib
+from glob import glob
+
+
+# Label stems that name the slide stem in a group, e.g. tumor_001_mask -> tumor_001
+DEFAULT_RULES = [(r'(?P<stem>.+?)[_\-. ](mask|masks|annotation|annotations|label|labels)', '{stem}')]
+
+
+def stem(path):
+    """ Lower case file name without extension(s) """
+    return os.path.basename(path).split('.')[0].lower()
+
+
+def parse_rules(rules):
+    """
+    Pairing rules from strings 'REGEX=>TEMPLATE': a label stem that fully
+    matches REGEX pairs with the slide stem TEMPLATE.format(**groups), e.g.
+    '(?P<patient>patient_\\d+)_node_(?P<node>\\d)_.*=>{patient}_node_{node}'
+    """
+    parsed = []
+    for rule in rules or []:
+        pattern, template = rule.split('=>')
+        parsed.append((pattern.strip(), template.strip()))
+    return parsed
+
+
+def pair_paths(slides, labels, rules=(), fuzzy_cutoff=0.6):
+    """
+    - Pair every label with a slide:
+        > 'exact' : same stem (case insensitive), a dictionary lookup
+        > 'rule'  : the first of `rules` + DEFAULT_RULES that maps the label stem to a slide stem
+        > 'fuzzy' : difflib on the slides that are left, only if the digits in
+                    both stems agree (patient_010 never pairs with patient_001)
+                    and the similarity is at least `fuzzy_cutoff` (None = no fuzzy matching)
+
+    - A slide pairs with at most one label.
+
+    Returns (pairs, unmatched), pairs as (slide, label, rule) in the order of
+    `labels` and unmatched the labels without slide
+    """
+    by_stem = {}
+    for slide in slides:
+        by_stem.setdefault(stem(slide), slide)
+    used = set()
+    rules = list(rules) + DEFAULT_RULES
+    matched, leftovers = {}, []
+
+    for label in labels:
+        key = stem(label)
+        candidates = [(key, 'exact')]
+        for pattern, template in rules:
+            match = re.fullmatch(pattern, key)
+            if match:
+                candidates.append((template.format(**match.groupdict()).lower(), 'rule'))
+        for candidate, rule in candidates:
+            slide = by_stem.get(candidate)
+            if slide is not None and slide not in used:
+                matched[label] = (slide, rule)
+                used.add(slide)
+                break
+        else:
+            leftovers.append(label)
+
+    # Fuzzy fallback, only on the slides that are left
+    unmatched = []
+    digits = lambda name: re.findall(r'\d+', name)
+    for label in leftovers:
+        key = stem(label)
+        free = {stem(slide): slide for slide in slides if slide not in used and digits(stem(slide)) == digits(key)}
+        close = difflib.get_close_matches(key, list(free), n=1, cutoff=fuzzy_cutoff) if fuzzy_cutoff is not None else []
+        if close:
+            matched[label] = (free[close[0]], 'fuzzy')
+            used.add(free[close[0]])
+        else:
+            unmatched.append(label)
+
+    pairs = [(matched[label][0], label, matched[label][1]) for label in labels if label in matched]
+    return pairs, unmatched
+
+
+def save_manifest(path, entries):
+    """ Write the entries (dicts) as JSON Lines, through a temporary file """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    os.replace(tmp_path, path)
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def pair_entries(opts):
+    """ The (split, slide, label, rule) entries of the train, validation and test data of `opts` """
+    rules = parse_rules(opts.pairing_rules)
+    entries = []
+    for split, slide_path, label_path in (('train', opts.slide_path, opts.label_path),
+                                          ('validation', opts.valid_slide_path, opts.valid_label_path)):
+        if not slide_path:
+            continue
+        slides = sorted(glob(os.path.join(slide_path, f'*.{opts.slide_format}')))
+        labels = sorted(glob(os.path.join(label_path, f'*.{opts.label_format}')))
+        pairs, unmatched = pair_paths(slides, labels, rules, opts.fuzzy_cutoff)
+        for slide, label, rule in pairs:
+            entries.append({'split': split, 'slide': slide, 'label': label, 'rule': rule})
+        fuzzy = [(slide, label) for slide, label, rule in pairs if rule == 'fuzzy']
+        print(f"Paired {len(pairs)} / {len(labels)} {split} labels ({len(fuzzy)} fuzzy), {len(unmatched)} without slide")
+        for slide, label in fuzzy:
+            print(f"WARNING: fuzzy pair {os.path.basename(label)} -> {os.path.basename(slide)}")
+
+    if opts.test_path:
+        for slide in sorted(glob(os.path.join(opts.test_path, f'*.{opts.slide_format}'))):
+            entries.append({'split': 'test', 'slide': slide, 'label': None, 'rule': None})
+    return entries
+
+
+def dataset_pairs(opts):
+    """
+    - The entries of `pair_entries`. If `opts.manifest` exists it is loaded,
+    without any globbing or matching (a manifest of surf_manifest.py also
+    holds the slide metadata). Otherwise the pairs are computed and, if
+    `opts.manifest` is given, saved for later runs (delete the file when the
+    data changes).
+
+    - Call on one worker only, and broadcast the result (see SurfSampler).
+    """
+    if opts.manifest and os.path.isfile(opts.manifest):
+        return load_manifest(opts.manifest)
+
+    entries = pair_entries(opts)
+    if opts.manifest:
+        save_manifest(opts.manifest, entries)
+        print(f"Saved {len(entries)} entries to {opts.manifest}")
+    return entries
@@ -0,0 +1,65 @@
+"""Tests for surf_pairing."""
+import os
+import shutil
+import tempfile
+import unittest
+from surf_pairing import load_manifest, pair_paths, parse_rules, save_manifest, stem
+
+
+class PairPathsTest(unittest.TestCase):
+
+    def test_stem(self):
+        self.assertEqual(stem('/data/Tumor_001.tif'), 'tumor_001')
+        self.assertEqual(stem('patient_004_node_4.ome.tif'), 'patient_004_node_4')
+
+    def test_exact_and_default_rule(self):
+        slides = ['/slides/tumor_001.tif', '/slides/Tumor_002.tif', '/slides/normal_001.tif']
+        labels = ['/labels/tumor_002_mask.tif', '/labels/TUMOR_001.xml']
+        pairs, unmatched = pair_paths(slides, labels)
+        self.assertEqual(pairs, [('/slides/Tumor_002.tif', '/labels/tumor_002_mask.tif', 'rule'),
+                                 ('/slides/tumor_001.tif', '/labels/TUMOR_001.xml', 'exact')])
+        self.assertEqual(unmatched, [])
+
+    def test_custom_rule(self):
+        rules = parse_rules(['(?P<patient>patient_\\d+)_node_(?P<node>\\d)_.* => {patient}_node_{node}'])
+        self.assertEqual(rules, [('(?P<patient>patient_\\d+)_node_(?P<node>\\d)_.*', '{patient}_node_{node}')])
+        pairs, _ = pair_paths(['patient_010_node_2.tif'], ['patient_010_node_2_annotated.xml'], rules)
+        self.assertEqual(pairs, [('patient_010_node_2.tif', 'patient_010_node_2_annotated.xml', 'rule')])
+
+    def test_one_label_per_slide(self):
+        pairs, unmatched = pair_paths(['tumor_001.tif'], ['tumor_001.xml', 'tumor_001_mask.tif'], fuzzy_cutoff=None)
+        self.assertEqual(pairs, [('tumor_001.tif', 'tumor_001.xml', 'exact')])
+        self.assertEqual(unmatched, ['tumor_001_mask.tif'])
+
+    def test_fuzzy(self):
+        slides = ['patient_001.tif', 'patient_010.tif']
+        # Digits must agree: patient_01 matches neither slide
+        pairs, unmatched = pair_paths(slides, ['patient-010-tissue.xml', 'patient_01.xml'])
+        self.assertEqual(pairs, [('patient_010.tif', 'patient-010-tissue.xml', 'fuzzy')])
+        self.assertEqual(unmatched, ['patient_01.xml'])
+
+    def test_fuzzy_cutoff(self):
+        slides = ['patient_001.tif']
+        # The similarity of 'pt001' and 'patient_001' is 2 * 5 / 16 = 0.625
+        self.assertEqual(pair_paths(slides, ['pt001.xml'], fuzzy_cutoff=0.7), ([], ['pt001.xml']))
+        self.assertEqual(pair_paths(slides, ['pt001.xml'], fuzzy_cutoff=0.6), ([('patient_001.tif', 'pt001.xml', 'fuzzy')], []))
+        self.assertEqual(pair_paths(slides, ['pt001.xml'], fuzzy_cutoff=None)[1], ['pt001.xml'])
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'pairs.jsonl')
+            entries = [{'split': 'train', 'slide': 'tumor_001.tif', 'label': 'tumor_001.xml', 'rule': 'exact'},
+                       {'split': 'test', 'slide': 'test_001.tif', 'label': None, 'rule': None}]
+            save_manifest(path, entries)
+            self.assertEqual(load_manifest(path), entries)
+            self.assertEqual(os.listdir(tmp_dir), ['pairs.jsonl'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+import numpy as np
+import os
+import json
+import argparse
+import tensorflow as tf
+import horovod.tensorflow as hvd
+from numpy.lib.format import open_memmap
+
+
+class PatchWriter():
+    """
+    - Writes fixed size uint8 patches and masks to shards of at most
+    `patches_per_shard` patches in `cache_dir`, named `{prefix}_{k:05d}`:
+        {name}.patches.npy  : (count, image_size, image_size, 3) uint8
+        {name}.masks.npy    : (count, image_size, image_size, 1) uint8
+        {name}.index.npy    : (count, 4) int64 slide id, level 0 y, x, tumor (0 / 1) per patch
+
+    - A shard is written in place through a memory map, so memory stays
+    bounded by one patch. `close` returns the (name, count) of the shards.
+    """
+    def __init__(self, cache_dir, prefix, image_size, patches_per_shard=1024):
+        self.cache_dir = cache_dir
+        self.prefix = prefix
+        self.image_size = image_size
+        self.patches_per_shard = patches_per_shard
+        self.shards = []
+        self.patches = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, name, kind):
+        return os.path.join(self.cache_dir, f'{name}.{kind}.npy')
+
+    def _open(self):
+        self.name = f'{self.prefix}_{len(self.shards):05d}'
+        size, capacity = self.image_size, self.patches_per_shard
+        self.patches = open_memmap(self._path(self.name, 'patches'), mode='w+', dtype=np.uint8, shape=(capacity, size, size, 3))
+        self.masks = open_memmap(self._path(self.name, 'masks'), mode='w+', dtype=np.uint8, shape=(capacity, size, size, 1))
+        self.index = np.zeros((capacity, 4), dtype=np.int64)
+        self.count = 0
+
+    def _flush(self):
+        """ Finish the current shard, trimmed to the patches that were written """
+        for kind, array in (('patches', self.patches), ('masks', self.masks)):
+            array.flush()
+            if self.count < len(array):
+                tmp_path = f'{self._path(self.name, kind)}.tmp{os.getpid()}.npy'
+                np.save(tmp_path, array[:self.count])
+                os.replace(tmp_path, self._path(self.name, kind))
+        np.save(self._path(self.name, 'index'), self.index[:self.count])
+        self.shards.append({'name': self.name, 'count': self.count})
+        self.patches, self.masks = None, None
+
+    def add(self, patch, mask, slide_id, coords):
+        if self.patches is None:
+            self._open()
+        self.patches[self.count] = patch
+        self.masks[self.count] = mask
+        self.index[self.count] = (slide_id, coords[0], coords[1], int(mask.any()))
+        self.count += 1
+        if self.count == self.patches_per_shard:
+            self._flush()
+
+    def close(self):
+        if self.patches is not None and self.count:
+            self._flush()
+        return self.shards
+
+
+class PatchCache():
+    """
+    - Read side of a patch cache written by `extract_patches`: the shards
+    listed in `{cache_dir}/index.json` are memory mapped on first use, so a
+    patch costs a page read instead of a JPEG / JPEG2000 tile decode.
+
+    - Random access per patch (`cache[i]`, `batch(indices)`), or streaming
+    reads of whole shards (`iter_shard`). `index` holds the slide id, level 0
+    (y, x) and tumor flag of every patch, `slides` the slide paths.
+
+    >>>>Example:
+
+    cache = PatchCache(opts.patch_cache_dir)
+    patch, mask = cache[0]
+    patches, masks = cache.batch(cache.rank_indices(hvd.rank(), hvd.size())[:8])
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'index.json')) as f:
+            meta = json.load(f)
+        self.image_size = meta['image_size']
+        self.slides = meta['slides']
+        self.shards = meta['shards']
+        self.offsets = np.cumsum([0] + [shard['count'] for shard in self.shards]).astype(np.int64)
+        self.index = np.concatenate([np.load(os.path.join(cache_dir, f"{shard['name']}.index.npy")) for shard in self.shards]
+                                    or [np.zeros((0, 4), dtype=np.int64)])
+        self._arrays = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def arrays(self, k):
+        """ Memory mapped (patches, masks) of shard `k` """
+        if k not in self._arrays:
+            load = lambda kind: np.load(os.path.join(self.cache_dir, f"{self.shards[k]['name']}.{kind}.npy"), mmap_mode='r')
+            self._arrays[k] = (load('patches'), load('masks'))
+        return self._arrays[k]
+
+    def __getitem__(self, i):
+        k = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        patches, masks = self.arrays(k)
+        return patches[i - self.offsets[k]], masks[i - self.offsets[k]]
+
+    def batch(self, indices, out=None):
+        """ uint8 (patches, masks) of `indices`, read shard by shard in file order (into `out`, if given) """
+        indices = np.asarray(indices, dtype=np.int64)
+        size = self.image_size
+        if out is None:
+            out = (np.empty((len(indices), size, size, 3), dtype=np.uint8),
+                   np.empty((len(indices), size, size, 1), dtype=np.uint8))
+        patches, masks = out
+        shard_ids = np.searchsorted(self.offsets, indices, side='right') - 1
+        for k in np.unique(shard_ids):
+            rows = np.nonzero(shard_ids == k)[0]
+            rows = rows[np.argsort(indices[rows])]
+            shard_patches, shard_masks = self.arrays(int(k))
+            patches[rows] = shard_patches[indices[rows] - self.offsets[k]]
+            masks[rows] = shard_masks[indices[rows] - self.offsets[k]]
+        return patches, masks
+
+    def iter_shard(self, k, chunk=64):
+        """ Stream the (patches, masks) of shard `k` in chunks of `chunk` patches """
+        patches, masks = self.arrays(k)
+        for start in range(0, len(patches), chunk):
+            yield np.asarray(patches[start:start + chunk]), np.asarray(masks[start:start + chunk])
+
+    def rank_indices(self, rank, size):
+        """ Patch indices of a worker: whole shards if there are enough, every size'th patch otherwise """
+        if len(self.shards) >= size:
+            return np.concatenate([np.arange(self.offsets[k], self.offsets[k + 1]) for k in range(rank, len(self.shards), size)])
+        return np.arange(len(self))[rank::size]
+
+
+class PatchCacheSampler(tf.keras.utils.Sequence):
+    """
+    - Training sampler on a patch cache (`opts.patch_cache_dir`, see
+    `extract_patches`), in place of the slide reads of SurfSampler. Every
+    Horovod worker samples from its own shards of the cache.
+
+    - Batches are composed like SurfSampler: round(batch_tumor_ratio *
+    batch_size) patches with tumor, the rest from all patches. Every epoch the
+    patches are reshuffled (`on_epoch_end`).
+
+    - `__getitem__` returns the same uint8 batches as SurfSampler, in reused
+    buffers, and `as_dataset` a tf.data pipeline that normalizes them in the
+    graph (`normalize_batch`).
+
+    >>>>Example:
+
+    train_sampler = PatchCacheSampler(opts)
+    patches, masks = train_sampler.__getitem__(step)
+    """
+    def __init__(self, opts):
+        super().__init__()
+        self.mode = 'train'
+        self.opts = opts
+        assert not opts.context_levels, "WARNING: The patch cache has no context patches"
+        self.cache = PatchCache(opts.patch_cache_dir)
+        assert self.cache.image_size == opts.image_size, \
+            f"WARNING: patch cache has image size {self.cache.image_size}, not {opts.image_size}"
+        self.epoch = 0
+        self.indices = self.cache.rank_indices(hvd.rank(), hvd.size())
+        assert len(self.indices), \
+            f"WARNING: worker {hvd.rank()} has no cached patches ({len(self.cache.index)} patches in {len(self.cache.shards)} shards " \
+            f"for {hvd.size()} workers), write more patches or use fewer workers"
+        self.tumor_indices = self.indices[self.cache.index[self.indices, 3] > 0]
+        self.rng = np.random.RandomState((opts.shard_seed * 100003 + hvd.rank()) % 2**32)
+        (patch_shape, _), (mask_shape, _) = self.output_signature()
+        self.batch_patches = np.empty(patch_shape, dtype=np.uint8)
+        self.batch_masks = np.empty(mask_shape, dtype=np.uint8)
+        self._shuffle()
+        print(f"Worker {hvd.rank()}: {len(self.indices)} cached patches ({len(self.tumor_indices)} with tumor) "
+              f"of {len(self.cache.slides)} slides in {opts.patch_cache_dir}")
+
+    def _shuffle(self):
+        self.order = {'all': self.rng.permutation(self.indices), 'tumor': self.rng.permutation(self.tumor_indices)}
+        self.cursors = {'all': 0, 'tumor': 0}
+
+    def _take(self, pool, count):
+        order = self.order[pool]
+        if not len(order):
+            return self._take('all', count)
+        taken = order[np.arange(self.cursors[pool], self.cursors[pool] + count) % len(order)]
+        self.cursors[pool] = (self.cursors[pool] + count) % len(order)
+        return taken
+
+    def next_indices(self):
+        tumor_patches = round(self.opts.batch_size * self.opts.batch_tumor_ratio)
+        return np.concatenate([self._take('tumor', tumor_patches), self._take('all', self.opts.batch_size - tumor_patches)])
+
+    def __len__(self):
+        return self.opts.steps_per_epoch
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self._shuffle()
+
+    def output_signature(self):
+        """ See SurfSampler.output_signature """
+        size, batch_size = self.opts.image_size, self.opts.batch_size
+        return ((batch_size, size, size, 3), np.uint8), ((batch_size, size, size, 1), np.uint8)
+
+    def __getitem__(self, idx):
+        return self.cache.batch(self.next_indices(), out=(self.batch_patches, self.batch_masks))
+
+    def as_dataset(self):
+        """ Batches as a tf.data pipeline, see SurfSampler.as_dataset """
+        from surf_sampler import augmented_normalize
+        from surf_augment import train_augmentation
+        size, batch_size = self.opts.image_size, self.opts.batch_size
+        signature = (tf.TensorSpec((batch_size, size, size, 3), tf.uint8), tf.TensorSpec((batch_size, size, size, 1), tf.uint8))
+
+        def _batches():
+            while True:
+                yield self.cache.batch(self.next_indices())
+
+        dataset = tf.data.Dataset.from_generator(_batches, output_signature=signature)
+        dataset = dataset.map(augmented_normalize(train_augmentation(self.opts)), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        return dataset
+
+
+def add_sampler_arguments(parser):
+    """ The options SurfSampler needs for train sampling outside of a training run """
+    parser.add_argument('--slide_path', type=str, help='Folder of where the training data whole slide images are located', default=None)
+    parser.add_argument('--label_path', type=str, help='Folder of where the training data whole slide images labels are located', default=None)
+    parser.add_argument('--valid_slide_path', type=str, help='Folder of where the validation data whole slide images are located', default=None)
+    parser.add_argument('--valid_label_path', type=str, help='Folder of where the validation data whole slide images labels are located', default=None)
+    parser.add_argument('--test_path', type=str, help='Folder of where the test data whole slide images are located', default=None)
+    parser.add_argument('--slide_format', type=str, help='In which format the whole slide images are saved.', default='tif')
+    parser.add_argument('--label_format', type=str, help='In which format the labels are saved.', default='xml', choices=['tif', 'xml'])
+    parser.add_argument('--val_split', type=float, default=0.15,
+                        help='Part of images that is used as validation dataset (the same as in training, so no validation slide is cached)')
+    parser.add_argument('--bb_downsample', type=int, help='Level to use for the bounding box construction as downsampling level of whole slide image', default=7)
+    parser.add_argument('--batch_tumor_ratio', type=float, help='The ratio of the patches that is sampled from tumor contours', default=0.5)
+    parser.add_argument('--image_size', type=int, default=1024, help='Image size to use')
+    parser.add_argument('--batch_size', type=int, default=2, help='Batch size to use')
+    parser.add_argument('--steps_per_epoch', type=int, default=50000, help='Steps per epoch, sets the coordinate pool size per contour')
+    parser.add_argument('--contour_index_dir', type=str, default=None, help='Folder of the contour index (see surf_index.py)')
+    parser.add_argument('--tissue_method', type=str, default='hsv', choices=['hsv', 'otsu'], help='Tissue detection method (see surf_tissue.py)')
+    parser.add_argument('--manifest', type=str, default=None, help='JSONL dataset manifest (see surf_manifest.py), loaded instead of globbing if it exists')
+    parser.add_argument('--pairing_rules', type=str, nargs='*', default=[],
+                        help='Rules REGEX=>TEMPLATE that map a label file name to its slide file name (see surf_pairing.py)')
+    parser.add_argument('--fuzzy_cutoff', type=float, default=0.6, help='Minimum string similarity of the fuzzy pairing of leftover labels')
+    parser.add_argument('--shard_seed', type=int, default=0, help='Seed of the division of the slides over the workers')
+    parser.add_argument('--sampler_seed', type=int, default=0, help='Seed of the sampling RNG of every worker (combined with the rank)')
+    parser.add_argument('--tile_cache_mb', type=int, default=1024, help='Size in MB of the LRU cache of decoded slide tiles (see surf_tiles.py)')
+    parser.add_argument('--target_level', type=int, default=0, help='Sample patches at the magnification of this pyramid level')
+    parser.add_argument('--target_mpp', type=float, default=None, help='Sample patches at this resolution in micron per pixel (overrides --target_level)')
+    parser.add_argument('--min_tissue_fraction', type=float, default=0.5, help='Minimum tissue fraction on the overview of the footprint of a patch')
+    parser.add_argument('--min_overview_std', type=float, default=4.0, help='Minimum mean channel stddev on the overview of the footprint of a patch')
+    parser.add_argument('--log_dir', type=str, default=None, help='Folder of where the logs are saved')
+    parser.add_argument('--no_overlays', dest='overlays', action='store_false', help='Do not write the sampling overlays to --log_dir')
+    parser.add_argument('--overlay_interval', type=float, default=60, help='Write the sampling overlay of a WSI at most every X seconds')
+    parser.add_argument('--verbose', type=str, default='info', help='Verbosity of the Sampler', choices=['info', 'debug'])
+    # Train batch options of SurfSampler, not used outside of a training run
+    parser.set_defaults(stratified=False, boundary_ratio=0.0, hard_mining=False, context_levels=[], resume_sampler=False,
+                        stain_augment=False)
+    return parser
+
+
+def get_options():
+    """ Argument parsing options"""
+
+    parser = argparse.ArgumentParser(description='Extract a patch cache of the SurfSampler train slides',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_sampler_arguments(parser)
+    parser.add_argument('--patch_cache_dir', type=str, help='Folder the patch cache is written to', required=True)
+    parser.add_argument('--patches_per_slide', type=int, default=2048, help='Patches extracted per train slide')
+    parser.add_argument('--patches_per_shard', type=int, default=1024, help='Patches per shard file')
+    return parser.parse_args()
+
+
+def extract_patches(opts):
+    """
+    - Walk the ROI's of the train slides with `SurfSampler.iter_slide`
+    (the same tissue / tumor contours, coordinate pools and background
+    rejection as training) and write `opts.patches_per_slide` patches per
+    slide to a patch cache in `opts.patch_cache_dir`.
+
+    - Run with horovodrun to divide the slides over the workers: every worker
+    writes its own shards, and rank 0 writes `index.json`.
+
+    >>>>Example:
+
+    python surf_patches.py --slide_path /path/to/slides --label_path /path/to/labels --image_size 1024 --patch_cache_dir /path/to/cache
+    """
+    from surf_sampler import SurfSampler
+
+    hvd.init()
+    sampler = SurfSampler(opts, mode='train')
+    slides = [slide for slide, _ in sampler.all_train_paths]
+    writer = PatchWriter(opts.patch_cache_dir, f'rank{hvd.rank():03d}', opts.image_size, opts.patches_per_shard)
+
+    for wsi_idx, (slide_path, _) in enumerate(sampler.train_paths):
+        count = 0
+        for patch, mask, coords in sampler.iter_slide(wsi_idx, opts.patches_per_slide, with_coords=True):
+            writer.add(patch, mask, slides.index(slide_path), coords)
+            count += 1
+        print(f"Worker {hvd.rank()}: cached {count} patches of {slide_path} ({wsi_idx + 1} / {len(sampler.train_paths)})")
+
+    shards = hvd.allgather_object(writer.close())
+    if hvd.rank() == 0:
+        shards = sorted((shard for worker_shards in shards for shard in worker_shards), key=lambda shard: shard['name'])
+        with open(os.path.join(opts.patch_cache_dir, 'index.json'), 'w') as f:
+            json.dump({'image_size': opts.image_size, 'slides': slides, 'shards': shards}, f, indent=2)
+        print(f"Saved {sum(shard['count'] for shard in shards)} patches in {len(shards)} shards to {opts.patch_cache_dir}")
+
+
+if __name__ == '__main__':
+    extract_patches(get_options())
@@ -0,0 +1,69 @@
+"""Tests for surf_patches."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from surf_patches import PatchCache, PatchWriter
+
+
+class PatchCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.patches = rng.randint(0, 256, (10, 8, 8, 3)).astype(np.uint8)
+        self.masks = np.zeros((10, 8, 8, 1), np.uint8)
+        self.masks[::3, 2:4, 2:4] = 1
+        writer = PatchWriter(self.tmp_dir, 'rank000', 8, patches_per_shard=4)
+        for i, (patch, mask) in enumerate(zip(self.patches, self.masks)):
+            writer.add(patch, mask, i % 2, (100 * i, 10 * i))
+        self.shards = writer.close()
+        with open(os.path.join(self.tmp_dir, 'index.json'), 'w') as f:
+            json.dump({'image_size': 8, 'slides': ['a.tif', 'b.tif'], 'shards': self.shards}, f)
+        self.cache = PatchCache(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shards_trimmed(self):
+        self.assertEqual(self.shards, [{'name': 'rank000_00000', 'count': 4}, {'name': 'rank000_00001', 'count': 4},
+                                       {'name': 'rank000_00002', 'count': 2}])
+        # The last shard holds only the patches that were written
+        self.assertEqual(np.load(os.path.join(self.tmp_dir, 'rank000_00002.patches.npy')).shape, (2, 8, 8, 3))
+        self.assertEqual(np.load(os.path.join(self.tmp_dir, 'rank000_00002.masks.npy')).shape, (2, 8, 8, 1))
+        self.assertFalse([name for name in os.listdir(self.tmp_dir) if '.tmp' in name])
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.cache), 10)
+        for i in range(10):
+            patch, mask = self.cache[i]
+            np.testing.assert_array_equal(patch, self.patches[i])
+            np.testing.assert_array_equal(mask, self.masks[i])
+        np.testing.assert_array_equal(self.cache.index[:, :3], [(i % 2, 100 * i, 10 * i) for i in range(10)])
+        np.testing.assert_array_equal(self.cache.index[:, 3], [1, 0, 0, 1, 0, 0, 1, 0, 0, 1])
+
+    def test_batch(self):
+        indices = [9, 0, 5, 4, 5]
+        patches, masks = self.cache.batch(indices)
+        np.testing.assert_array_equal(patches, self.patches[indices])
+        np.testing.assert_array_equal(masks, self.masks[indices])
+        out = (np.empty((5, 8, 8, 3), np.uint8), np.empty((5, 8, 8, 1), np.uint8))
+        self.assertIs(self.cache.batch(indices, out=out)[0], out[0])
+        np.testing.assert_array_equal(out[0], self.patches[indices])
+
+    def test_iter_shard(self):
+        chunks = list(self.cache.iter_shard(1, chunk=3))
+        self.assertEqual([len(patches) for patches, _ in chunks], [3, 1])
+        np.testing.assert_array_equal(np.concatenate([patches for patches, _ in chunks]), self.patches[4:8])
+
+    def test_rank_indices(self):
+        # Whole shards if there are enough, every size'th patch otherwise
+        np.testing.assert_array_equal(self.cache.rank_indices(0, 2), [0, 1, 2, 3, 8, 9])
+        np.testing.assert_array_equal(self.cache.rank_indices(1, 2), [4, 5, 6, 7])
+        np.testing.assert_array_equal(self.cache.rank_indices(3, 4), [3, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import numpy as np
+import os
+import random
+import time
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import tensorflow as tf
+import horovod.tensorflow as hvd
+
+# Seconds between the liveness checks of the workers while waiting on the buffer
+PREFETCH_POLL = 10
+
+
+def _prefetch_worker(sampler, rank, worker_id, num_workers, shm, slot_views, free_slots, ready_slots):
+    """
+    - Worker process of the PrefetchSampler. Owns its own share of the slides
+    (and therefore its own OpenSlide / pyvips handles), and fills free slots
+    of the ring buffer with (patch, mask) batches.
+
+    - It is forked from the training process after TensorFlow and Horovod are
+    initialized, whose threads and device contexts are not forked: it only
+    runs the numpy / pyvips / OpenSlide path of SurfSampler.__getitem__. It
+    never runs TensorFlow ops or Horovod collectives; `hvd.rank()` in the log
+    messages of the sampler only reads the state copied at the fork.
+
+    - The workers sample one epoch of the sharding of the sampler, they are
+    restarted by PrefetchSampler.on_epoch_end.
+
+    - An exception ends the worker, its traceback is put on `ready_slots` for
+    the training process to raise (see PrefetchSampler.__getitem__).
+    """
+    # Every worker samples from its own slides, with its own RNG seeded by --sampler_seed
+    if len(sampler.train_paths) >= num_workers:
+        sampler.train_paths = sampler.train_paths[worker_id::num_workers]
+    sampler.rng = np.random.RandomState([sampler.opts.sampler_seed, rank, 0, worker_id + 1, sampler.epoch])
+    seed = sampler.rng.randint(2**31)
+    np.random.seed(seed)
+    random.seed(seed)
+
+    step = 0
+    while True:
+        slot = free_slots.get()
+        if slot is None:
+            break
+        try:
+            patches, masks = sampler.__getitem__(step)
+            patch_view, mask_view = slot_views[slot]
+            patch_view[...] = patches
+            mask_view[...] = masks
+            ready_slots.put(slot)
+        except Exception:
+            ready_slots.put((worker_id, step, traceback.format_exc()))
+            break
+        step += 1
+    return
+
+
+class PrefetchSampler(tf.keras.utils.Sequence):
+    """
+    - Prefetching mode of a (train) SurfSampler. `opts.prefetch_workers`
+    processes per Horovod rank sample batches in the background, each with its
+    own slide handles and its own share of the rank's slides.
+
+    - Ready (patch, mask) batches are written in a bounded ring buffer in
+    shared memory of `opts.prefetch_depth` slots, which the training loop
+    consumes. If the buffer is full the workers wait, so memory stays bounded to
+    `prefetch_depth` batches.
+
+    - Counters for the time the training loop had to wait on the buffer are
+    available through `stats()`:
+        > batches       : consumed batches
+        > stalls        : batches for which the training loop had to wait
+        > stall_time    : total seconds the training loop waited
+        > fill          : batches ready in the ring buffer
+
+    - Only random (train) sampling is prefetched, the validation / test samplers
+    rely on the order of `__getitem__(idx)`.
+
+    - The workers are forked and must not run TensorFlow ops or Horovod
+    collectives (see `_prefetch_worker`); the sampler of a worker is a copy,
+    so nothing is fed back to it (no hard mining). `on_epoch_end` reshards the
+    sampler of this process and restarts the workers from it, so they sample
+    the slides of the new epoch. If a worker fails or dies, `__getitem__`
+    raises its exception instead of waiting on the buffer.
+
+    >>>>Example:
+
+    train_sampler = PrefetchSampler(SurfSampler(opts, mode='train'), opts)
+    patches, masks = train_sampler.__getitem__(step)
+    print(train_sampler.stats())
+    train_sampler.close()
+
+    """
+    def __init__(self, sampler, opts):
+        super().__init__()
+        assert sampler.mode == 'train', "WARNING: Only the train sampler can be prefetched"
+        assert not opts.context_levels, "WARNING: Context patches are not prefetched, use --prefetch_workers 0"
+        assert getattr(sampler, "miner", None) is None, "WARNING: The losses of hard mining can not reach the prefetch workers, use --prefetch_workers 0"
+        self.sampler = sampler
+        self.opts = opts
+        self.num_workers = opts.prefetch_workers
+        self.depth = max(1, opts.prefetch_depth)
+
+        # One slot holds one batch of patches and masks
+        (patch_shape, patch_dtype), (mask_shape, mask_dtype) = sampler.output_signature()
+        patch_bytes = int(np.prod(patch_shape)) * np.dtype(patch_dtype).itemsize
+        mask_bytes = int(np.prod(mask_shape)) * np.dtype(mask_dtype).itemsize
+        slot_bytes = patch_bytes + mask_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=slot_bytes * self.depth)
+        self.slot_views = []
+        for slot in range(self.depth):
+            offset = slot * slot_bytes
+            self.slot_views.append((np.ndarray(patch_shape, dtype=patch_dtype, buffer=self.shm.buf, offset=offset),
+                                    np.ndarray(mask_shape, dtype=mask_dtype, buffer=self.shm.buf, offset=offset + patch_bytes)))
+
+        self.workers = []
+        self.start_workers()
+
+        self.batches = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        print(f"Worker {hvd.rank()}: prefetching with {self.num_workers} processes, "
+              f"ring buffer of {self.depth} x {slot_bytes / 2**20:.1f} MB")
+
+    def start_workers(self):
+        """ Fork the workers from the sampler of this process, with an empty ring buffer """
+        # Fork, so the workers inherit the sampler and the shared memory. The workers
+        # run no TensorFlow ops / Horovod collectives, which are not fork safe (see _prefetch_worker)
+        ctx = multiprocessing.get_context('fork')
+        self.free_slots = ctx.Queue()
+        self.ready_slots = ctx.Queue()
+        for slot in range(self.depth):
+            self.free_slots.put(slot)
+
+        for worker_id in range(self.num_workers):
+            worker = ctx.Process(target=_prefetch_worker,
+                                 args=(self.sampler, hvd.rank(), worker_id, self.num_workers, self.shm, self.slot_views,
+                                       self.free_slots, self.ready_slots),
+                                 daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop_workers(self):
+        for _ in self.workers:
+            self.free_slots.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.workers = []
+
+    def on_epoch_end(self):
+        """
+        Reshard the sampler for the next epoch (see SurfSampler.on_epoch_end)
+        and restart the workers from it, the batches prefetched for the old epoch are dropped
+        """
+        self.stop_workers()
+        self.sampler.on_epoch_end()
+        self.start_workers()
+
+    def __len__(self):
+        return self.sampler.__len__()
+
+    def __getattr__(self, name):
+        # Expose the attributes of the wrapped sampler (opts, mode, wsi_idx, ...)
+        if name == 'sampler':
+            raise AttributeError(name)
+        return getattr(self.sampler, name)
+
+    def next_slot(self):
+        """ The next ready slot, waits while the workers are alive and raises the exception of a failed worker """
+        try:
+            slot = self.ready_slots.get_nowait()
+        except queue.Empty:
+            t1 = time.time()
+            while True:
+                try:
+                    slot = self.ready_slots.get(timeout=PREFETCH_POLL)
+                    break
+                except queue.Empty:
+                    dead = [(worker_id, worker.exitcode) for worker_id, worker in enumerate(self.workers) if not worker.is_alive()]
+                    if dead:
+                        raise RuntimeError(f"Worker {hvd.rank()}: prefetch workers (id, exitcode) {dead} died")
+            self.stall_time += time.time() - t1
+            self.stalls += 1
+        if isinstance(slot, tuple):
+            worker_id, step, error = slot
+            raise RuntimeError(f"Worker {hvd.rank()}: prefetch worker {worker_id} failed at step {step}:\n{error}")
+        return slot
+
+    def __getitem__(self, idx):
+        slot = self.next_slot()
+
+        # Copy out, so the slot can be refilled right away
+        patch_view, mask_view = self.slot_views[slot]
+        patches, masks = np.array(patch_view), np.array(mask_view)
+        self.free_slots.put(slot)
+        self.batches += 1
+        return patches, masks
+
+    def stats(self):
+        try:
+            fill = self.ready_slots.qsize()
+        except NotImplementedError:
+            # qsize is not implemented on macOS
+            fill = -1
+        return {'batches'   : self.batches,
+                'stalls'    : self.stalls,
+                'stall_time': self.stall_time,
+                'fill'      : fill}
+
+    def close(self):
+        self.stop_workers()
+        self.slot_views = []
+        self.shm.close()
+        self.shm.unlink()
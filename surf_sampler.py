@@ -1,17 +1,13 @@
 import numpy as np
 from glob import glob
 import os
-from sklearn.utils import shuffle
-from PIL import Image, ImageStat, ImageDraw, ImageFont
 import tensorflow as tf
 import horovod.tensorflow as hvd
 import pdb
 import pyvips
 import cv2
 import sys
-import random
 import time
-import difflib
 import itertools
 from openslide import OpenSlide, ImageSlide, OpenSlideUnsupportedFormatError
 import logging
@@ -23,7 +19,18 @@ import os
 import math
 import xml.etree.ElementTree as ET
 import numpy as np
-import PIL.Image
+from surf_index import ContourIndex
+from surf_annotations import PolygonMask
+from surf_coords import CoordinatePool, foreground_mask, patch_stddev, MIN_PATCH_STD
+from surf_sharding import slide_work, plan_shards, shard_report
+from surf_pairing import dataset_pairs, pair_paths
+from surf_tiles import tile_cache
+from surf_overlay import OverlayWriter, base_overlay
+from surf_tissue import tissue_params, slide_tissue_contours
+from surf_staging import slide_resolution
+from surf_strata import slide_strata, StratifiedIndex
+from surf_mining import HardExampleMiner
+from surf_augment import train_augmentation
 
 
 sys.path.insert(0, '$PROJECT_DIR/xml-pathology')
@@ -56,34 +63,113 @@ dtype_to_format = {
     'complex128': 'dpcomplex',
 }
 
+def slide_overview(wsi, mask, level):
+    """
+    Read the RGBA overview of an OpenSlide `wsi` at `level`, and the tumor mask
+    at the same size. `mask` is either a PolygonMask (xml labels), an
+    OpenSlide (tif labels) or None (no labels)
+    """
+    rgb_image = np.array(wsi.read_region((0, 0), level, wsi.level_dimensions[level]))
+    if mask is None:
+        mask_image = None
+    elif isinstance(mask, PolygonMask):
+        mask_image = mask.overview(wsi.level_dimensions[level])
+    else:
+        mask_image = np.array(mask.read_region((0, 0), level, wsi.level_dimensions[level]))
+    return rgb_image, mask_image
+
+
+def tumor_contours(mask_image):
+    """ Contours of the tumor in an overview mask """
+    contours, _ = cv2.findContours(np.ascontiguousarray(mask_image[..., 0]), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return list(contours)
+
+
+def normalize_batch(patches, masks):
+    """
+    uint8 patches to float32 in [-1,1], and uint8 class index masks (0 = no
+    tumor) to float32 one - hot, in the graph. Works on batches and on single
+    patches, so the uint8 arrays of the samplers are what is transferred, and
+    the conversion runs on the device (or in the map of a tf.data pipeline).
+    `patches` can be a (patches, contexts) pair, see SurfSampler.read_contexts
+    """
+    patches = tf.nest.map_structure(lambda patch: 2.0 * tf.cast(patch, tf.float32) / 255.0 - 1.0, patches)
+    masks = tf.one_hot(tf.cast(masks[..., 0] > 0, tf.int32), 2, dtype=tf.float32)
+    return patches, masks
+
+
+def augmented_normalize(augment=None):
+    """ `normalize_batch` of uint8 batches, after the `augment` of surf_augment.py (if any), as one map function """
+    if augment is None:
+        return normalize_batch
+    return lambda patches, masks: normalize_batch(*augment(patches, masks))
+
+
+def batch_dataset(sampler, augment=None):
+    """
+    - The uint8 batches of `sampler.__getitem__` (SurfSampler, PrefetchSampler,
+    PatchCacheSampler) as a tf.data pipeline, normalized with `normalize_batch`,
+    e.g. for keras `fit` in place of the Sequence. `augment` (see
+    surf_augment.py) runs on the uint8 batches, in the same map.
+
+    - The samplers reuse their batch buffers, so every batch is copied once
+    (in uint8) before it is handed to tf.data, which prefetches ahead.
+
+    - keras does not call `on_epoch_end` of a dataset, so the generator calls
+    `sampler.on_epoch_end()` after every `len(sampler)` batches (the steps of
+    an epoch), in its own thread, so it never runs during a `__getitem__`.
+    The sampler is only used by this generator then: take samples for
+    callbacks before `fit`, or from another sampler.
+    """
+    def _spec(signature):
+        # A (shape, dtype) pair, or a tuple of them
+        if isinstance(signature[0][0], (int, np.integer)):
+            return tf.TensorSpec(signature[0], tf.as_dtype(signature[1]))
+        return tuple(_spec(s) for s in signature)
+    signature = _spec(sampler.output_signature())
+
+    def _batches():
+        steps_per_epoch = len(sampler)
+        for step in itertools.count():
+            if step and step % steps_per_epoch == 0:
+                # Reshard the slides (SurfSampler) / reshuffle the patches (PatchCacheSampler)
+                sampler.on_epoch_end()
+            yield tf.nest.map_structure(np.array, sampler.__getitem__(step % steps_per_epoch))
+
+    dataset = tf.data.Dataset.from_generator(_batches, output_signature=signature)
+    dataset = dataset.map(augmented_normalize(augment), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset
+
 
 class PreProcess():
     def __init__(self,opts):
         self.opts = opts
 
     def _load(image,mask,augment=False):
+        """ Normalized (image, one - hot mask) of uint8 sampler output, see normalize_batch """
         if augment:
-            img = tf.image.random_brightness(image, max_delta=50.)
+            img = tf.cast(image, tf.float32)
+            img = tf.image.random_brightness(img, max_delta=50.)
             img = tf.image.random_saturation(img, lower=0.5, upper=1.5)
             img = tf.image.random_hue(img, max_delta=0.2)
             img = tf.image.random_contrast(img, lower=0.5, upper=1.5)
-        else:
-            # img = tf.clip_by_value(img, 0, 2)
-            # img = tf.math.divide(image, 255)
-            img = image
-            img = tf.math.subtract(tf.math.multiply(2.0, img), 1.0)
-
-        mask = tf.clip_by_value(tf.cast(mask,tf.int32), 0, 1)
-
-        return img,mask
-
-    def tfdataset(self,x,y):
-        dataset = tf.data.Dataset.from_tensor_slices((x,y))
-        dataset = dataset.apply(tf.data.experimental.map_and_batch(
-            map_func=lambda im, msk: PreProcess._load(im,msk,augment=False),
-            batch_size=self.opts.batch_size,
-            num_parallel_calls=tf.data.experimental.AUTOTUNE,
-            drop_remainder=True))
+            image = tf.clip_by_value(img, 0.0, 255.0)
+
+        return normalize_batch(image, mask)
+
+    def tfdataset(self,x,y,augment=False):
+        """
+        A uint8 batch of a sampler, normalized in one map over the whole batch.
+        With `augment` (train batches) and opts.stain_augment, stain augmented
+        on the uint8 batch first (see surf_augment.py)
+        """
+        augmentation = train_augmentation(self.opts) if augment else None
+        dataset = tf.data.Dataset.from_tensors((x,y))
+        if augmentation is not None:
+            dataset = dataset.map(augmentation, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.map(lambda im, msk: PreProcess._load(im,msk,augment=False),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
         dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
 
         return dataset
@@ -110,7 +196,11 @@ class SurfSampler(tf.keras.utils.Sequence):
                         ...
 
 
-    !! Label and WSI's are matched on string similarity (https://docs.python.org/3/library/difflib.html -> difflib.get_close_matches() )
+    !! Labels and WSI's are paired on their file name (see surf_pairing.py): same name,
+    then `opts.pairing_rules` and e.g. tumor_001_mask -> tumor_001, then string similarity
+    for the leftovers. The pairs are saved to / loaded from `opts.manifest`, which
+    can also hold the slide metadata (see surf_manifest.py), so startup does not
+    glob, stat or open any slide
 
     - It samples a batch according to `opts.batch_size`, with the batch
     consisting of patches that contain tumor and non - tumor, based on
@@ -118,6 +208,12 @@ class SurfSampler(tf.keras.utils.Sequence):
 
     - It samples out of contours made with OpenCV thresholding
 
+    - `__getitem__` returns a uint8 batch of (batch_size, image_size, image_size, 3)
+    patches and (batch_size, image_size, image_size, 1) class index masks
+    (0 = no tumor), written in place in buffers that are reused by the next
+    call. Normalization and one - hot encoding happen in the graph, with
+    `normalize_batch` (or `batch_dataset` / `as_dataset` for tf.data)
+
     - Furthermore it contains a hard-coded standard deviation threshold, which
     can discard patches if not above some stddev. This is to avoid sampling
     patches that are background. From experience on CAMELYON16/17 this works
@@ -144,33 +240,19 @@ class SurfSampler(tf.keras.utils.Sequence):
         super().__init__()
         self.mode = mode.lower()
 
-        # Get list of paths
-        slides = sorted(glob(os.path.join(opts.slide_path,f'*.{opts.slide_format}')))
-        labels = sorted(glob(os.path.join(opts.label_path,f'*.{opts.label_format}')))
-        
-        # Match labels to slides (all slides must have labels)
-        # self.train_paths = shuffle([(difflib.get_close_matches(label.split('/')[-1].split('.')[-2],slides,n=1,cutoff=0.1)[0],label) for label in labels])
-        self.train_paths = [(difflib.get_close_matches(label.split('/')[-1].split('.')[-2],slides,n=1,cutoff=0.1)[0],label) for label in labels]
-        
-        # Custom path removal for Camelyon 17
-        if opts.slide_path.find('CAMELYON17') > 0:
-            _del = []
-            for data in self.train_paths:
-                if data[0].split('/')[-1].split('.')[-2] != data[1].split('/')[-1].split('.')[-2]:
-                    _del.append(data)
+        # Pair labels to slides on rank 0 (or load the manifest), and share the pairs (see surf_pairing.py)
+        entries = dataset_pairs(opts) if hvd.rank() == 0 else None
+        entries = hvd.broadcast_object(entries, root_rank=0)
+        split_paths = lambda split: [(entry['slide'], entry['label']) for entry in entries if entry['split'] == split]
+        # Slide metadata of a manifest of surf_manifest.py (empty for a pairs only manifest)
+        self.metadata = {entry['slide']: entry for entry in entries if 'size' in entry}
 
-            self.train_paths = [data for data in self.train_paths if data not in _del]
-        
-        
+        self.train_paths = split_paths('train')
         if hvd.rank() == 0 : print(f"\nFound {len(self.train_paths)} slides")
         
         # Get validation data
         if opts.valid_slide_path:
-            valid_slides = glob(os.path.join(opts.valid_slide_path, f'*.{opts.slide_format}'))
-            valid_labels = glob(os.path.join(opts.valid_label_path, f'*.{opts.label_format}'))
-
-            # Match labels to slides (all slides must have labels)
-            self.valid_paths = [(difflib.get_close_matches(label.split('/')[-1],valid_slides,n=1,cutoff=0.1)[0],label) for label in valid_labels]
+            self.valid_paths = split_paths('validation')
         else:
             val_split = int(len(self.train_paths) * (1-opts.val_split))
             val_split = min(len(self.train_paths)-1,val_split)
@@ -181,7 +263,7 @@ class SurfSampler(tf.keras.utils.Sequence):
         
         # Get test data
         if opts.test_path:
-            self.test_paths = glob(os.path.join(opts.test_path,f'*.{opts.slide_format}'))
+            self.test_paths = [slide for slide, _ in split_paths('test')]
         elif mode == 'test' and not opts.test_path:
             self.test_paths = self.valid_paths
         else:
@@ -198,39 +280,107 @@ class SurfSampler(tf.keras.utils.Sequence):
         self.contours_valid = []
         self.contours_test  = []
         self.contours_tumor = []
-        self.pixelpoints    = []
+        self.pools          = {}
         self.save_data      = []
         self.mag_factor     = pow(2, self.opts.bb_downsample)
         self.cnt            = 0
         self.wsi_idx        = 0
+        # Seeded per worker and mode, so the sampling position can be saved and resumed (see save_state)
+        self.rng            = np.random.RandomState([opts.sampler_seed, hvd.rank(), ('train', 'validation', 'test').index(self.mode)])
+        self.overlay        = None
+        self.overlay_slide  = None
+        # Pyramid downsamples and resolution per slide / tif label (see slide_info)
+        self.slide_infos    = {}
         
-        self.train_paths = self.train_paths * hvd.size() * 4
-        assert hvd.size() <= len(self.train_paths), f"WARNING: {hvd.size()} workers will share {len(self.train_paths)} train images"
-        trainims     = len(self.train_paths)
-        train_per_worker     = trainims // hvd.size()
-        print(f"Worker {hvd.rank()}: len = {len(self.train_paths)}")
-        self.train_paths = self.train_paths[hvd.rank()*train_per_worker:(hvd.rank()+1)*train_per_worker]
-        print(f"Worker {hvd.rank()}: AFTER len = {len(self.train_paths)}")     
+        # Batches are written in place in uint8 buffers, reused by every __getitem__ (see normalize_batch)
+        size, batch_size    = opts.image_size, opts.batch_size
+        self.batch_patches  = np.zeros((batch_size, size, size, 3), dtype=np.uint8)
+        self.batch_masks    = np.zeros((batch_size, size, size, 1), dtype=np.uint8)
+        # Context patches of opts.context_levels, centred on the patches (see read_contexts)
+        if opts.context_levels:
+            self.batch_contexts = np.full((batch_size, len(opts.context_levels), size, size, 3), 255, dtype=np.uint8)
+        
+        # Background rejection on the overview (see overview_foreground), and the
+        # level 0 fetches of which the patch turned out to be background anyway
+        self.foreground   = None
+        self.fetch_counts = {'fetches': 0, 'background': 0}
+        
+        # Stratified train sampling over all train WSI's of the worker (see surf_strata.py)
+        self.strata           = {}
+        self.label_masks      = {}
+        self.stratified_index = None
+        self.batch_origin     = None
+        self.mined_batches    = 0
+        
+        # Hard example mining: the losses of the stratified batches weigh the next draws (see surf_mining.py)
+        if getattr(opts, 'hard_mining', False) and self.mode == 'train':
+            self.miner = HardExampleMiner(opts.image_size, opts.mining_decay, opts.mining_cap)
+            if opts.log_dir and self.miner.load(os.path.join(opts.log_dir, 'hard_mining_*.npz')):
+                print(f"Worker {hvd.rank()}: resumed hard mining {self.miner.stats()}")
+        else:
+            self.miner = None
+        
+        # Sampling overlays are written in a background thread, at most every opts.overlay_interval seconds per WSI
+        if opts.overlays and opts.log_dir:
+            self.overlay_writer = OverlayWriter(opts.overlay_interval)
+        else:
+            self.overlay_writer = None
+        
+        # Persistent tissue / tumor contours per WSI (see surf_index.py)
+        if opts.contour_index_dir:
+            self.contour_index = ContourIndex(opts.contour_index_dir, opts.bb_downsample, tissue_params(opts.tissue_method))
+            for entry in self.metadata.values():
+                self.contour_index.mtimes[entry['slide']] = entry['mtime']
+                if entry['label'] and entry['label_mtime'] is not None:
+                    self.contour_index.mtimes[entry['label']] = entry['label_mtime']
+        else:
+            self.contour_index = None
+        
+        # Divide the slides over the workers, balanced by tissue area (see surf_sharding.py)
+        self.epoch           = 0
+        self.all_train_paths = self.train_paths
+        self.train_work      = slide_work(self.all_train_paths, self.contour_index, self.metadata)
+        self.train_paths     = self.shard_paths(self.all_train_paths, 'train', work=self.train_work)
 
          # Make sure that every process has at least 1 WSI
         if opts.test_path:
-             self.test_paths  = self.test_paths
-             assert hvd.size() <= len(self.test_paths), f"WARNING: {hvd.size()} workers will share {len(self.test_paths)} {mode} images"
-             testims     = len(self.test_paths)
-             test_per_worker     = testims // hvd.size()
-             print(f"Worker {hvd.rank()}: len = {len(self.test_paths)}")
-             self.test_paths = self.test_paths[hvd.rank()*test_per_worker:(hvd.rank()+1)*test_per_worker]
-             print(f"Worker {hvd.rank()}: AFTER len = {len(self.test_paths)}")
+            self.test_paths  = self.shard_paths(self.test_paths, 'test')
         else:
-            self.valid_paths = self.valid_paths * hvd.size() * 4
-            assert hvd.size() <= len(self.valid_paths), f"WARNING: {hvd.size()} workers will share {len(self.valid_paths)} {mode} images"
-            validims    = len(self.valid_paths)
-            valid_per_worker    = validims // hvd.size()
-            print(f"Worker {hvd.rank()}: len = {len(self.valid_paths)} Validation")
-            self.valid_paths = self.valid_paths[hvd.rank()*valid_per_worker:(hvd.rank()+1)*valid_per_worker]
-            print(f"Worker {hvd.rank()}: AFTER len = {len(self.valid_paths)} Validation")
-
+            self.valid_paths = self.shard_paths(self.valid_paths, 'validation')
         
+        # Continue where a preempted run stopped (see save_state)
+        self.resume      = None
+        self.resume_step = 0
+        if self.mode == 'train' and opts.resume_sampler and opts.log_dir:
+            self.load_state()
+
+    def shard_paths(self, paths, name, epoch=0, work=None):
+        """ The share of `paths` of this worker, of a plan balanced by the expected work per slide """
+        if work is None:
+            work = slide_work(paths, self.contour_index, self.metadata)
+        shards, loads = plan_shards(work, hvd.size(), seed=self.opts.shard_seed, epoch=epoch)
+        if hvd.rank() == 0:
+            print(f"Worker {hvd.rank()}: {name} epoch {epoch}, {len(paths)} slides, {shard_report(loads)}")
+        print(f"Worker {hvd.rank()}: {len(shards[hvd.rank()])} {name} slides, expected work {loads[hvd.rank()]:.3g}")
+        return [paths[i] for i in shards[hvd.rank()]]
+
+    def on_epoch_end(self):
+        """ Rebalance the train slides over the workers for the next epoch """
+        self.epoch += 1
+        if self.mode == 'train':
+            if self.miner is not None:
+                # The slides move to other workers, which need their heat
+                t1 = time.perf_counter()
+                self.miner.merge(hvd.allgather_object(self.miner.state()))
+                self.miner.seconds += time.perf_counter() - t1
+            # The open WSI may move to another worker: release it, so the next batch starts at the first slide of the new shard
+            if self.contours_train:
+                self.release_wsi()
+            self.train_paths = self.shard_paths(self.all_train_paths, 'train', epoch=self.epoch, work=self.train_work)
+            self.wsi_idx = 0
+            # Rebuilt from the cached strata of the slides on the first stratified batch
+            self.stratified_index = None
+
     def __len__(self):
         # if self.train:
         #     return math.ceil(len(self.train_paths) / self.opts.batch_size)
@@ -240,29 +390,408 @@ class SurfSampler(tf.keras.utils.Sequence):
         #     return math.ceil(len(self.test_paths) / self.opts.batch_size)
 
         return self.opts.steps_per_epoch
+    
+    def output_signature(self):
+        """
+        ((shape, dtype) of the uint8 patches, (shape, dtype) of the uint8 class
+        index masks) of a batch. With opts.context_levels the patches are a
+        pair of (shape, dtype) of the patches and of the contexts
+        """
+        size, batch_size = self.opts.image_size, self.opts.batch_size
+        patches = ((batch_size, size, size, 3), np.uint8)
+        if self.opts.context_levels:
+            patches = (patches, ((batch_size, len(self.opts.context_levels), size, size, 3), np.uint8))
+        return patches, ((batch_size, size, size, 1), np.uint8)
+        
+    @staticmethod
+    def match_paths(slides, labels, rules=(), fuzzy_cutoff=0.6):
+        """ (slide, label) pairs of the labels with a slide, see surf_pairing.pair_paths """
+        pairs, _ = pair_paths(slides, labels, rules, fuzzy_cutoff)
+        return [(slide, label) for slide, label, _ in pairs]
+    
+    def write_overlay(self, force=False):
+        """ Queue the overlay of the current WSI for writing to opts.log_dir """
+        if self.overlay_writer is None or self.overlay is None:
+            return
+        path = os.path.join(self.opts.log_dir, self.overlay_slide.split('/')[-1].replace(self.opts.slide_format, 'png'))
+        self.overlay_writer.submit(path, self.overlay, force=force)
+    
+    def open_region(self, path, level=0):
+        """
+        (image, region) of a slide or tif mask at pyramid `level`: a CachedSlide
+        of the tile cache of this process (see surf_tiles.py) with
+        `opts.tile_cache_mb`, which is both, or pyvips handles otherwise
+        """
+        if self.opts.tile_cache_mb:
+            slide = tile_cache(self.opts.tile_cache_mb).slide(path, level)
+            return slide, slide
+        image = pyvips.Image.new_from_file(path, level=level) if level else pyvips.Image.new_from_file(path)
+        return image, pyvips.Region.new(image)
+    
+    def slide_info(self, path):
+        """ {'level_downsamples', 'mpp'} of a slide or tif label, from the manifest or else read once with OpenSlide """
+        if path not in self.slide_infos:
+            if path in self.metadata:
+                entry = self.metadata[path]
+                self.slide_infos[path] = {'level_downsamples': entry['level_downsamples'], 'mpp': entry['mpp']}
+            else:
+                slide = OpenSlide(path)
+                try:
+                    mpp = slide_resolution(slide)
+                except (KeyError, ValueError, ZeroDivisionError):
+                    mpp = None
+                self.slide_infos[path] = {'level_downsamples': [float(d) for d in slide.level_downsamples], 'mpp': mpp}
+                slide.close()
+        return self.slide_infos[path]
+    
+    def level_downsample(self, slide_path, level):
+        """ Downsample of pyramid `level` of a slide """
+        downsamples = self.slide_info(slide_path)['level_downsamples']
+        return downsamples[min(level, len(downsamples) - 1)]
+    
+    def target_downsample(self, slide_path):
+        """
+        Level 0 pixels per patch pixel of a slide: opts.target_mpp / the mpp of
+        the slide (never below 1) if given, else the downsample of opts.target_level
+        """
+        if self.opts.target_mpp:
+            mpp = self.slide_info(slide_path)['mpp']
+            if mpp:
+                return max(1.0, self.opts.target_mpp / mpp)
+            print(f"WARNING: {slide_path} has no resolution, sampled at --target_level {self.opts.target_level}")
+        return self.level_downsample(slide_path, self.opts.target_level) if self.opts.target_level else 1.0
+    
+    def footprint(self, slide_path):
+        """ Size in level 0 pixels of a patch of a slide """
+        return int(round(self.opts.image_size * self.target_downsample(slide_path)))
+    
+    def overview_foreground(self, entry, slide_path):
+        """
+        Positions of the overview of a slide (an entry of `slide_contours`) of
+        which the patch footprint is not background, see surf_coords.foreground_mask.
+        None with --min_tissue_fraction and --min_overview_std 0
+        """
+        if self.opts.min_tissue_fraction <= 0 and self.opts.min_overview_std <= 0:
+            return None
+        return foreground_mask(entry['overview'], entry['contours'], self.footprint(slide_path) / self.mag_factor,
+                               self.opts.min_tissue_fraction, self.opts.min_overview_std)
+    
+    def count_fetch(self, patch):
+        """ Counts a level 0 fetch, and returns whether its patch is background (stddev below MIN_PATCH_STD) """
+        background = patch_stddev(patch) < MIN_PATCH_STD
+        self.fetch_counts['fetches'] += 1
+        self.fetch_counts['background'] += int(background)
+        return background
+    
+    def fetch_stats(self):
+        fetches, background = self.fetch_counts['fetches'], self.fetch_counts['background']
+        return f"{background} / {fetches} fetches background ({100 * background / max(fetches, 1):.1f}%)"
+    
+    def read_patch(self, path, x_topleft, y_topleft, handles, slide_path=None, mask=False):
+        """
+        - uint8 (image_size, image_size, bands) patch of a slide, or of its
+        label with `mask` (`slide_path` is then the slide), with its top left
+        at level 0 (x_topleft, y_topleft), at the magnification of
+        opts.target_mpp / opts.target_level.
+
+        - It is read from the nearest pyramid level that is not coarser than
+        the target (pyvips `level=`, through the tile cache), and only resized
+        for the rest: INTER_AREA, or INTER_NEAREST for masks. A PolygonMask is
+        rasterized at the target directly. At level 0 it is a fetch of the
+        level 0 `handles` (image, region).
+        """
+        size = self.opts.image_size
+        downsample = self.target_downsample(slide_path or path)
+        image, region = handles
+        if isinstance(image, PolygonMask):
+            read, level_downsample = int(round(size * downsample)), 1.0
+            patch = image.window(int(x_topleft), int(y_topleft), read, read, downsample)[..., None]
+        else:
+            level = 0
+            if downsample > 1:
+                # The coarsest level at or below the target (with some slack for rounding of the downsamples)
+                downsamples = self.slide_info(path)['level_downsamples']
+                level = max(i for i, d in enumerate(downsamples) if d <= downsample * 1.01 or i == 0)
+                if level:
+                    image, region = self.open_region(path, level)
+            level_downsample = self.level_downsample(path, level) if level else 1.0
+            read = int(round(size * downsample / level_downsample))
+            patch = region.fetch(int(x_topleft // level_downsample), int(y_topleft // level_downsample), read, read)
+            patch = np.ndarray((read, read, image.get('bands')), buffer=patch, dtype=np.uint8)
+        if patch.shape[0] != size:
+            bands = patch.shape[2]
+            patch = cv2.resize(patch, (size, size), interpolation=cv2.INTER_NEAREST if mask else cv2.INTER_AREA).reshape(size, size, bands)
+        return patch
+    
+    def read_contexts(self, i, slide_path, x_topleft, y_topleft):
+        """
+        - Writes the context patches of patch `i` of the batch to
+        `self.batch_contexts[i]`: an image_size crop of every level of
+        `opts.context_levels`, centred on the patch at level 0 (x_topleft,
+        y_topleft), read from that pyramid level, so a context of 4 x 4 patches
+        (level 2) decodes 1 / 16 of the level 0 pixels.
+
+        - The crop keeps its centre at the border of the slide, the part
+        outside the slide is white (255).
+        """
+        size, footprint = self.opts.image_size, self.footprint(slide_path)
+        for k, level in enumerate(self.opts.context_levels):
+            context = self.batch_contexts[i, k]
+            context[...] = 255
+            try:
+                image, region = self.open_region(slide_path, level)
+                downsample = self.level_downsample(slide_path, level)
+                x = int(round((x_topleft + footprint / 2) / downsample - size / 2))
+                y = int(round((y_topleft + footprint / 2) / downsample - size / 2))
+                # The part of the crop inside the level
+                x0, y0 = max(x, 0), max(y, 0)
+                x1, y1 = min(x + size, image.width), min(y + size, image.height)
+                if x1 > x0 and y1 > y0:
+                    crop = region.fetch(x0, y0, x1 - x0, y1 - y0)
+                    context[y0 - y:y1 - y, x0 - x:x1 - x] = np.ndarray((y1 - y0, x1 - x0, image.get('bands')), buffer=crop, dtype=np.uint8)[..., :3]
+            except Exception as e:
+                print(f"Exception in extracting context at level {level}: ", e)
+    
+    def batch_output(self, patches, masks):
+        """ (patches, masks), or ((patches, contexts), masks) with opts.context_levels """
+        if self.opts.context_levels:
+            return (patches, self.batch_contexts), masks
+        return patches, masks
+    
+    def label_region(self, label_path):
+        """ (image, region) of a label: the PolygonMask of an xml label, see open_region otherwise """
+        if label_path in self.label_masks:
+            return self.label_masks[label_path], self.label_masks[label_path]
+        return self.open_region(label_path)
+    
+    def build_strata(self):
+        """
+        - StratifiedIndex of the train WSI's of this worker. The candidate
+        positions of every WSI are labelled tumor / boundary / normal once
+        (from the contour index, if any), and kept for the next epochs.
+        """
+        for slide_path, label_path in self.train_paths:
+            if slide_path in self.strata:
+                continue
+            try:
+                wsi = OpenSlide(slide_path)
+                if self.opts.label_format.find('xml') > -1:
+                    mask = PolygonMask.from_xml(label_path, wsi.dimensions)
+                    self.label_masks[label_path] = mask
+                else:
+                    mask = OpenSlide(label_path)
+                entry = self.slide_contours(wsi, mask, slide_path, label_path)
+                self.strata[slide_path] = slide_strata(entry['contours'], entry['mask'], entry['overview'].shape,
+                                                       self.mag_factor, self.footprint(slide_path), wsi.dimensions,
+                                                       foreground=self.overview_foreground(entry, slide_path))
+                if self.miner is not None:
+                    self.miner.register(slide_path, wsi.dimensions, cell=self.footprint(slide_path))
+                wsi.close()
+                mask.close()
+            except Exception as e:
+                print(f"{e}, at {slide_path}")
+                self.strata[slide_path] = (np.zeros((0, 2), dtype=np.int32), np.zeros(0, dtype=np.uint8))
         
+        self.index_strata()
+        print(f"Worker {hvd.rank()}: candidate patch positions of {len(self.train_paths)} train slides {self.stratified_index.counts()}")
+    
+    def index_strata(self):
+        """ StratifiedIndex of the strata of the train WSI's, weighted by their difficulty with hard mining """
+        entries = [self.strata[slide_path] for slide_path, _ in self.train_paths]
+        weights = None
+        if self.miner is not None:
+            weights = [self.miner.weights(slide_path, positions.astype(np.int64) * self.mag_factor)
+                       for (slide_path, _), (positions, _) in zip(self.train_paths, entries)]
+        self.stratified_index = StratifiedIndex(entries, self.mag_factor, rng=self.rng, weights=weights)
+    
+    def record_losses(self, losses):
+        """
+        - Hard mining: record the per patch `losses` of the last stratified
+        batch. Every `opts.mining_refresh` batches the heat decays and the
+        draws are reweighted.
+        """
+        if self.miner is None or self.batch_origin is None:
+            return
+        slides, coords = self.batch_origin
+        self.miner.record([self.train_paths[wsi_idx][0] for wsi_idx in slides], coords, losses)
+        self.batch_origin = None
+        self.mined_batches += 1
+        if self.mined_batches % self.opts.mining_refresh == 0:
+            t1 = time.perf_counter()
+            self.miner.decay()
+            self.index_strata()
+            self.miner.seconds += time.perf_counter() - t1
+    
+    def save_mining(self):
+        """ Save the hard mining state of this worker to opts.log_dir, next to the checkpoints """
+        if self.miner is not None and self.opts.log_dir:
+            self.miner.save(os.path.join(self.opts.log_dir, f'hard_mining_{hvd.rank():03d}.npz'))
+    
+    def state_path(self):
+        return os.path.join(self.opts.log_dir, f'sampler_state_{hvd.rank():03d}.npz')
+    
+    def save_state(self, step):
+        """
+        - Saves the sampling position of this (train) worker to opts.log_dir,
+        next to the checkpoints: the state of its RNG, the epoch, the current
+        WSI and contour, and the coordinate pools of the WSI with their
+        cursors. `step` is the step of the training loop of the next batch.
+        Written atomically, one file per Horovod worker.
+
+        - The slide order of an epoch follows from the epoch (see
+        surf_sharding.py), so it is not saved, only checked on load.
+        """
+        if self.mode != 'train' or not self.opts.log_dir:
+            return
+        name, keys, pos, has_gauss, cached_gaussian = self.rng.get_state()
+        pools = list(self.pools.items())
+        state = {'epoch'        : self.epoch,
+                 'step'         : int(step),
+                 'size'         : hvd.size(),
+                 'train_paths'  : [slide_path for slide_path, _ in self.train_paths],
+                 'wsi_idx'      : int(self.wsi_idx),
+                 'slide'        : self.cur_wsi_path[0] if self.contours_train else None,
+                 'cnt'          : int(self.cnt),
+                 'mined_batches': self.mined_batches,
+                 'rng'          : [name, int(pos), int(has_gauss), float(cached_gaussian)],
+                 'pools'        : [[kind, int(n), int(pool.cursor)] for (kind, n), pool in pools]}
+        path = self.state_path()
+        tmp_path = f'{path}.tmp{os.getpid()}.npz'
+        np.savez(tmp_path, state=json.dumps(state), rng_keys=keys, **{f'pool_{i}': pool.coords for i, (_, pool) in enumerate(pools)})
+        os.replace(tmp_path, path)
+    
+    def load_state(self):
+        """
+        - Resumes the sampling position of `save_state`. The epoch and the step
+        of the training loop (`self.resume_step`) are those of rank 0, for
+        every worker, so the workers stay in step.
+
+        - The RNG and the position in the slides are only restored if the
+        number of workers and the slides of the epoch are those of the saved
+        run, otherwise the epoch starts over at its first slide. The WSI
+        is reopened on the next batch, at the saved contour and pools (see resume_position).
+        """
+        path = self.state_path()
+        state = None
+        if os.path.isfile(path):
+            saved = np.load(path)
+            state = json.loads(str(saved['state']))
+        epoch, step = hvd.broadcast_object((state['epoch'], state['step']) if state else (0, 0), root_rank=0)
+        if not epoch and not step:
+            return
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.train_paths = self.shard_paths(self.all_train_paths, 'train', epoch=epoch, work=self.train_work)
+        self.resume_step = step
+        
+        if (state is None or state['size'] != hvd.size() or state['epoch'] != epoch
+                or state['train_paths'] != [slide_path for slide_path, _ in self.train_paths]):
+            print(f"Worker {hvd.rank()}: the sampler state does not match this run, epoch {epoch} starts over at its first slide")
+            return
+        name, pos, has_gauss, cached_gaussian = state['rng']
+        self.rng.set_state((name, saved['rng_keys'], pos, has_gauss, cached_gaussian))
+        self.wsi_idx = state['wsi_idx']
+        self.mined_batches = state['mined_batches']
+        self.resume = {'slide': state['slide'],
+                       'cnt'  : state['cnt'],
+                       'pools': {(kind, n): CoordinatePool.from_coords(saved[f'pool_{i}'], cursor, self.rng)
+                                 for i, (kind, n, cursor) in enumerate(state['pools'])}}
+        print(f"Worker {hvd.rank()}: resumed sampling at epoch {epoch}, step {step}, slide {self.wsi_idx + 1} / {len(self.train_paths)}")
+    
+    def resume_position(self):
+        """ (contour index, coordinate pools) of a newly opened WSI: the saved ones if it is the WSI of a resumed state, else the start """
+        resume, self.resume = self.resume, None
+        if resume is not None and resume['slide'] == self.cur_wsi_path[0] and resume['cnt'] < len(self.contours):
+            return resume['cnt'], resume['pools']
+        return 0, {}
+    
+    def stratified_batch(self):
+        """
+        - Train batch with exactly round(batch_tumor_ratio * batch_size) tumor
+        and round(boundary_ratio * batch_size) boundary patches, the rest
+        normal, drawn over all tumor regions of all train WSI's of the worker
+        (see surf_strata.py). Every drawn position is in the tissue and not
+        background on the overview, so there is no retry (the background
+        fetches are only counted, see fetch_stats).
+
+        - Written in the same uint8 buffers as `trainer`. No overlays are
+        drawn, the patches of a batch come from several WSI's.
+        """
+        if self.stratified_index is None:
+            self.build_strata()
+        batch_size, size = self.opts.batch_size, self.opts.image_size
+        tumor_patches = min(batch_size, round(batch_size * self.opts.batch_tumor_ratio))
+        boundary_patches = min(batch_size - tumor_patches, round(batch_size * self.opts.boundary_ratio))
+        slides, coords, _ = self.stratified_index.draw({'tumor'   : tumor_patches,
+                                                        'boundary': boundary_patches,
+                                                        'normal'  : batch_size - tumor_patches - boundary_patches})
+        # For the losses of the batch, see record_losses
+        self.batch_origin = (slides, coords)
+        for i, (wsi_idx, (y_topleft, x_topleft)) in enumerate(zip(slides, coords)):
+            slide_path, label_path = self.train_paths[wsi_idx]
+            try:
+                self.batch_patches[i] = self.read_patch(slide_path, x_topleft, y_topleft, self.open_region(slide_path))[..., :3]
+                self.count_fetch(self.batch_patches[i])
+                if self.opts.context_levels:
+                    self.read_contexts(i, slide_path, x_topleft, y_topleft)
+                mask = self.read_patch(label_path, x_topleft, y_topleft, self.label_region(label_path), slide_path=slide_path, mask=True)
+                self.batch_masks[i] = mask[..., :1] > 0
+            except Exception as e:
+                print("Exception in extracting patch: ", e)
+                self.batch_patches[i] = np.random.randint(0, 256, size=(size, size, 3), dtype=np.uint8)
+                self.batch_masks[i] = 0
+        
+        return self.batch_output(self.batch_patches, self.batch_masks)
+    
+    def get_pool(self, key, contour, paths):
+        """
+        CoordinatePool of a contour of the current WSI (see surf_coords.py),
+        built once per contour and reused across batches
+        """
+        if key not in self.pools:
+            # Get subset of coordinates based on arg, minimum two
+            part = max(2,int(self.opts.steps_per_epoch // len(paths)))
+            self.pools[key] = CoordinatePool(contour, self.mag_factor, size=part, rng=self.rng, keep=self.foreground)
+        return self.pools[key]
+    
+    def next_contour(self, used_pools, paths):
+        """ Move on to the next contour if a pool used in this batch is exhausted """
+        remaining = min(self.pools[key].remaining() for key in used_pools)
+        print(f"\n\n{self.mode.capitalize()} sampling at ROI {self.cnt+1} / {len(self.contours)} of {self.cur_wsi_path} with ~ {remaining // self.opts.batch_size} iter to go.\n\n")
+        
+        # If past all patches of contour, get next contour
+        if remaining <= self.opts.batch_size:
+        # if 1: # for debugging
+            self.cnt +=1
+            # Exhausted pools are reshuffled, so they can be reused when sampled again
+            for pool in self.pools.values():
+                if pool.remaining() <= self.opts.batch_size:
+                    pool.reset()
+            
+            if self.cnt == len(self.contours): 
+                self.wsi_idx +=1
+                self.release_wsi()
+        return
+    
+    def release_wsi(self):
+        """ Close the current WSI and reset its contours and coordinate pools, the next batch opens `wsi_idx` """
+        # Final overlay of the WSI
+        self.write_overlay(force=True)
+        self.cnt = 0
+        self.wsi.close()
+        if self.opts.tile_cache_mb:
+            print(f"Worker {hvd.rank()}: tile cache {tile_cache(self.opts.tile_cache_mb).stats()}")
+        print(f"Worker {hvd.rank()}: {self.fetch_stats()}")
+        if hasattr(self,'mask'):
+            del self.mask
+        self.pools = {}
+        self.contours_train = []
+        self.contours_valid = []
+        self.contours_tumor = []
+        self.contours_test  = []
     
     def get_bb(self):
-        hsv = cv2.cvtColor(self.rgb_image, cv2.COLOR_BGR2HSV)
-        lower_red = np.array([20, 20, 20])
-        upper_red = np.array([255, 255, 255])
-        mask = cv2.inRange(hsv, lower_red, upper_red)
-
-        # (50, 50)
-        close_kernel = np.ones((50, 50), dtype=np.uint8)
-        image_close = Image.fromarray(cv2.morphologyEx(np.array(mask), cv2.MORPH_CLOSE, close_kernel))
-        # (30, 30)
-        open_kernel = np.ones((30, 30), dtype=np.uint8)
-        image_open = Image.fromarray(cv2.morphologyEx(np.array(image_close), cv2.MORPH_OPEN, open_kernel))
-        contours, _ = cv2.findContours(np.array(image_open), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        _offset = 0
-        for i, contour in enumerate(contours):
-            # sometimes the bounding boxes annotate a very small area not in the ROI
-            if contour.shape[0] < 10:
-                if hvd.rank() ==0  and self.opts.verbose == 'debug': print(f"Deleted too small contour from {self.cur_wsi_path}")
-                del contours[i]
-                _offset += 1
-                i = i - _offset        
+        contours = slide_tissue_contours(self.wsi, self.rgb_image, self.opts.bb_downsample, tissue_params(self.opts.tissue_method))
                              
         # contours_rgb_image_array = np.array(self.rgb_image)
         # line_color = (255, 150, 150)
@@ -279,88 +808,64 @@ class SurfSampler(tf.keras.utils.Sequence):
                     
         tumor_count = 0
         tumor_patches = round(self.opts.batch_size * self.opts.batch_tumor_ratio)
-        # tbc = self.tumorcnt
-        bc  = self.cnt
+        used_pools = set()
 
         for i in range(int(self.opts.batch_size)): 
             patch = []
             k=0
-            while not len(patch):
-                try:
-                    if tumor_count < tumor_patches:
-                        self.contours_tumor = self.contours_tumor
-                        # bc = self.contours_tumor[self.cnt]
-                        bc = self.contours_tumor[-1]
-                        tumor_count += 1
-                    else:
-                        bc = self.contours[self.cnt]
-                except:
-                    print(f"WARNING: WSI {self.cur_wsi_path[0]} has no (tumor)contours")
-                    bc = self.contours[self.cnt]
+            # First get coords from contours of tumor, after tumor get negative coords (retries stay in the contour)
+            try:
+                if tumor_count < tumor_patches:
+                    # bc = self.contours_tumor[self.cnt]
+                    key, bc = ('tumor', len(self.contours_tumor) - 1), self.contours_tumor[-1]
+                    tumor_count += 1
+                else:
+                    key, bc = ('tissue', self.cnt), self.contours[self.cnt]
+            except:
+                print(f"WARNING: WSI {self.cur_wsi_path[0]} has no (tumor)contours")
+                key, bc = ('tissue', self.cnt), self.contours[self.cnt]
             
-                msk = np.zeros(self.rgb_image.shape,np.uint8)
-                # First get coords from contours of tumor, after tumor get negative coords 
-                cv2.drawContours(msk,[bc],-1,(255),-1)
-                if not len(self.pixelpoints):
-                    # get all non zero pixels, aka all pixels in contour
-                    self.pixelpoints = np.transpose(np.nonzero(msk))
-                    # multiply coordinates by magnification factor
-                    self.pixelpoints = self.pixelpoints[...,:2] * self.mag_factor
-                    # Shuffle coordinates
-                    np.random.shuffle(self.pixelpoints)
-                    # Get subset of coordinates based on arg
-                    part = max(2,int(self.opts.steps_per_epoch // len(self.train_paths)))
-                    self.pixelpoints = self.pixelpoints[:part,:]
-                                     
-                b_x_start = bc[...,0].min() * self.mag_factor
-                b_y_start = bc[...,1].min() * self.mag_factor
-                b_x_end = bc[...,0].max() * self.mag_factor
-                b_y_end = bc[...,1].max() * self.mag_factor
-                h = b_y_end - b_y_start
-                w = b_x_end - b_x_start
-                pixelcoords = random.choice(self.pixelpoints)
+            while not len(patch):
+                pixelcoords = self.get_pool(key, bc, self.train_paths).next()
+                used_pools.add(key)
                 x_topleft = pixelcoords[1] 
                 y_topleft = pixelcoords[0] 
                 
                 
                 # if trying to fetch outside of image, retry
                 try:
-                    patch = img_reg.fetch(x_topleft, y_topleft, self.opts.image_size, self.opts.image_size)
-                    patch = np.ndarray((self.opts.image_size, self.opts.image_size, image.get('bands')), buffer=patch,
-                                       dtype=np.uint8)[..., :3]
-                    _std = ImageStat.Stat(Image.fromarray(patch)).stddev
+                    patch = self.read_patch(self.cur_wsi_path[0], x_topleft, y_topleft, (image, img_reg))[..., :3]
 
                     k += 1
-                    # discard based on stddev
-                    if k < 10: 
-                        if (sum(_std[:3]) / len(_std[:3])) < 15:
-                            if self.opts.verbose == 'debug':
-                                print("Discard based on stddev")
-                                patch = []
+                    # discard based on stddev (rare, the pools have no background positions of the overview)
+                    if self.count_fetch(patch) and k < 10:
+                        if self.opts.verbose == 'debug':
+                            print("Discard based on stddev")
+                        patch = []
+                        continue
                     
-                    msk_downsample = 1
-                    mask  = mask_reg.fetch(x_topleft, y_topleft, self.opts.image_size//msk_downsample, self.opts.image_size//msk_downsample)
-                    mask  = np.ndarray((self.opts.image_size//msk_downsample,self.opts.image_size//msk_downsample,mask_image.get('bands')),buffer=mask, dtype=np.uint8)
+                    mask  = self.read_patch(self.cur_wsi_path[1], x_topleft, y_topleft, (mask_image, mask_reg), slide_path=self.cur_wsi_path[0], mask=True)
                 
                 except Exception as e:
                     print("Exception in extracting patch: ", e)
-                    patch = np.random.normal(size=(self.opts.image_size,self.opts.image_size,3))
-                    mask  = np.random.normal(size=(self.opts.image_size,self.opts.image_size,1))
+                    patch = np.random.randint(0, 256, size=(self.opts.image_size,self.opts.image_size,3), dtype=np.uint8)
+                    mask  = np.zeros((self.opts.image_size,self.opts.image_size,1), dtype=np.uint8)
                 
 
 
-            numpy_batch_patch.append(patch)
-            numpy_batch_mask.append(mask)
+            # Written in place, the mask as class index (0 = no tumor)
+            numpy_batch_patch[i] = patch
+            if self.opts.context_levels:
+                self.read_contexts(i, self.cur_wsi_path[0], x_topleft, y_topleft)
+            numpy_batch_mask[i]  = mask[..., :1] > 0
             x,y,imsize = x_topleft, y_topleft, self.opts.image_size
             coords = [y,x]
-            try:
-                # Draw the rectangles of sampled images on downsampled rgb
-                save_image = cv2.drawContours(save_image, self.contours, -1, (0,255,0), 1)
+            if self.opts.overlays:
+                # Draw the rectangles of sampled images on downsampled rgb (the contours are drawn once, see base_overlay)
+                footprint = self.footprint(self.cur_wsi_path[0])
                 save_image = cv2.rectangle(save_image, (int(x_topleft // self.mag_factor) , int(y_topleft // self.mag_factor)),
-                                                        (int((x_topleft + self.opts.image_size) // self.mag_factor), int((y_topleft + self.opts.image_size) // self.mag_factor)),
+                                                        (int((x_topleft + footprint) // self.mag_factor), int((y_topleft + footprint) // self.mag_factor)),
                                                         (255,255,255), -1)
-            except:
-                pass
 
             self.save_data.append(({   'patch'      : patch,
                                        'image'      : save_image,
@@ -369,166 +874,238 @@ class SurfSampler(tf.keras.utils.Sequence):
                                        'mask'       : mask,
                                        'tumor'      : 1}))
 
+        self.next_contour(used_pools, self.train_paths)
+        self.write_overlay()
 
-            # Remove past coordinates from possible pixelpoints
-            # Get index of row-wise intersection
-            del_row = np.where(np.all(np.isin(self.pixelpoints,pixelcoords),axis=1))
-            # Delete row from pixelpoints
-            self.pixelpoints = np.delete(self.pixelpoints,del_row,axis=0)
-        
-        print(f"\n\nTrain sampling at ROI {self.cnt+1} / {len(self.contours)} of {self.cur_wsi_path} with ~ {len(self.pixelpoints) // self.opts.batch_size} iter to go.\n\n")
-        # If past all patches of contour, get next contour
-        if len(self.pixelpoints) <= self.opts.batch_size:
-        
-        # if 1: # for debugging
-            self.cnt +=1
-            self.pixelpoints = []
-            
-            if self.cnt == len(self.contours): 
-                self.wsi_idx +=1
-                self.cnt = 0
-                self.wsi.close()
-                if hasattr(self,'mask'):
-                    del self.mask
-                self.contours_train = []
-                self.contours_tumor = []
-
-        try:
-            Image.fromarray(save_image[..., :3]).save(os.path.join(self.opts.log_dir,
-                                                                   self.cur_wsi_path[0].split('/')[-1].replace(
-                                                                       self.opts.slide_format, 'png')))
-        except:
-            pass
-
-        return np.array(numpy_batch_patch),np.array(numpy_batch_mask)
+        return numpy_batch_patch,numpy_batch_mask
 
 
     def tester(self,image,mask_image,img_reg,mask_reg,numpy_batch_patch,numpy_batch_mask,save_image):
         
         tumor_count = 0
         tumor_patches = round(self.opts.batch_size * 1)#self.opts.batch_tumor_ratio)
+        paths = self.valid_paths if self.mode == 'validation' else self.test_paths
+        used_pools = set()
+        # One entry per patch of the batch, in batch order
+        self.save_data = []
         for i in range(int(self.opts.batch_size)):
             patch = []
             while not len(patch):
                 try:
                     if self.mode == 'validation':# and not self.opts.evaluate:
                         if tumor_count < tumor_patches:
-                            bc = self.contours_tumor[self.cnt]
+                            key, bc = ('tumor', self.cnt), self.contours_tumor[self.cnt]
                             tumor_count += 1
                         else:
-                            bc = self.contours[self.cnt]
+                            key, bc = ('tissue', self.cnt), self.contours[self.cnt]
                     else:
-                        bc = self.contours[self.cnt]
+                        key, bc = ('tissue', self.cnt), self.contours[self.cnt]
                 except:
                     print(f"WARNING: WSI {self.cur_wsi_path[0]} has no contours")
-                    bc = self.contours[self.cnt]
+                    key, bc = ('tissue', self.cnt), self.contours[self.cnt]
                 
-                msk = np.zeros(self.rgb_image.shape,np.uint8)
-                x_topleft,y_topleft,width,height = cv2.boundingRect(bc)
-                cv2.drawContours(msk,[bc],-1,(255),-1)
-                # First gather all posssible pixelpoints, then, drop past_coords
-                if not len(self.pixelpoints):
-                    # get all non zero pixels, aka all pixels in contour
-                    self.pixelpoints = np.transpose(np.nonzero(msk))
-                    # multiply coordinates by magnification factor
-                    self.pixelpoints = self.pixelpoints[...,:2] * self.mag_factor
-                    # Shuffle coordinates
-                    np.random.shuffle(self.pixelpoints)
-                    # Get subset of coordinates based on argument, minimum two
-                    if self.mode == 'validation':
-                        part = max(2,int(self.opts.steps_per_epoch // len(self.valid_paths)))
-                    elif self.mode == 'test':
-                        part = max(2,int(self.opts.steps_per_epoch // len(self.test_paths)))
-                    self.pixelpoints = self.pixelpoints[:part,:]
-                    
-
-                b_x_start = bc[...,0].min() * self.mag_factor
-                b_y_start = bc[...,1].min() * self.mag_factor
-                b_x_end = bc[...,0].max() * self.mag_factor
-                b_y_end = bc[...,1].max() * self.mag_factor
-                h = b_y_end - b_y_start
-                w = b_x_end - b_x_start
-                
-                pixelcoords = random.choice(self.pixelpoints)
+                pixelcoords = self.get_pool(key, bc, paths).next()
+                used_pools.add(key)
                 x_topleft = pixelcoords[1]
                 y_topleft = pixelcoords[0]
                 
                 try:
-                    patch = img_reg.fetch(x_topleft, y_topleft, self.opts.image_size, self.opts.image_size)
-                    patch = np.ndarray((self.opts.image_size,self.opts.image_size,image.get('bands')),buffer=patch, dtype=np.uint8)[...,:3]
-                    msk_downsample = 1
+                    patch = self.read_patch(self.cur_wsi_path[0], x_topleft, y_topleft, (image, img_reg))[...,:3]
                     if not self.mode == 'test':
-                        # mask  = mask_reg.fetch(x_topleft, y_topleft, self.opts.image_size, self.opts.image_size)
-                        mask  = mask_reg.fetch(x_topleft, y_topleft, self.opts.image_size//msk_downsample, self.opts.image_size//msk_downsample)
-                        # mask  = np.ndarray((self.opts.image_size,self.opts.image_size,mask_image.get('bands')),buffer=mask, dtype=np.uint8)
-                        mask  = np.ndarray((self.opts.image_size//msk_downsample,self.opts.image_size//msk_downsample,mask_image.get('bands')),buffer=mask, dtype=np.uint8)
+                        mask  = self.read_patch(self.cur_wsi_path[1], x_topleft, y_topleft, (mask_image, mask_reg), slide_path=self.cur_wsi_path[0], mask=True)
                     else:
                         mask=[]
                 except Exception as e:
                     print("Exception in extracting patch: ", e)
-                    patch = np.random.normal(size=(self.opts.image_size,self.opts.image_size,3))
+                    patch = np.random.randint(0, 256, size=(self.opts.image_size,self.opts.image_size,3), dtype=np.uint8)
                     if not self.mode == 'test':
-                        mask = np.random.normal(size=(self.opts.image_size,self.opts.image_size,1))
+                        mask = np.zeros((self.opts.image_size,self.opts.image_size,1), dtype=np.uint8)
                     else:
                         mask = []
                     continue
                     
             # if hvd.rank() ==0 : print(f"\n\nTest Sample {self.opts.image_size} x {self.opts.image_size} from ROI = {h}" + f" by {w} in {time.time() -t1} seconds\n\n")
-            numpy_batch_patch.append(patch)            
-            numpy_batch_mask.append(mask)
-
-            try:
-                # Draw the rectangles of sampled images on downsampled rgb
-                save_image = cv2.drawContours(save_image, self.contours, -1, (0,255,0), 1)
+            # Written in place, the mask as class index (0 = no tumor, and in test mode)
+            numpy_batch_patch[i] = patch
+            if self.opts.context_levels:
+                self.read_contexts(i, self.cur_wsi_path[0], x_topleft, y_topleft)
+            numpy_batch_mask[i]  = mask[..., :1] > 0 if len(mask) else 0
+
+            if self.opts.overlays:
+                # Draw the rectangles of sampled images on downsampled rgb (the contours are drawn once, see base_overlay)
+                footprint = self.footprint(self.cur_wsi_path[0])
                 save_image = cv2.rectangle(save_image, (int(x_topleft // self.mag_factor) , int(y_topleft // self.mag_factor)),
-                                                        (int((x_topleft + self.opts.image_size) // self.mag_factor), int((y_topleft + self.opts.image_size) // self.mag_factor)),
+                                                        (int((x_topleft + footprint) // self.mag_factor), int((y_topleft + footprint) // self.mag_factor)),
                                                         (255,255,255), -1)
-            except:
-                pass
 
             x,y,imsize = x_topleft, y_topleft, self.opts.image_size
-            # Get coordinates so all patch coordinates are dropped from pixelpoints
             coords = [y,x]
-            self.save_data = [{     'patch'      : patch,
-                                    'image'      : save_image,
-                                    'file_name'  : self.cur_wsi_path[0],
-                                    'coords'     : coords,
-                                    'mask'       : mask,
-                                    'tumor'      : 1*(np.count_nonzero(mask) > 0)}]
-            
-            # Remove past coordinates from possible pixelpoints
-            # Get index of row-wise intersection
-            del_row = np.where(np.all(np.isin(self.pixelpoints,pixelcoords),axis=1))
-            # Delete row from pixelpoints
-            self.pixelpoints = np.delete(self.pixelpoints,del_row,axis=0)
-        
-        print(f"\n\nTest sampling at ROI {self.cnt+1} / {len(self.contours)} of {self.cur_wsi_path} with ~ {len(self.pixelpoints) // self.opts.batch_size} iter to go.\n\n")
+            self.save_data.append({'patch'      : patch,
+                                   'image'      : save_image,
+                                   'file_name'  : self.cur_wsi_path[0],
+                                   'coords'     : coords,
+                                   'mask'       : mask,
+                                   'tumor'      : 1*(np.count_nonzero(mask) > 0)})
             
-        # If past all patches of contour, get next contour
-        if len(self.pixelpoints) <= self.opts.batch_size:
-        # if 1: # for debugging
-            self.cnt +=1
-            self.pixelpoints = []
-            
-            if self.cnt == len(self.contours): 
-                self.wsi_idx +=1
-                self.cnt = 0
-                self.wsi.close()
-                if hasattr(self,'mask'):
-                    del self.mask
-                self.contours_valid = []
-                self.contours_tumor = []
-                self.contours_test  = []
-                
+        self.next_contour(used_pools, paths)
+        self.write_overlay()
 
-        try:
-            Image.fromarray(save_image[...,:3]).save(os.path.join(self.opts.log_dir,self.cur_wsi_path[0].split('/')[-1].replace(self.opts.slide_format,'png')))
-        except:
-            pass
+        return numpy_batch_patch,numpy_batch_mask
 
-        return np.array(numpy_batch_patch),np.array(numpy_batch_mask)
 
+    def load_overview(self):
+        """
+        - Sets `self.rgb_image`, `self.mask_image` (not in test mode) and
+        `self.foreground` of the current WSI at `opts.bb_downsample`, and
+        returns its tissue and tumor contours.
 
+        - With `opts.contour_index_dir` these are looked up in the ContourIndex,
+        and only computed (and stored for the next time) on a miss.
+        """
+        slide_path = self.cur_wsi_path[0]
+        label_path = self.cur_wsi_path[1] if self.mode != 'test' else None
+        
+        entry = self.slide_contours(self.wsi, self.mask if label_path else None, slide_path, label_path)
+        self.rgb_image = entry['overview']
+        self.mask_image = entry['mask']
+        self.foreground = self.overview_foreground(entry, slide_path)
+        return entry['contours'], entry['contours_tumor']
+    
+    def slide_contours(self, wsi, mask, slide_path, label_path=None):
+        """
+        Overview, overview mask, tissue and tumor contours of an opened WSI (see
+        `load_overview`), without touching the state of the sampler
+        """
+        if self.contour_index is not None:
+            entry = self.contour_index.lookup(slide_path, label_path)
+            if entry is not None:
+                if hvd.rank() == 0 and self.opts.verbose == 'debug': print(f"Contour index hit for {slide_path}")
+                return entry
+        
+        overview, mask_overview = slide_overview(wsi, mask, self.opts.bb_downsample)
+        contours = slide_tissue_contours(wsi, overview, self.opts.bb_downsample, tissue_params(self.opts.tissue_method))
+        contours_tumor = tumor_contours(mask_overview) if mask_overview is not None else []
+        
+        if self.contour_index is not None:
+            self.contour_index.store(slide_path, overview, mask_overview, contours, contours_tumor, label_path=label_path)
+            
+        return {'overview'      : overview,
+                'mask'          : mask_overview,
+                'contours'      : contours,
+                'contours_tumor': contours_tumor}
+    
+    def iter_slide(self, wsi_idx, num_patches, with_coords=False):
+        """
+        - Generator of `num_patches` uint8 (patch, mask) pairs of train WSI
+        `wsi_idx`, with (image_size, image_size, 3) patches and
+        (image_size, image_size, 1) masks (0 = no tumor). With `with_coords`
+        the level 0 (y, x) of the top left corner is yielded as third element.
+
+        - Opens its own OpenSlide / pyvips handles (or uses the pyvips handles
+        of the tile cache, which are per thread) and keeps no state on the
+        sampler, so several slides can be sampled in parallel (see `as_dataset`).
+        """
+        slide_path, label_path = self.train_paths[int(wsi_idx) % len(self.train_paths)]
+        size = self.opts.image_size
+        try:
+            wsi = OpenSlide(slide_path)
+            if self.opts.label_format.find('xml') > -1:
+                mask = PolygonMask.from_xml(label_path, wsi.dimensions)
+                mask_image, mask_reg = mask, mask
+            else:
+                mask = OpenSlide(label_path)
+                mask_image, mask_reg = self.open_region(label_path)
+            entry = self.slide_contours(wsi, mask, slide_path, label_path)
+            image, img_reg = self.open_region(slide_path)
+        except Exception as e:
+            print(f"{e}, at {slide_path}")
+            return
+        
+        contours = entry['contours']
+        contours_tumor = entry['contours_tumor'] if len(entry['contours_tumor']) else contours
+        if not len(contours):
+            wsi.close()
+            mask.close()
+            return
+        
+        part = max(2,int(self.opts.steps_per_epoch // len(self.train_paths)))
+        foreground = self.overview_foreground(entry, slide_path)
+        # Generators of several slides run in parallel, each with its own RNG, seeded by the sampler
+        rng = np.random.RandomState(self.rng.randint(2**31))
+        pools = {}
+        for i in range(num_patches):
+            # int(batch_tumor_ratio * batch_size) of the patches are sampled from tumor contours
+            if rng.random_sample() < self.opts.batch_tumor_ratio:
+                key = ('tumor', rng.randint(len(contours_tumor)))
+                bc = contours_tumor[key[1]]
+            else:
+                key = ('tissue', rng.randint(len(contours)))
+                bc = contours[key[1]]
+            if key not in pools:
+                pools[key] = CoordinatePool(bc, self.mag_factor, size=part, rng=rng, keep=foreground)
+            
+            for k in range(10):
+                y_topleft, x_topleft = pools[key].next()
+                try:
+                    patch = self.read_patch(slide_path, x_topleft, y_topleft, (image, img_reg))[..., :3]
+                except Exception as e:
+                    print("Exception in extracting patch: ", e)
+                    continue
+                # discard based on stddev
+                if not self.count_fetch(patch) or k == 9:
+                    break
+            else:
+                continue
+            
+            mask_patch = self.read_patch(label_path, x_topleft, y_topleft, (mask_image, mask_reg), slide_path=slide_path, mask=True)[..., :1]
+            yield (patch, mask_patch, (y_topleft, x_topleft)) if with_coords else (patch, mask_patch)
+        
+        wsi.close()
+        mask.close()
+        if self.opts.verbose == 'debug':
+            if self.opts.tile_cache_mb:
+                print(f"Worker {hvd.rank()}: tile cache {tile_cache(self.opts.tile_cache_mb).stats()}")
+            print(f"Worker {hvd.rank()}: {self.fetch_stats()}")
+    
+    def as_dataset(self):
+        """
+        - Patch sampling as one long-lived tf.data pipeline, built once per run
+        instead of once per step:
+            > `opts.interleave_slides` train WSI's are sampled in parallel (`interleave`)
+            > batched in uint8 with `opts.batch_size`
+            > stain augmented with opts.stain_augment (see surf_augment.py), patches
+            normalized to [-1,1] and masks one - hot encoded in the graph
+            (`normalize_batch`), in one map over the batch, and prefetched
+
+        - The train WSI's are already divided over the Horovod workers in
+        `__init__`, so every worker interleaves its own shard.
+
+        >>>>Example:
+
+        train_ds = SurfSampler(opts, mode='train').as_dataset()
+        for patches, masks in train_ds.take(opts.steps_per_epoch):
+            ...
+        """
+        assert not self.opts.context_levels, "WARNING: as_dataset does not sample context patches"
+        size = self.opts.image_size
+        num_patches = max(self.opts.batch_size, int(self.opts.steps_per_epoch // len(self.train_paths)))
+        signature = (tf.TensorSpec((size, size, 3), tf.uint8), tf.TensorSpec((size, size, 1), tf.uint8))
+        
+        dataset = tf.data.Dataset.range(len(self.train_paths))
+        dataset = dataset.shuffle(len(self.train_paths), reshuffle_each_iteration=True).repeat()
+        dataset = dataset.interleave(
+            lambda wsi_idx: tf.data.Dataset.from_generator(self.iter_slide, args=(wsi_idx, num_patches),
+                                                           output_signature=signature),
+            cycle_length=self.opts.interleave_slides,
+            block_length=1,
+            num_parallel_calls=self.opts.interleave_slides,
+            deterministic=False)
+        dataset = dataset.batch(self.opts.batch_size, drop_remainder=True)
+        dataset = dataset.map(augmented_normalize(train_augmentation(self.opts)), num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        
+        return dataset
+    
     def parse_xml(self,label=None):
         """
             make the list of contour from xml(annotation file)
@@ -553,48 +1130,18 @@ class SurfSampler(tf.keras.utils.Sequence):
         	</AnnotationGroups>
         </ASAP_Annotations>
 
-            fn_xml = file name of xml file
-            downsample = desired resolution
-            var:
-            li_li_point = list of tumors
-            li_point = the coordinates([x,y]) of a tumor
-            return  list of list (2D array list)
+            label = file name of xml file
+            return PolygonMask of the tumors, with width - height dimensionality
+            of level 0 (see surf_annotations.py). Only the windows that are
+            fetched are rasterized, so no level 0 mask is ever allocated.
         """
-
-        li_li_point = []
-        tree = ET.parse(label)
-
-        for ASAP_Annotations in tree.getiterator():
-            for i_1, Annotations in enumerate(ASAP_Annotations):
-                for i_2, Annotation in enumerate(Annotations):
-                    for i_3, Coordinates in enumerate(Annotation):
-                        li_point = []
-                        for i_4, Coordinate in enumerate(Coordinates):
-                            x_0 = float(Coordinate.attrib['X'])
-                            y_0 = float(Coordinate.attrib['Y'])
-                            li_point.append((x_0, y_0))
-                        if len(li_point):
-                            li_li_point.append(li_point)
-
-       
-        # Make opencv contours
-        contours = []
-        for li_point in li_li_point:
-            li_point_int = [[int(round(point[0])), int(round(point[1]))] for point in li_point]
-            contour = np.array(li_point_int, dtype=np.int32)
-            contours.append(contour)
-        
-        # Make lvl 0 mask, with width - height dimensionality
-
-        mask = np.zeros(tuple(reversed(self.wsi.dimensions)),dtype=np.uint8)
-        
-        for idx,contour in enumerate(contours):
-            cv2.fillPoly(mask, pts =[contour], color=(255))
-
-        return mask
+        return PolygonMask.from_xml(label, self.wsi.dimensions)
 
     def __getitem__(self,idx):
 
+        if self.mode == 'train' and self.opts.stratified:
+            return self.stratified_batch()
+        
         # Every new iteration, new sample
         
         cnt = 0
@@ -617,27 +1164,17 @@ class SurfSampler(tf.keras.utils.Sequence):
                         else:
                             self.mask = OpenSlide(self.cur_wsi_path[1])
                         
-                        self.rgb_image_pil = self.wsi.read_region((0, 0), self.opts.bb_downsample, self.wsi.level_dimensions[self.opts.bb_downsample])
-                        self.rgb_image = np.array(self.rgb_image_pil)
-                        
-                        if self.opts.label_format.find('xml') > -1:
-                            self.mask_image = cv2.resize(self.mask,self.wsi.level_dimensions[self.opts.bb_downsample])[...,None]
-                        else:
-                            self.mask_pil = self.mask.read_region((0, 0), self.opts.bb_downsample, self.wsi.level_dimensions[self.opts.bb_downsample])
-                            self.mask_image = np.array(self.mask_pil)
-                            
-                        self.contours_train = self.get_bb()
+                        self.contours_train, contours = self.load_overview()
                         self.contours = self.contours_train
                         
                         # Get contours of tumor, if not tumor, patch is negative
-                        contours, _ = cv2.findContours(self.mask_image[...,0], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
                         if contours:
                             self.contours_tumor = contours
                         else:
                             self.contours_tumor = self.contours
                             
-                        # Initialize contour index for trainer
-                        self.cnt = 0
+                        # Initialize contour index for trainer, or continue at those of a resumed run
+                        self.cnt, self.pools = self.resume_position()
                         # Initialize contour index for trainer
                         self.tumorcnt = 0
                         cnt += 1
@@ -672,20 +1209,11 @@ class SurfSampler(tf.keras.utils.Sequence):
                         else:
                             self.mask = OpenSlide(self.cur_wsi_path[1])
                         
-                        self.rgb_image_pil = self.wsi.read_region((0, 0), self.opts.bb_downsample, self.wsi.level_dimensions[self.opts.bb_downsample])
-                        self.rgb_image = np.array(self.rgb_image_pil)
-                        if self.opts.label_format.find('xml') > -1:
-                            self.mask_image = cv2.resize(self.mask,self.wsi.level_dimensions[self.opts.bb_downsample])[...,None]
-                        else:
-                            self.mask_pil = self.mask.read_region((0, 0), self.opts.bb_downsample, self.wsi.level_dimensions[self.opts.bb_downsample])
-                            self.mask_image = np.array(self.mask_pil)
-                        
-                        self.contours_valid = self.get_bb()
+                        self.contours_valid, contours = self.load_overview()
                         if not self.contours_valid: self.valid_paths.remove(self.cur_wsi_path)
                         self.contours = self.contours_valid
                         
                         # Get contours of tumor, if not tumor, patch is negative
-                        contours, _ = cv2.findContours(self.mask_image[...,0], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
                         if contours:
                             self.contours_tumor = contours
                         else:
@@ -726,9 +1254,7 @@ class SurfSampler(tf.keras.utils.Sequence):
                         
                         # OpenSlide and get contours of ROI
                         self.wsi  = OpenSlide(self.cur_wsi_path[0])
-                        self.rgb_image_pil = self.wsi.read_region((0, 0), self.opts.bb_downsample, self.wsi.level_dimensions[self.opts.bb_downsample])
-                        self.rgb_image = np.array(self.rgb_image_pil)
-                        self.contours_test = self.get_bb()
+                        self.contours_test, _ = self.load_overview()
                         if not self.contours_test: self.test_paths.remove(self.cur_wsi_path)
                         self.contours = self.contours_test
                         cnt += 1
@@ -742,35 +1268,27 @@ class SurfSampler(tf.keras.utils.Sequence):
                         pass
                 
             
-            image = pyvips.Image.new_from_file(self.cur_wsi_path[0])
+            image, img_reg = self.open_region(self.cur_wsi_path[0])
 
             if not self.mode == 'test':
                 if self.opts.label_format.find('xml') > -1:
-                    mask_image  = pyvips.Image.new_from_memory(self.mask,self.mask.shape[1],self.mask.shape[0],1,dtype_to_format[str(self.mask.dtype)])
+                    # The PolygonMask serves as both image and region
+                    mask_image  = self.mask
+                    mask_reg    = self.mask
                 else:
-                    mask_image  = pyvips.Image.new_from_file(self.cur_wsi_path[1])
-                mask_reg = pyvips.Region.new(mask_image)
-            
-            img_reg = pyvips.Region.new(image)
+                    mask_image, mask_reg = self.open_region(self.cur_wsi_path[1])
             
             
-            numpy_batch_patch = []
-            numpy_batch_mask  = []
-
-            if os.path.isfile(os.path.join(self.opts.log_dir,self.cur_wsi_path[0].split('/')[-1].replace(self.opts.slide_format,'png'))):   
-                try:
-                    save_image = np.asarray(Image.open(os.path.join(self.opts.log_dir,self.cur_wsi_path[0].split('/')[-1].replace(self.opts.slide_format, 'png'))))
-                except:
-                    try:
-                        save_image = np.array(self.rgb_image.copy()) * np.repeat((self.mask_image + 1)[...,0][...,np.newaxis],4,axis=-1)
-                    except:
-                        save_image = np.array(self.rgb_image.copy()[...,:3])
-            else:
-                try:
-                    # copy image and mark tumor in black
-                    save_image = np.array(self.rgb_image.copy()) * np.repeat((self.mask_image + 1)[...,0][...,np.newaxis],4,axis=-1)
-                except:
-                    save_image = np.array(self.rgb_image.copy()[...,:3])
+            numpy_batch_patch = self.batch_patches
+            numpy_batch_mask  = self.batch_masks
+
+            # The overlay of a WSI stays in memory while it is sampled (see surf_overlay.py)
+            if self.overlay_slide != self.cur_wsi_path[0]:
+                # copy image and mark tumor in black
+                mask_overview = self.mask_image if self.mode != 'test' else None
+                self.overlay = base_overlay(self.rgb_image, mask_overview, self.contours if self.opts.overlays else None)
+                self.overlay_slide = self.cur_wsi_path[0]
+            save_image = self.overlay
             
             if self.mode == 'test':
                     mask_reg = None
@@ -782,8 +1300,6 @@ class SurfSampler(tf.keras.utils.Sequence):
             patches, masks = SurfSampler.trainer(self,image,mask_image,img_reg,mask_reg,numpy_batch_patch,numpy_batch_mask,save_image)
             self.save_data = []
         
-        # Make one - hot
-        masks = np.where(masks == 0,[255,0],[0,255])
         # self.wsi.close()
         # if hasattr(self,'mask'):
         #     del self.mask
@@ -803,7 +1319,9 @@ class SurfSampler(tf.keras.utils.Sequence):
         # return dataset
         # print(f"Got item with shape {patches.shape},{masks.shape}")
 
-        return (2.0*(patches / 255).astype('float32')-1.0), (masks / 255).astype('float32')
+        # uint8 patches and class index masks, in the reused buffers: normalize (normalize_batch)
+        # or copy before the next call
+        return self.batch_output(patches, masks)
 
 
 
@@ -0,0 +1,95 @@
+"""Tests for surf_sampler."""
+import unittest
+from types import SimpleNamespace
+import numpy as np
+from surf_sampler import SurfSampler, batch_dataset
+
+
+class FakeImage():
+    """ A (height, width, bands) array in place of the pyvips image and region of a slide level """
+    def __init__(self, array):
+        self.array = array
+        self.height, self.width, self.bands = array.shape
+
+    def get(self, name):
+        return getattr(self, name)
+
+    def fetch(self, x, y, width, height):
+        return np.ascontiguousarray(self.array[y:y + height, x:x + width]).tobytes()
+
+
+class CountingSampler():
+    """ Batches of value 10 * epoch + step, in a reused buffer """
+    def __init__(self):
+        self.epochs = 0
+        self.patches = np.zeros((2, 4, 4, 3), np.uint8)
+        self.masks = np.zeros((2, 4, 4, 1), np.uint8)
+        self.masks[0, 0, 0] = 1
+
+    def __len__(self):
+        return 3
+
+    def output_signature(self):
+        return ((2, 4, 4, 3), np.uint8), ((2, 4, 4, 1), np.uint8)
+
+    def __getitem__(self, idx):
+        self.patches[...] = 10 * self.epochs + idx
+        return self.patches, self.masks
+
+    def on_epoch_end(self):
+        self.epochs += 1
+
+
+class BatchDatasetTest(unittest.TestCase):
+
+    def test_epochs_and_normalize(self):
+        batches = list(batch_dataset(CountingSampler()).take(7))
+        values = [float(patches[0, 0, 0, 0]) for patches, _ in batches]
+        # on_epoch_end after every 3 batches, and every batch is a copy of the reused buffer
+        np.testing.assert_allclose(values, [2.0 * v / 255.0 - 1.0 for v in (0, 1, 2, 10, 11, 12, 20)], rtol=1e-6)
+        _, masks = batches[0]
+        self.assertEqual(masks.shape, (2, 4, 4, 2))
+        np.testing.assert_array_equal(masks[0, 0, 0], [0, 1])
+        np.testing.assert_array_equal(masks[1, 0, 0], [1, 0])
+
+
+class ReadContextsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Level 1 of a 256 x 256 slide at downsample 4
+        self.levels = [FakeImage(rng.randint(0, 256, (256, 256, 4)).astype(np.uint8)),
+                       FakeImage(rng.randint(0, 255, (64, 64, 4)).astype(np.uint8))]
+        sampler = SurfSampler.__new__(SurfSampler)
+        sampler.opts = SimpleNamespace(image_size=16, context_levels=[1], target_mpp=None, target_level=0)
+        sampler.metadata = {}
+        sampler.slide_infos = {'slide.tif': {'level_downsamples': [1.0, 4.0], 'mpp': 0.25}}
+        sampler.open_region = lambda path, level=0: (self.levels[level], self.levels[level])
+        sampler.batch_contexts = np.zeros((2, 1, 16, 16, 3), np.uint8)
+        self.sampler = sampler
+
+    def test_centred_crop(self):
+        # The patch centre (104, 72) is (26, 18) on level 1
+        self.sampler.read_contexts(1, 'slide.tif', 96, 64)
+        np.testing.assert_array_equal(self.sampler.batch_contexts[1, 0], self.levels[1].array[10:26, 18:34, :3])
+        self.assertFalse(self.sampler.batch_contexts[0].any())
+
+    def test_slide_border(self):
+        # The crop of the patch at the top left starts 6 level 1 pixels outside the slide, which is white
+        self.sampler.read_contexts(0, 'slide.tif', 0, 0)
+        context = self.sampler.batch_contexts[0, 0]
+        np.testing.assert_array_equal(context[6:, 6:], self.levels[1].array[:10, :10, :3])
+        self.assertTrue((context[:6] == 255).all() and (context[:, :6] == 255).all())
+
+    def test_batch_output(self):
+        patches, masks = np.zeros((2, 16, 16, 3), np.uint8), np.zeros((2, 16, 16, 1), np.uint8)
+        (out_patches, contexts), out_masks = self.sampler.batch_output(patches, masks)
+        self.assertIs(out_patches, patches)
+        self.assertIs(contexts, self.sampler.batch_contexts)
+        self.assertIs(out_masks, masks)
+        self.sampler.opts.context_levels = []
+        self.assertIs(self.sampler.batch_output(patches, masks)[0], patches)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import numpy as np
+import os
+import heapq
+import cv2
+
+
+def slide_work(paths, contour_index=None, metadata=None):
+    """
+    Expected work per slide of (slide, label) pairs or slide paths:
+        > tissue area on the overview, from the dataset manifest (`metadata`,
+          slide path -> manifest entry, see surf_manifest.py) or the contour index,
+          if known for all slides
+        > file size otherwise (background tiles compress well, so it follows the tissue area)
+    """
+    slides = [path[0] if isinstance(path, (tuple, list)) else path for path in paths]
+    labels = [path[1] if isinstance(path, (tuple, list)) else None for path in paths]
+    metadata = metadata or {}
+    entries = [metadata.get(slide, {}) for slide in slides]
+    if all(entry.get('tissue_area') is not None for entry in entries):
+        return np.maximum(np.array([entry['tissue_area'] for entry in entries], dtype=np.float64), 1.0)
+    if contour_index is not None:
+        areas = []
+        for slide, label in zip(slides, labels):
+            entry = contour_index.lookup(slide, label)
+            if entry is None:
+                break
+            areas.append(sum(cv2.contourArea(np.asarray(contour, dtype=np.int32)) for contour in entry['contours']))
+        else:
+            return np.maximum(np.array(areas, dtype=np.float64), 1.0)
+    return np.array([max(entry['size'] if 'size' in entry else os.path.getsize(slide), 1)
+                     for slide, entry in zip(slides, entries)], dtype=np.float64)
+
+
+def plan_shards(work, num_ranks, seed=0, epoch=0, jitter=0.1):
+    """
+    - Longest Processing Time first (LPT) assignment of slides to ranks: the
+    slides are sorted by decreasing work, and every slide goes to the rank with
+    the least work so far. The maximum rank load is at most 4/3 of the optimum.
+
+    - Every epoch the work is perturbed by up to `jitter` with a generator
+    seeded by (seed, epoch), so ranks see different slides over the epochs,
+    while every rank computes the same plan without communication.
+
+    - If there are fewer slides than ranks, slides are repeated so every rank
+    gets at least one.
+
+    Returns (shards, loads): the slide indices and the expected work per rank
+    """
+    work = np.asarray(work, dtype=np.float64)
+    indices = np.arange(len(work))
+    if len(indices) < num_ranks:
+        indices = np.resize(indices, num_ranks)
+    rng = np.random.RandomState((seed * 100003 + epoch) % 2**32)
+    perturbed = work[indices] * (1 + jitter * rng.uniform(-1, 1, size=len(indices)))
+
+    shards = [[] for _ in range(num_ranks)]
+    loads = np.zeros(num_ranks, dtype=np.float64)
+    heap = [(0.0, rank) for rank in range(num_ranks)]
+    for i in np.argsort(-perturbed, kind='stable'):
+        load, rank = heapq.heappop(heap)
+        shards[rank].append(int(indices[i]))
+        loads[rank] += work[indices[i]]
+        heapq.heappush(heap, (load + perturbed[i], rank))
+
+    # Visit the slides of a rank in a random order
+    for shard in shards:
+        rng.shuffle(shard)
+    return shards, loads
+
+
+def shard_report(loads, unit='work'):
+    """ One line summary of the expected work per rank """
+    loads = np.asarray(loads, dtype=np.float64)
+    imbalance = loads.max() / max(loads.mean(), 1e-12)
+    return (f"expected {unit} per rank: min {loads.min():.3g}, mean {loads.mean():.3g}, max {loads.max():.3g} "
+            f"(max / mean = {imbalance:.2f})")
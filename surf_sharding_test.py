@@ -0,0 +1,72 @@
+"""Tests for surf_sharding."""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from surf_sharding import plan_shards, shard_report, slide_work
+
+
+class PlanShardsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work = np.random.RandomState(0).lognormal(size=50)
+
+    def test_partition_and_balance(self):
+        shards, loads = plan_shards(self.work, 4, jitter=0)
+        self.assertEqual(sorted(i for shard in shards for i in shard), list(range(50)))
+        np.testing.assert_allclose(loads, [self.work[shard].sum() for shard in shards])
+        # LPT: the maximum load is at most 4/3 of the optimum, here even of its lower bound (the mean or the largest slide)
+        optimum = max(self.work.sum() / 4, self.work.max())
+        self.assertLessEqual(loads.max(), 4 / 3 * optimum)
+
+    def test_lpt_assignment(self):
+        # Sorted 8, 7, 6, 5, 4: the rank with the least work (on a tie the first) gets the next slide
+        shards, loads = plan_shards([5, 8, 4, 7, 6], 2, jitter=0)
+        self.assertEqual(list(map(sorted, shards)), [[0, 1, 2], [3, 4]])
+        np.testing.assert_array_equal(loads, [17, 13])
+
+    def test_deterministic(self):
+        shards, loads = plan_shards(self.work, 4, seed=3, epoch=1)
+        again, again_loads = plan_shards(self.work, 4, seed=3, epoch=1)
+        self.assertEqual(shards, again)
+        np.testing.assert_array_equal(loads, again_loads)
+        # Another epoch perturbs the plan
+        self.assertNotEqual(plan_shards(self.work, 4, seed=3, epoch=2)[0], shards)
+
+    def test_fewer_slides_than_ranks(self):
+        shards, _ = plan_shards([1, 2, 3], 5)
+        self.assertTrue(all(len(shard) == 1 for shard in shards))
+        self.assertEqual({i for shard in shards for i in shard}, {0, 1, 2})
+
+    def test_report(self):
+        self.assertEqual(shard_report([1, 2, 3], unit='pixels'),
+                         'expected pixels per rank: min 1, mean 2, max 3 (max / mean = 1.50)')
+
+
+class SlideWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.tmp_dir, f'slide_{i}.tif') for i in range(2)]
+        for path, size in zip(self.paths, (10, 30)):
+            with open(path, 'wb') as f:
+                f.write(b'0' * size)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_file_size(self):
+        np.testing.assert_array_equal(slide_work(self.paths), [10, 30])
+        np.testing.assert_array_equal(slide_work([(path, None) for path in self.paths]), [10, 30])
+
+    def test_manifest(self):
+        metadata = {self.paths[0]: {'tissue_area': 500, 'size': 10}, self.paths[1]: {'tissue_area': 0, 'size': 30}}
+        np.testing.assert_array_equal(slide_work(self.paths, metadata=metadata), [500, 1])
+        # Without the tissue area of all slides, the manifest sizes are used
+        del metadata[self.paths[1]]['tissue_area']
+        np.testing.assert_array_equal(slide_work(self.paths, metadata=metadata), [10, 30])
+
+
+if __name__ == '__main__':
+    unittest.main()
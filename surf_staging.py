@@ -0,0 +1,123 @@
+import numpy as np
+import cv2
+
+
+# Largest diameters (in micron) of the CAMELYON17 metastasis categories
+ITC_MAX_UM = 200
+MICRO_MAX_UM = 2000
+
+
+def slide_resolution(slide):
+    """ Resolution of level 0 of an OpenSlide in micron per pixel """
+    try:
+        # CAM16
+        resolution = (float(slide.properties['openslide.mpp-x']) + float(slide.properties['openslide.mpp-y'])) / 2
+    except KeyError:
+        # CAM 17
+        resolution = ( float(slide.properties['tiff.YResolution']) / float(slide.properties['openslide.level[0].height']) +
+                       float(slide.properties['tiff.XResolution'])  / float(slide.properties['openslide.level[0].width']) ) / 2
+    return resolution
+
+
+class StagingMap():
+    """
+    - Low resolution tumor probability map of a whole slide image, used for
+    the pN staging of `get_metastase`. Predictions are accumulated directly at
+    `res_for_micro` (level 0 pixels per map pixel), chosen so that the smallest
+    relevant size (`ITC_MAX_UM`, 200 micron) spans `pixels_per_itc` map pixels.
+    Memory is bounded by the map size, e.g. ~6 MB for a 100k x 100k slide at
+    0.25 micron per pixel, instead of the full level 0 mask.
+
+    - Predicted patches are added with `add` (or a batch of them with
+    `add_batch`, at the coordinates of the `save_data` entries of the
+    sampler), stitched probability maps of `TiledInference` with `add_map`.
+    Overlapping predictions keep the maximum.
+
+    - `stage` thresholds the map, labels its connected components and measures
+    the largest diameter (the Feret diameter of the convex hull) of every
+    component in micron. The largest component decides the category:
+        > negative  : no tumor pixels
+        > itc       : < 200 micron
+        > micro     : 200 - 2000 micron
+        > macro     : > 2000 micron
+
+    See https://camelyon17.grand-challenge.org/Evaluation/
+
+    >>>>Example:
+
+    staging_map = StagingMap(wsi.dimensions, slide_resolution(wsi))
+    staging_map.add(y_topleft, x_topleft, predictions[0, ..., 0] / 255)
+    stage, diameter = staging_map.stage()
+
+    """
+    def __init__(self, dimensions, resolution, pixels_per_itc=10, threshold=0.5):
+        self.resolution = resolution
+        self.threshold = threshold
+        # Level 0 pixels per map pixel
+        self.res_for_micro = max(1, int(round(ITC_MAX_UM / pixels_per_itc / resolution)))
+        # Micron per map pixel
+        self.pixel_um = self.res_for_micro * resolution
+        width, height = dimensions
+        self.map = np.zeros((int(np.ceil(height / self.res_for_micro)), int(np.ceil(width / self.res_for_micro))), dtype=np.float32)
+
+    def add(self, row, column, prob, footprint=None):
+        """
+        Add a (H,W) or (H,W,1) tumor probability patch at its level 0 top-left
+        (row, column). It covers `footprint` level 0 pixels (a patch sampled
+        at a target magnification, see SurfSampler.footprint), by default H x W
+        """
+        prob = np.asarray(prob, dtype=np.float32).reshape(prob.shape[0], prob.shape[1])
+        height, width = (footprint, footprint) if footprint else prob.shape
+        r, c = int(row) // self.res_for_micro, int(column) // self.res_for_micro
+        # Cover the complete footprint of the patch, so neighbouring patches leave no gaps
+        h = -(-(int(row) + height) // self.res_for_micro) - r
+        w = -(-(int(column) + width) // self.res_for_micro) - c
+        prob = cv2.resize(prob, (w, h), interpolation=cv2.INTER_AREA).reshape(h, w)
+        # Clip at the slide border
+        h, w = min(h, self.map.shape[0] - r), min(w, self.map.shape[1] - c)
+        if h <= 0 or w <= 0:
+            return
+        np.maximum(self.map[r:r + h, c:c + w], prob[:h, :w], out=self.map[r:r + h, c:c + w])
+
+    def add_batch(self, entries, probs, footprint=None):
+        """ Add the (batch,H,W) probability patches `probs` of `footprint` at the (row, column) 'coords' of their `entries` """
+        for entry, prob in zip(entries, probs):
+            row, column = entry['coords']
+            self.add(row, column, prob, footprint)
+
+    def add_map(self, prob_map, downsample):
+        """ Add a complete tumor probability map of the slide at `downsample` (level 0 pixels per pixel) """
+        scale = downsample / self.res_for_micro
+        h = min(self.map.shape[0], int(round(prob_map.shape[0] * scale)))
+        w = min(self.map.shape[1], int(round(prob_map.shape[1] * scale)))
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        prob = cv2.resize(np.asarray(prob_map, dtype=np.float32), (w, h), interpolation=interpolation).reshape(h, w)
+        np.maximum(self.map[:h, :w], prob, out=self.map[:h, :w])
+
+    def diameters(self):
+        """ Largest diameter in micron of every connected tumor component of the map """
+        binary = (self.map >= self.threshold).astype(np.uint8)
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        diameters = []
+        # Label 0 is the background
+        for label in range(1, num_labels):
+            x, y, w, h = stats[label, :4]
+            component = (labels[y:y + h, x:x + w] == label).astype(np.uint8)
+            points = cv2.findNonZero(component)
+            hull = cv2.convexHull(points).reshape(-1, 2).astype(np.float32)
+            # Feret diameter, plus one pixel as the hull goes through pixel centers
+            feret = np.sqrt(((hull[:, None] - hull[None]) ** 2).sum(-1)).max() + 1
+            diameters.append(feret * self.pixel_um)
+        return np.array(diameters, dtype=np.float32)
+
+    def stage(self):
+        """ (category, largest diameter in micron) of the slide """
+        diameters = self.diameters()
+        if not len(diameters):
+            return 'negative', 0.0
+        diameter = float(diameters.max())
+        if diameter > MICRO_MAX_UM:
+            return 'macro', diameter
+        if diameter >= ITC_MAX_UM:
+            return 'micro', diameter
+        return 'itc', diameter
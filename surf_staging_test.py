@@ -0,0 +1,72 @@
+"""Tests for surf_staging."""
+import unittest
+import numpy as np
+from surf_staging import MICRO_MAX_UM, StagingMap
+
+
+class StagingMapTest(unittest.TestCase):
+
+    def setUp(self):
+        # 2 micron per pixel: 10 level 0 pixels per map pixel
+        self.staging_map = StagingMap((4000, 3000), 2.0)
+
+    def test_add_batch_coords(self):
+        entries = [{'coords': [0, 0]}, {'coords': [2000, 3000]}, {'coords': [500, 1200]}]
+        probs = np.stack([np.full((100, 100), value, np.float32) for value in (1.0, 0.8, 0.6)])
+        self.staging_map.add_batch(entries, probs)
+        self.assertEqual(self.staging_map.res_for_micro, 10)
+        expected = np.zeros_like(self.staging_map.map)
+        expected[0:10, 0:10] = 1.0
+        expected[200:210, 300:310] = 0.8
+        expected[50:60, 120:130] = 0.6
+        np.testing.assert_allclose(self.staging_map.map, expected, atol=1e-6)
+
+    def test_add_batch_equals_add(self):
+        rng = np.random.RandomState(0)
+        entries = [{'coords': [int(row), int(column)]} for row, column in rng.randint(0, 2900, (4, 2))]
+        probs = rng.uniform(size=(4, 100, 100)).astype(np.float32)
+        self.staging_map.add_batch(entries, probs)
+        single = StagingMap((4000, 3000), 2.0)
+        for entry, prob in zip(entries, probs):
+            single.add(*entry['coords'], prob)
+        np.testing.assert_array_equal(self.staging_map.map, single.map)
+
+    def test_add_footprint(self):
+        # A 100 x 100 patch sampled at downsample 4 covers 400 x 400 level 0 pixels
+        self.staging_map.add(1000, 2000, np.ones((100, 100), np.float32), footprint=400)
+        rows, columns = np.nonzero(self.staging_map.map)
+        self.assertEqual((rows.min(), rows.max(), columns.min(), columns.max()), (100, 139, 200, 239))
+
+    def test_add_map(self):
+        # A map at downsample 40 is upsampled by 4 to the 10 level 0 pixels of the staging map
+        prob_map = np.zeros((75, 100), np.float32)
+        prob_map[10:20, 30:40] = 1.0
+        self.staging_map.add_map(prob_map, 40)
+        self.assertEqual(self.staging_map.map.shape, (300, 400))
+        self.assertTrue((self.staging_map.map[42:78, 122:158] == 1).all())
+        self.assertFalse(self.staging_map.map[:36].any() or self.staging_map.map[84:].any())
+
+    def test_feret_diameter(self):
+        # 20 micron per map pixel
+        self.assertEqual(self.staging_map.pixel_um, 20.0)
+        self.staging_map.map[10:13, 10:14] = 1.0
+        self.staging_map.map[50, 50:60] = 0.9
+        self.staging_map.map[100, 100] = 0.4
+        diameters = sorted(self.staging_map.diameters())
+        # A 4 x 3 rectangle spans its diagonal, a 10 pixel line its length
+        np.testing.assert_allclose(diameters, [(np.sqrt(3 ** 2 + 2 ** 2) + 1) * 20, 10 * 20], rtol=1e-6)
+
+    def test_stage(self):
+        self.assertEqual(self.staging_map.stage(), ('negative', 0.0))
+        self.staging_map.map[10, 10:15] = 1.0
+        self.assertEqual(self.staging_map.stage(), ('itc', 100.0))
+        # The largest component decides, 200 micron is micro
+        self.staging_map.map[50, 50:60] = 1.0
+        self.assertEqual(self.staging_map.stage(), ('micro', 200.0))
+        self.staging_map.map[100, 100:201] = 1.0
+        self.assertEqual(self.staging_map.stage(), ('macro', 101 * 20.0))
+        self.assertGreater(101 * 20.0, MICRO_MAX_UM)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+"""
+- Stratified train sampling: every candidate patch position of a slide (the
+tissue pixels of the overview at `bb_downsample`, as top left corners) is
+labelled from the overview mask by the tumor fraction of the patch footprint:
+
+    tumor    : at least `TUMOR_FRACTION` of the footprint is tumor
+    boundary : some, but less than `TUMOR_FRACTION` of the footprint is tumor
+    normal   : no tumor in the footprint
+
+- `StratifiedIndex` draws exact numbers of positions per stratum over all
+tumor regions of all slides, uniform over the positions of a stratum: the
+slide with an alias table weighted by its number of positions, then a
+position of the slide uniformly. Every draw is a valid position, so there
+are no retries. With per position weights (e.g. the difficulty of
+surf_mining.py) the draws are proportional to the weights instead.
+"""
+import numpy as np
+import cv2
+
+
+STRATA = ('normal', 'boundary', 'tumor')
+
+# Minimum tumor fraction of the patch footprint of a tumor position
+TUMOR_FRACTION = 0.5
+
+
+def window_sums(mask, size):
+    """
+    Sum of the binary (or, as float64, any) `mask` in the `size` x `size`
+    window with its top left corner at every pixel (windows that cross the
+    border are cut off), from the integral image
+    """
+    if mask.dtype == np.float64:
+        integral = cv2.integral(np.ascontiguousarray(mask), sdepth=cv2.CV_64F)
+    else:
+        integral = cv2.integral(np.ascontiguousarray(mask, dtype=np.uint8), sdepth=cv2.CV_32S)
+    height, width = mask.shape
+    # Edge padding cuts the windows off at the border, with slices instead of index arrays
+    integral = np.pad(integral, ((0, size), (0, size)), mode='edge')
+    return (integral[size:size + height, size:size + width] - integral[:height, size:size + width]
+            - integral[size:size + height, :width] + integral[:height, :width])
+
+
+def slide_strata(contours, mask_image, shape, mag_factor, image_size, dimensions, foreground=None):
+    """
+    (positions, strata) of a slide: the (row, column) pixels of its overview
+    of `shape` inside the tissue `contours` of which the patch fits in the
+    level 0 `dimensions` (width, height), and their stratum (index in STRATA).
+    `mask_image` is the overview mask (None for a slide without labels, all normal).
+    `foreground` (see surf_coords.foreground_mask) drops the background
+    positions, unless it would drop all of them
+    """
+    width, height = dimensions
+    shape = shape[:2]
+    tissue = np.zeros(shape, dtype=np.uint8)
+    cv2.drawContours(tissue, [np.asarray(contour, dtype=np.int32) for contour in contours], -1, 1, -1)
+    # The patch has to fit in the slide
+    tissue[max(0, (height - image_size) // mag_factor + 1):] = 0
+    tissue[:, max(0, (width - image_size) // mag_factor + 1):] = 0
+    if foreground is not None and (tissue & foreground).any():
+        tissue &= foreground
+    positions = np.transpose(np.nonzero(tissue)).astype(np.int32)
+
+    strata = np.zeros(len(positions), dtype=np.uint8)
+    if mask_image is not None and len(positions):
+        size = max(1, int(round(image_size / mag_factor)))
+        tumor = window_sums(mask_image[..., 0] > 0, size)[positions[:, 0], positions[:, 1]]
+        area = (np.minimum(positions[:, 0] + size, shape[0]) - positions[:, 0]) * (np.minimum(positions[:, 1] + size, shape[1]) - positions[:, 1])
+        strata[tumor > 0] = STRATA.index('boundary')
+        strata[tumor >= TUMOR_FRACTION * area] = STRATA.index('tumor')
+    return positions, strata
+
+
+class AliasTable():
+    """
+    Walker / Vose alias table: O(1) draws of indices with probability
+    proportional to `weights`, after O(n) construction
+    """
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        probs = weights * n / weights.sum()
+        self.prob = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if probs[i] < 1.0]
+        large = [i for i in range(n) if probs[i] >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = probs[s], l
+            probs[l] -= 1.0 - probs[s]
+            (small if probs[l] < 1.0 else large).append(l)
+
+    def draw(self, n, rng=np.random):
+        """ `n` indices """
+        i = rng.randint(0, len(self.prob), size=n)
+        return np.where(rng.random_sample(n) < self.prob[i], i, self.alias[i])
+
+
+class StratifiedIndex():
+    """
+    - Candidate patch positions per stratum of a set of slides, see slide_strata.
+
+    - `draw(counts)` returns exactly counts[stratum] positions of every
+    stratum. A stratum without positions on any slide is filled from the
+    next one in the `fallback` order (tumor -> boundary -> normal).
+
+    - `weights` (per slide, one per position of slide_strata) makes the
+    draws proportional to the weights, over the slides and within a slide.
+
+    >>>>Example:
+
+    index = StratifiedIndex([slide_strata(...) for slide in slides], mag_factor=2**7)
+    slides, coords, strata = index.draw({'tumor': 1, 'boundary': 0, 'normal': 1})
+    """
+    fallback = {'tumor': 'boundary', 'boundary': 'normal', 'normal': 'tumor'}
+
+    def __init__(self, slide_entries, mag_factor, rng=None, weights=None):
+        self.mag_factor = mag_factor
+        self.rng = rng if rng is not None else np.random
+        self.positions = {}
+        self.cumulative = {}
+        self.tables = {}
+        for k, stratum in enumerate(STRATA):
+            per_slide = [positions[strata == k] for positions, strata in slide_entries]
+            if weights is None:
+                totals = np.array([len(positions) for positions in per_slide], dtype=np.float64)
+            else:
+                # Cumulative weights of the positions of a slide, to draw with searchsorted
+                self.cumulative[stratum] = [np.cumsum(w[strata == k], dtype=np.float64) for w, (_, strata) in zip(weights, slide_entries)]
+                totals = np.array([c[-1] if len(c) else 0.0 for c in self.cumulative[stratum]])
+            if totals.sum():
+                self.positions[stratum] = per_slide
+                self.tables[stratum] = AliasTable(totals)
+
+    def counts(self):
+        """ Number of positions per stratum """
+        return {stratum: sum(len(positions) for positions in self.positions.get(stratum, [])) for stratum in STRATA}
+
+    def draw_stratum(self, stratum, n):
+        """ (slide indices, level 0 (row, column) coordinates, stratum drawn from) of `n` positions of `stratum` """
+        for _ in STRATA:
+            if stratum in self.tables:
+                break
+            stratum = self.fallback[stratum]
+        else:
+            raise ValueError("No candidate patch positions in any stratum")
+        slides = self.tables[stratum].draw(n, self.rng)
+        if stratum in self.cumulative:
+            cumulative = self.cumulative[stratum]
+            picks = [np.searchsorted(cumulative[s], self.rng.random_sample() * cumulative[s][-1], side='right') for s in slides]
+        else:
+            picks = [self.rng.randint(len(self.positions[stratum][s])) for s in slides]
+        coords = np.stack([self.positions[stratum][s][i] for s, i in zip(slides, picks)]) if n else np.zeros((0, 2), np.int32)
+        return slides, coords.astype(np.int64) * self.mag_factor, stratum
+
+    def draw(self, counts):
+        """ (slide indices, level 0 (row, column) coordinates, stratum names) with counts[stratum] per stratum """
+        slides, coords, strata = [], [], []
+        for stratum, n in counts.items():
+            s, c, stratum = self.draw_stratum(stratum, n)
+            slides.append(s)
+            coords.append(c)
+            strata += [stratum] * n
+        return np.concatenate(slides), np.concatenate(coords), strata
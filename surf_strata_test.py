@@ -0,0 +1,89 @@
+"""Tests for surf_strata."""
+import unittest
+import numpy as np
+from surf_strata import STRATA, AliasTable, StratifiedIndex, slide_strata, window_sums
+
+
+class WindowSumsTest(unittest.TestCase):
+
+    def test_against_direct(self):
+        rng = np.random.RandomState(0)
+        for mask in (rng.randint(0, 2, (13, 17)).astype(np.uint8), rng.uniform(size=(13, 17))):
+            sums = window_sums(mask, 4)
+            expected = np.array([[mask[r:r + 4, c:c + 4].sum() for c in range(17)] for r in range(13)])
+            np.testing.assert_allclose(sums, expected)
+
+
+class AliasTableTest(unittest.TestCase):
+
+    def test_frequencies(self):
+        weights = np.array([1.0, 0.0, 3.0, 6.0])
+        draws = AliasTable(weights).draw(200000, np.random.RandomState(0))
+        frequencies = np.bincount(draws, minlength=4) / len(draws)
+        np.testing.assert_allclose(frequencies, weights / weights.sum(), atol=0.005)
+        self.assertEqual(frequencies[1], 0)
+
+
+class SlideStrataTest(unittest.TestCase):
+
+    def test_strata(self):
+        # 20 x 20 overview of tissue, tumor in rows 8 - 11, a footprint of 4 x 4 overview pixels
+        contour = np.array([[[0, 0]], [[19, 0]], [[19, 19]], [[0, 19]]], dtype=np.int32)
+        mask = np.zeros((20, 20, 1), np.uint8)
+        mask[8:12] = 255
+        positions, strata = slide_strata([contour], mask, (20, 20), 16, 64, (320, 320))
+        # The patch fits in the slide up to the top left at overview pixel 16
+        self.assertEqual(positions.max(), 16)
+        by_row = {row: set(strata[positions[:, 0] == row]) for row in range(17)}
+        self.assertEqual(by_row[0], {STRATA.index('normal')})
+        self.assertEqual(by_row[5], {STRATA.index('boundary')})
+        self.assertEqual(by_row[6], {STRATA.index('tumor')})
+        self.assertEqual(by_row[10], {STRATA.index('tumor')})
+        self.assertEqual(by_row[11], {STRATA.index('boundary')})
+        self.assertEqual(by_row[12], {STRATA.index('normal')})
+
+    def test_without_mask(self):
+        contour = np.array([[[2, 2]], [[5, 2]], [[5, 5]], [[2, 5]]], dtype=np.int32)
+        positions, strata = slide_strata([contour], None, (20, 20), 16, 64, (320, 320))
+        self.assertEqual(len(positions), 16)
+        self.assertFalse(strata.any())
+
+
+class StratifiedIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        positions = np.array([[row, column] for row in range(10) for column in range(10)], dtype=np.int32)
+        strata = np.zeros(100, np.uint8)
+        strata[:5] = STRATA.index('tumor')
+        # A slide with 5 tumor positions and one without tumor
+        self.entries = [(positions, strata), (positions, np.zeros(100, np.uint8))]
+
+    def test_exact_counts(self):
+        index = StratifiedIndex(self.entries, 16, rng=np.random.RandomState(0))
+        self.assertEqual(index.counts(), {'normal': 195, 'boundary': 0, 'tumor': 5})
+        slides, coords, strata = index.draw({'tumor': 3, 'boundary': 2, 'normal': 4})
+        # The boundary draws fall back to normal
+        self.assertEqual(strata, ['tumor'] * 3 + ['normal'] * 6)
+        # The tumor positions are the first 5 of the first slide, (0, 0) - (0, 4)
+        self.assertFalse(slides[:3].any())
+        self.assertFalse(coords[:3, 0].any())
+        self.assertTrue((coords[:3, 1] < 5 * 16).all())
+        self.assertFalse((coords % 16).any())
+
+    def test_uniform_over_slides(self):
+        index = StratifiedIndex(self.entries, 1, rng=np.random.RandomState(0))
+        slides, _, _ = index.draw({'normal': 20000})
+        # 95 normal positions on the first slide, 100 on the second
+        self.assertAlmostEqual(np.mean(slides == 0), 95 / 195, delta=0.015)
+
+    def test_weights(self):
+        weights = [np.zeros(100), np.zeros(100)]
+        weights[1][42] = 1.0
+        index = StratifiedIndex(self.entries, 1, rng=np.random.RandomState(0), weights=weights)
+        slides, coords, _ = index.draw({'normal': 50})
+        self.assertTrue((slides == 1).all())
+        self.assertTrue((coords == (4, 2)).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+import numpy as np
+import os
+import threading
+from collections import OrderedDict
+import pyvips
+
+
+class SlidePool():
+    """
+    - Per process pool of open pyvips images and regions, keyed by (path,
+    level, thread), so a slide is opened once instead of on every batch.
+    Regions are not thread safe, so every thread (e.g. the interleaved
+    generators of `SurfSampler.as_dataset`) gets its own.
+
+    - At most `max_open` handles are kept open, the least recently used is
+    dropped (pyvips closes the file when the image is garbage collected).
+    """
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, level=0):
+        """ (pyvips.Image, pyvips.Region) of `path` at pyramid `level` """
+        key = (path, level, threading.get_ident())
+        with self.lock:
+            if key in self.handles:
+                self.handles.move_to_end(key)
+                return self.handles[key]
+        image = pyvips.Image.new_from_file(path, level=level) if level else pyvips.Image.new_from_file(path)
+        handle = (image, pyvips.Region.new(image))
+        with self.lock:
+            self.handles[key] = handle
+            while len(self.handles) > self.max_open:
+                self.handles.popitem(last=False)
+        return handle
+
+    def __len__(self):
+        return len(self.handles)
+
+
+class TileCache():
+    """
+    - Byte bounded LRU cache of decoded tiles of `tile_size` x `tile_size`
+    pixels, keyed by (slide, level, tile_x, tile_y). Patches are assembled
+    from the cached tiles (`fetch`), so adjacent and overlapping patches of
+    the same ROI decode every tile once.
+
+    - At most `max_bytes` of tiles are kept, the least recently used tile is
+    evicted first. Counters to size the cache against the node RAM are
+    available through `stats()`:
+        > hits, misses  : tile lookups
+        > evictions     : tiles dropped to stay below `max_bytes`
+        > bytes         : current size of the cached tiles
+        > handles       : open slide handles of the SlidePool
+
+    - One cache per process (`tile_cache`), shared by all samplers of the process.
+
+    >>>>Example:
+
+    slide = tile_cache(opts.tile_cache_mb).slide(slide_path)
+    patch = np.ndarray((1024, 1024, slide.get('bands')), buffer=slide.fetch(x, y, 1024, 1024), dtype=np.uint8)
+    """
+    def __init__(self, max_bytes, tile_size=512, max_open=32):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.pool = SlidePool(max_open)
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def slide(self, path, level=0):
+        """ CachedSlide of `path`, used in place of the pyvips image and region """
+        return CachedSlide(self, path, level)
+
+    def tile(self, path, level, tx, ty):
+        """ Decoded (h, w, bands) uint8 tile, smaller than tile_size at the right / bottom border """
+        key = (path, level, tx, ty)
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+
+        image, region = self.pool.get(path, level)
+        x, y = tx * self.tile_size, ty * self.tile_size
+        width, height = min(self.tile_size, image.width - x), min(self.tile_size, image.height - y)
+        tile = np.ndarray((height, width, image.bands), buffer=region.fetch(x, y, width, height), dtype=np.uint8)
+
+        with self.lock:
+            if key not in self.tiles:
+                self.tiles[key] = tile
+                self.bytes += tile.nbytes
+            while self.bytes > self.max_bytes and len(self.tiles) > 1:
+                _, evicted = self.tiles.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+        return tile
+
+    def fetch(self, path, level, x, y, width, height):
+        """ (height, width, bands) uint8 window at (x, y) of `level`, assembled from tiles """
+        image, _ = self.pool.get(path, level)
+        if x < 0 or y < 0 or x + width > image.width or y + height > image.height:
+            raise ValueError(f"Window ({x}, {y}, {width}, {height}) outside of {path} ({image.width} x {image.height})")
+        out = np.empty((height, width, image.bands), dtype=np.uint8)
+        ts = self.tile_size
+        for ty in range(y // ts, (y + height - 1) // ts + 1):
+            for tx in range(x // ts, (x + width - 1) // ts + 1):
+                tile = self.tile(path, level, tx, ty)
+                # Overlap of the window and the tile, in slide coordinates
+                x0, y0 = max(x, tx * ts), max(y, ty * ts)
+                x1, y1 = min(x + width, tx * ts + tile.shape[1]), min(y + height, ty * ts + tile.shape[0])
+                out[y0 - y:y1 - y, x0 - x:x1 - x] = tile[y0 - ty * ts:y1 - ty * ts, x0 - tx * ts:x1 - tx * ts]
+        return out
+
+    def stats(self):
+        lookups = max(self.hits + self.misses, 1)
+        return {'hits'     : self.hits,
+                'misses'   : self.misses,
+                'hit_rate' : round(self.hits / lookups, 3),
+                'evictions': self.evictions,
+                'bytes'    : self.bytes,
+                'tiles'    : len(self.tiles),
+                'handles'  : len(self.pool)}
+
+
+class CachedSlide():
+    """
+    A slide (at `level`) read through a TileCache. Like PolygonMask it can be
+    used in place of both the pyvips image and its region in the sampler:
+        > slide.get('bands')            -> number of bands
+        > slide.width, slide.height     -> size of the level
+        > slide.fetch(x, y, w, h)       -> buffer of (h, w, bands) uint8
+    """
+    def __init__(self, cache, path, level=0):
+        self.cache = cache
+        self.path = path
+        self.level = level
+
+    def get(self, name):
+        """ Mimics pyvips.Image.get """
+        image, _ = self.cache.pool.get(self.path, self.level)
+        return image.get(name)
+
+    @property
+    def width(self):
+        return self.get('width')
+
+    @property
+    def height(self):
+        return self.get('height')
+
+    def fetch(self, x, y, width, height):
+        """ Mimics pyvips.Region.fetch """
+        return self.cache.fetch(self.path, self.level, int(x), int(y), int(width), int(height))
+
+
+_caches = {}
+
+
+def tile_cache(max_mb, tile_size=512):
+    """ The TileCache of this process (a forked prefetch worker gets its own) """
+    key = (os.getpid(), max_mb, tile_size)
+    if key not in _caches:
+        _caches[key] = TileCache(int(max_mb * 2**20), tile_size)
+    return _caches[key]
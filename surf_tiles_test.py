@@ -0,0 +1,77 @@
+"""Tests for surf_tiles."""
+import unittest
+import numpy as np
+from surf_tiles import TileCache
+
+
+class FakeImage():
+    """ A (height, width, bands) array in place of the pyvips image and region of a slide level """
+    def __init__(self, array):
+        self.array = array
+        self.height, self.width, self.bands = array.shape
+        self.fetches = 0
+
+    def get(self, name):
+        return getattr(self, name)
+
+    def fetch(self, x, y, width, height):
+        self.fetches += 1
+        return np.ascontiguousarray(self.array[y:y + height, x:x + width]).tobytes()
+
+
+class FakePool():
+
+    def __init__(self, images):
+        self.images = images
+
+    def get(self, path, level=0):
+        image = self.images[path, level]
+        return image, image
+
+    def __len__(self):
+        return len(self.images)
+
+
+class TileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.image = FakeImage(rng.randint(0, 256, (50, 70, 3)).astype(np.uint8))
+        self.cache = TileCache(2**20, tile_size=16)
+        self.cache.pool = FakePool({('slide.tif', 0): self.image})
+
+    def test_fetch(self):
+        # A window over 3 x 3 tiles, and one at the right / bottom border tiles of 6 x 2 pixels
+        for x, y, width, height in ((10, 5, 30, 30), (40, 30, 30, 20), (0, 0, 70, 50)):
+            window = self.cache.fetch('slide.tif', 0, x, y, width, height)
+            np.testing.assert_array_equal(window, self.image.array[y:y + height, x:x + width])
+        with self.assertRaises(ValueError):
+            self.cache.fetch('slide.tif', 0, 60, 0, 16, 16)
+
+    def test_hits_and_misses(self):
+        self.cache.fetch('slide.tif', 0, 10, 5, 30, 30)
+        self.assertEqual((self.cache.hits, self.cache.misses, self.image.fetches), (0, 9, 9))
+        # An overlapping window decodes only its new tiles
+        self.cache.fetch('slide.tif', 0, 20, 5, 30, 30)
+        self.assertEqual((self.cache.hits, self.cache.misses, self.image.fetches), (6, 12, 12))
+        stats = self.cache.stats()
+        self.assertEqual(stats['tiles'], 12)
+        self.assertEqual(stats['bytes'], 12 * 16 * 16 * 3)
+        self.assertEqual(stats['hit_rate'], 0.333)
+
+    def test_lru_eviction(self):
+        tile_bytes = 16 * 16 * 3
+        self.cache.max_bytes = 2 * tile_bytes
+        slide = self.cache.slide('slide.tif')
+        self.assertEqual((slide.width, slide.height, slide.get('bands')), (70, 50, 3))
+        for x in (0, 16, 0, 32):
+            slide.fetch(x, 0, 16, 16)
+        # Tile (1, 0) is the least recently used when tile (2, 0) is added
+        self.assertEqual(list(self.cache.tiles), [('slide.tif', 0, 0, 0), ('slide.tif', 0, 2, 0)])
+        self.assertEqual((self.cache.evictions, self.cache.bytes), (1, 2 * tile_bytes))
+        slide.fetch(16, 0, 16, 16)
+        self.assertEqual(self.cache.misses, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+- Tissue detection of whole slide images, as contours on the overview at
+`bb_downsample` (see `slide_tissue_contours`). The method and its
+parameters are part of the ContourIndex key, so changing them re-indexes.
+
+    hsv  : HSV thresholding of the overview, closing and opening with
+           square kernels, contours of less than `min_contour_points`
+           points dropped (the original pipeline of SurfSampler)
+    otsu : Otsu threshold on the saturation of a thumbnail, closing and
+           opening with separable kernels on a downscaled mask, and
+           connected components smaller than `min_area` dropped. The
+           thumbnail is the smallest pyramid level that is at least
+           `thumbnail_size` pixels wide or high, and sizes are in level 0
+           pixels, so the result does not depend on the level
+"""
+import numpy as np
+import cv2
+
+
+# Tissue detection parameters per method (also part of the ContourIndex key)
+TISSUE_METHODS = {
+    'hsv' : {'hsv_lower'         : [20, 20, 20],
+             'hsv_upper'         : [255, 255, 255],
+             'close_kernel'      : 50,
+             'open_kernel'       : 30,
+             'min_contour_points': 10},
+    'otsu': {'method'            : 'otsu',
+             'thumbnail_size'    : 2048,
+             'min_saturation'    : 20,
+             'close_size'        : 6400,
+             'open_size'         : 3840,
+             'min_area'          : 20 * 128 ** 2,
+             'max_kernel'        : 15},
+}
+
+# The original parameters (without a 'method' key, so existing ContourIndex entries stay valid)
+TISSUE_PARAMS = TISSUE_METHODS['hsv']
+
+
+def tissue_params(method='hsv'):
+    assert method in TISSUE_METHODS, f"WARNING: tissue method {method} not in {list(TISSUE_METHODS)}"
+    return TISSUE_METHODS[method]
+
+
+def tissue_contours(rgb_image, params=TISSUE_PARAMS):
+    """ Contours of the tissue in an overview, by HSV thresholding and morphology """
+    hsv = cv2.cvtColor(np.ascontiguousarray(rgb_image[..., :3]), cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(hsv, np.array(params['hsv_lower']), np.array(params['hsv_upper']))
+
+    # (50, 50)
+    close_kernel = np.ones((params['close_kernel'], params['close_kernel']), dtype=np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, close_kernel)
+    # (30, 30)
+    open_kernel = np.ones((params['open_kernel'], params['open_kernel']), dtype=np.uint8)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, open_kernel)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    # sometimes the bounding boxes annotate a very small area not in the ROI
+    return [contour for contour in contours if contour.shape[0] >= params['min_contour_points']]
+
+
+def thumbnail_level(level_dimensions, thumbnail_size):
+    """ Smallest pyramid level that is at least `thumbnail_size` pixels wide or high (level 0 if none is) """
+    for level in range(len(level_dimensions) - 1, -1, -1):
+        if max(level_dimensions[level]) >= thumbnail_size:
+            return level
+    return 0
+
+
+def morphology(mask, op, size, max_kernel=15):
+    """
+    Closing / opening of a binary mask with a `size` x `size` square, on a copy
+    downscaled so that the kernel is at most `max_kernel` pixels, with
+    separable (1 x k, k x 1) kernels. The result is upscaled to the mask size.
+    """
+    size = max(1, int(round(size)))
+    scale = max(1, int(np.ceil(size / max_kernel)))
+    small = mask
+    if scale > 1:
+        small = cv2.resize(mask, (max(1, mask.shape[1] // scale), max(1, mask.shape[0] // scale)), interpolation=cv2.INTER_AREA)
+        small = np.where(small >= 128, 255, 0).astype(np.uint8)
+    k = max(1, int(round(size / scale)))
+    row, column = np.ones((1, k), dtype=np.uint8), np.ones((k, 1), dtype=np.uint8)
+    first, second = (cv2.dilate, cv2.erode) if op == cv2.MORPH_CLOSE else (cv2.erode, cv2.dilate)
+    small = second(second(first(first(small, row), column), row), column)
+    if scale > 1:
+        small = cv2.resize(small, (mask.shape[1], mask.shape[0]), interpolation=cv2.INTER_NEAREST)
+    return small
+
+
+def remove_small_components(mask, min_area):
+    """ Binary mask without the connected components of less than `min_area` pixels """
+    num, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    keep = np.zeros(num, dtype=np.uint8)
+    keep[1:] = np.where(stats[1:, cv2.CC_STAT_AREA] >= min_area, 255, 0)
+    return keep[labels]
+
+
+def otsu_mask(rgb_image, params, downsample):
+    """ Tissue mask of a thumbnail at `downsample` (level 0 pixels per thumbnail pixel) """
+    saturation = cv2.cvtColor(np.ascontiguousarray(rgb_image[..., :3]), cv2.COLOR_RGB2HSV)[..., 1]
+    threshold, _ = cv2.threshold(saturation, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Otsu on a slide without tissue splits the background noise, so keep a floor
+    mask = np.where(saturation > max(threshold, params['min_saturation']), 255, 0).astype(np.uint8)
+    mask = morphology(mask, cv2.MORPH_CLOSE, params['close_size'] / downsample, params['max_kernel'])
+    mask = morphology(mask, cv2.MORPH_OPEN, params['open_size'] / downsample, params['max_kernel'])
+    return remove_small_components(mask, params['min_area'] / downsample ** 2)
+
+
+def slide_tissue_contours(wsi, overview, overview_level, params=TISSUE_PARAMS):
+    """
+    Tissue contours of an OpenSlide `wsi` on its `overview` (the RGBA image at
+    `overview_level`), with the method of `params` (see TISSUE_METHODS)
+    """
+    if params.get('method', 'hsv') == 'hsv':
+        return tissue_contours(overview, params)
+
+    level = thumbnail_level(wsi.level_dimensions, params['thumbnail_size'])
+    downsample = wsi.level_downsamples[level]
+    thumbnail = overview if level == overview_level else np.array(wsi.read_region((0, 0), level, wsi.level_dimensions[level]))
+    mask = otsu_mask(thumbnail, params, downsample)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    # From the thumbnail to the overview, clipped to it (the level sizes are rounded, tissue at the border can map past it)
+    scale = downsample / wsi.level_downsamples[overview_level]
+    height, width = overview.shape[:2]
+    return [np.clip(np.round(contour * scale), 0, [width - 1, height - 1]).astype(np.int32) for contour in contours]
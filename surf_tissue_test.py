@@ -0,0 +1,55 @@
+"""Tests for surf_tissue."""
+import types
+import unittest
+import numpy as np
+import cv2
+from surf_coords import CoordinatePool
+from surf_tissue import TISSUE_METHODS, slide_tissue_contours, tissue_contours
+
+
+def fake_slide(thumbnail, level_dimensions, level_downsamples):
+    """ The OpenSlide attributes slide_tissue_contours uses, with `thumbnail` as the image of every level """
+    return types.SimpleNamespace(level_dimensions=level_dimensions, level_downsamples=level_downsamples,
+                                 read_region=lambda location, level, size: thumbnail)
+
+
+class SlideTissueContoursTest(unittest.TestCase):
+
+    def setUp(self):
+        self.params = dict(TISSUE_METHODS['otsu'], thumbnail_size=256)
+        # Overview at level 1 (1024 x 1024), thumbnail at level 2, of which the
+        # rounded downsample maps its last pixels past the overview
+        self.overview = np.full((1024, 1024, 4), 255, np.uint8)
+        self.thumbnail = np.full((256, 256, 4), 255, np.uint8)
+        self.thumbnail[156:, 156:, :3] = (200, 60, 150)
+        self.wsi = fake_slide(self.thumbnail, [(16384, 16384), (1024, 1024), (256, 256)], [1.0, 16.0, 64.8])
+
+    def test_otsu_border_clipped(self):
+        contours = slide_tissue_contours(self.wsi, self.overview, 1, self.params)
+        self.assertEqual(len(contours), 1)
+        points = np.concatenate(contours).reshape(-1, 2)
+        # Unclipped, the last thumbnail pixel 255 maps to 1033
+        self.assertGreater(points.min(), 512)
+        self.assertEqual(points.max(), 1023)
+
+    def test_otsu_border_pool(self):
+        # The bounding box of a clipped contour stays inside a keep mask of the overview
+        keep = np.ones(self.overview.shape[:2], bool)
+        for contour in slide_tissue_contours(self.wsi, self.overview, 1, self.params):
+            pool = CoordinatePool(contour, 16, keep=keep)
+            self.assertTrue(len(pool))
+            self.assertLessEqual(pool.coords.max(), 1023 * 16)
+
+    def test_hsv(self):
+        overview = np.zeros((256, 256, 4), np.uint8)
+        cv2.circle(overview, (96, 128), 50, (150, 60, 200, 255), -1)
+        contours = tissue_contours(overview)
+        self.assertEqual(len(contours), 1)
+        points = contours[0].reshape(-1, 2)
+        # Inside the disc (the opening rounds off its border), around its center
+        self.assertTrue((points.min(0) >= (46, 78)).all() and (points.max(0) <= (146, 178)).all())
+        self.assertGreater(cv2.pointPolygonTest(contours[0], (96, 128), False), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()